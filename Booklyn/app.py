@@ -1,20 +1,38 @@
+import csv
+import io
 import os
+import re
+import threading
+import time
 from urllib.parse import urljoin
 
 
-from flask import Flask, request, render_template, redirect, flash, session, g
+import click
+from flask import Flask, request, render_template, redirect, flash, session, g, jsonify, abort, send_file
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
 
-from forms import UserAddForm, LoginForm, UserEditForm, BookReviewForm
+from forms import UserAddForm, LoginForm, UserEditForm, BookReviewForm, LibraryImportForm
 from secret import GOOGLE_BOOKS_API_KEY
-from models import db, connect_db, User, Author, Category, Publisher, Book, Review
+from models import db, connect_db, User, Author, Category, Publisher, Book, Review, SearchCacheEntry, VolumeDetail, SHELVES, SessionUser, PRINCIPAL_VERSION, LibraryImport, LibraryImportRow
+from search_cache import SearchCache, DatabaseBackend, LRUBackend, CacheEntry
+from google_books import GoogleBooksClient, book_data_from_volume
+from instrumentation import init_query_stats
+from metrics import init_metrics, token_required, TimedQueuePool
+from caching import init_caching, conditional, asset_url
+from covers import CoverCache, google_cover_url, is_allowed_url
+import jobs
+import search_index
+import library_import
+from suggest import SuggestIndex
 
 
-import requests, ast
-
 CURR_USER_KEY = 'curr_user'
+CURR_PRINCIPAL_KEY = 'curr_user_principal'
+
+# what a Google Books volume id looks like; anything else is refused before it reaches a query or a path
+VOLUME_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
 
 app = Flask(__name__)
 
@@ -30,22 +48,224 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
-
+# record how long requests wait for a pooled Postgres connection (sqlite keeps its own pool)
+if uri.startswith('postgresql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
 
 connect_db(app)
 
+# X-DB-Queries / Server-Timing headers on every response, and a log line for slow statements
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['DB_TIMING_HEADERS'] = os.environ.get('DB_TIMING_HEADERS', 'true').lower() == 'true'
+init_query_stats(app)
+
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'hellosecret1')
 
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 # debug = DebugToolbarExtension(app)
 
-url = 'https://www.googleapis.com/books/v1'
+url = os.environ.get('GOOGLE_BOOKS_URL', 'https://www.googleapis.com/books/v1')
+
+# One pooled client per worker process for every call to the Google Books API.
+books_api = GoogleBooksClient(
+    url,
+    GOOGLE_BOOKS_API_KEY,
+    pool_size=int(os.environ.get('GOOGLE_BOOKS_POOL_SIZE', 20)),
+    read_timeout=float(os.environ.get('GOOGLE_BOOKS_TIMEOUT', 10)),
+    max_retries=int(os.environ.get('GOOGLE_BOOKS_MAX_RETRIES', 2)),
+)
+
+# Search results cache: repeated searches are answered without calling the API.
+# 'memory' keeps a per-worker LRU only, 'database' adds the shared search_cache table behind it.
+app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL', 60 * 60))
+app.config['SEARCH_CACHE_STALE_TTL'] = int(os.environ.get('SEARCH_CACHE_STALE_TTL', 24 * 60 * 60))
+app.config['SEARCH_CACHE_MAX_ENTRIES'] = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 512))
+app.config['SEARCH_CACHE_BACKEND'] = os.environ.get('SEARCH_CACHE_BACKEND', 'memory')
+
+search_cache = SearchCache(
+    ttl=app.config['SEARCH_CACHE_TTL'],
+    stale_ttl=app.config['SEARCH_CACHE_STALE_TTL'],
+    max_entries=app.config['SEARCH_CACHE_MAX_ENTRIES'],
+    shared=DatabaseBackend(app, SearchCacheEntry) if app.config['SEARCH_CACHE_BACKEND'] == 'database' else None,
+)
+
+# /search answers from the Google Books API ('google'), our own books and reviews ('local'), or both ('all').
+# Without ?source= it searches the API only, as it always has; the other two are opt-in.
+SEARCH_SOURCES = ('google', 'local', 'all')
+app.config['SEARCH_DEFAULT_SOURCE'] = os.environ.get('SEARCH_DEFAULT_SOURCE', 'google')
+app.config['LOCAL_SEARCH_LIMIT'] = int(os.environ.get('LOCAL_SEARCH_LIMIT', 10))
+
+# The volumes of the search results this worker served, by volumeId, so adding one of them
+# to a list needs neither the API nor book data posted back by the form.
+search_items = LRUBackend(int(os.environ.get('SEARCH_ITEMS_MAX_ENTRIES', 4096)))
+
+# Typeahead for the search box (/search/suggest), from each worker's in-memory index of our
+# titles and authors, loaded by a background thread as the worker starts (gunicorn.conf.py)
+# and topped up with new rows every SUGGEST_REFRESH_SECONDS.
+app.config['SUGGEST_REFRESH_SECONDS'] = float(os.environ.get('SUGGEST_REFRESH_SECONDS', 5))
+app.config['SUGGEST_LIMIT'] = int(os.environ.get('SUGGEST_LIMIT', 10))
+
+suggest_index = SuggestIndex(refresh_seconds=app.config['SUGGEST_REFRESH_SECONDS'])
+
+
+# Books per page on the list pages and in /api/users/<id>/shelves/<shelf>
+app.config['SHELF_PAGE_SIZE'] = int(os.environ.get('SHELF_PAGE_SIZE', 50))
+app.config['SHELF_MAX_PAGE_SIZE'] = int(os.environ.get('SHELF_MAX_PAGE_SIZE', 200))
+
+# Rows of an imported CSV file handled per transaction (and per import_rows job); see library_import.py
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 100))
+
+# Largest request body, uploads included, in bytes; bigger ones get a 413
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+
+# Reviews per page on the book page and in /api/books/<volumeId>/reviews
+app.config['REVIEW_PAGE_SIZE'] = int(os.environ.get('REVIEW_PAGE_SIZE', 20))
+app.config['REVIEW_MAX_PAGE_SIZE'] = int(os.environ.get('REVIEW_MAX_PAGE_SIZE', 100))
+
+
+# Prometheus metrics at /metrics. With several gunicorn workers, point METRICS_DIR at a
+# directory they all share so every scrape sees the totals of all of them. The metrics
+# endpoints are off until METRICS_TOKEN is set, and then need it as a bearer token.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+init_metrics(app, db, search_cache=search_cache, books_api=books_api)
+
+# Cache-Control/ETag policy for every response; see caching.py
+init_caching(app)
+
+# Resized covers served from /covers/<volumeId>; see covers.py. The directory is shared by all workers.
+app.config['COVER_CACHE_DIR'] = os.environ.get('COVER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cover_cache'))
+app.config['COVER_CACHE_MAX_BYTES'] = int(os.environ.get('COVER_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+app.config['COVER_CACHE_MAX_KEYS'] = int(os.environ.get('COVER_CACHE_MAX_KEYS', 100000))
+app.config['COVER_MAX_AGE'] = int(os.environ.get('COVER_MAX_AGE', 30 * 24 * 60 * 60))
+
+cover_cache = CoverCache(app.config['COVER_CACHE_DIR'], app.config['COVER_CACHE_MAX_BYTES'], app.config['COVER_CACHE_MAX_KEYS'])
+
+# Background jobs (see jobs.py): run by `python jobs.py`, and by default also right after the response that queued them
+jobs.init_jobs(app)
+
+
+def fetch_search_results(params):
+    """Call the Google Books volumes search endpoint."""
+
+    return books_api.search(params)
+
+
+# Volume details are stored in volume_details and re-fetched in the background once older than this.
+app.config['VOLUME_DETAIL_TTL'] = int(os.environ.get('VOLUME_DETAIL_TTL', 7 * 24 * 60 * 60))
+
+volumes_refreshing = set()
+volumes_refreshing_lock = threading.Lock()
+
+
+def fetch_volume_detail(volumeId, etag=None):
+    """Fetch a volume from the API and store it, sending the stored ETag so unchanged volumes cost a 304."""
+
+    res = books_api.volume(volumeId, etag)
+
+    if res.status_code == 304:
+        VolumeDetail.touch(volumeId)
+        return VolumeDetail.query.get(volumeId)
+
+    res.raise_for_status()
+    return VolumeDetail.store(volumeId, res.json(), res.headers.get('ETag'))
+
+
+def refresh_volume_detail(volumeId, etag):
+    """Re-fetch an expired volume; on failure the stored copy keeps being served."""
+
+    try:
+        with app.app_context():
+            fetch_volume_detail(volumeId, etag)
+    except Exception:
+        app.logger.warning('Could not refresh volume %s', volumeId, exc_info=True)
+    finally:
+        with volumes_refreshing_lock:
+            volumes_refreshing.discard(volumeId)
+
+
+def get_volume_detail(volumeId):
+    """Return the stored details for a volume, fetching them the first time it is viewed."""
+
+    detail = VolumeDetail.query.get(volumeId)
+
+    if detail is None:
+        return fetch_volume_detail(volumeId)
+
+    if detail.is_expired(app.config['VOLUME_DETAIL_TTL']):
+        with volumes_refreshing_lock:
+            start = volumeId not in volumes_refreshing
+            volumes_refreshing.add(volumeId)
 
+        if start:
+            threading.Thread(target=refresh_volume_detail, args=(volumeId, detail.etag), daemon=True).start()
+
+    return detail
+
+
+@jobs.handler('index_book', batch_size=100)
+def index_books(queued):
+    """Rewrite the search index rows of books whose reviews changed."""
+
+    search_index.reindex([job.payload['book_id'] for job in queued])
+    db.session.commit()
+
+
+@jobs.handler('fetch_volume', batch_size=50)
+def fetch_volumes(queued):
+    """Store the volume details of newly added books, fetching a batch of them at once."""
+
+    by_volume = {job.payload['volumeId']: job for job in queued}
+    stored = {row.volumeId for row in db.session.query(VolumeDetail.volumeId).filter(VolumeDetail.volumeId.in_(by_volume))}
+    missing = [volumeId for volumeId in by_volume if volumeId not in stored]
+
+    errors = {}
+    for volumeId, result in zip(missing, books_api.volumes(missing) if missing else []):
+        if result is None:
+            errors[by_volume[volumeId].id] = 'Could not fetch the volume'
+        else:
+            VolumeDetail.store(volumeId, result)
+
+    return errors
+
+
+@jobs.handler('import_rows', after_response=False)
+def import_rows(queued):
+    """Import chunks of the stored rows of uploaded CSV files, one transaction per chunk.
+
+    Only the worker process runs these: a whole file would tie up a web worker.
+    """
+
+    errors = {}
+    for job in queued:
+        payload = job.payload
+        try:
+            library_import.import_stored_chunk(payload['import_id'], payload['user_id'], payload['start'], payload['stop'], books_api)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning('Could not import rows for import %s', payload['import_id'], exc_info=True)
+            errors[job.id] = repr(e)
+
+            # the chunk won't be retried, so count it as failed for the import to still finish
+            if job.attempts >= app.config['JOB_MAX_ATTEMPTS']:
+                rows = LibraryImportRow.chunk(payload['import_id'], payload['start'], payload['stop'])
+                LibraryImport.record_failure(payload['import_id'], len(rows))
+                LibraryImportRow.remove(payload['import_id'], payload['start'], payload['stop'])
+                db.session.commit()
+
+    return errors
 
 
 @app.route('/search')
 def search():
-    """Get book data."""
+    """Get book data.
+
+    ?source=google (the default) searches the Google Books API, ?source=local our
+    own books and reviews (see search_index.py), and ?source=all shows local
+    matches first, followed by the API's results for books we don't have.
+    """
 
     if not g.user:
         flash("Access unauthorized.", 'danger')
@@ -54,15 +274,61 @@ def search():
     user = g.user
 
     search = request.args.get('q')
+    source = request.args.get('source', app.config['SEARCH_DEFAULT_SOURCE'])
+
+    if source not in SEARCH_SOURCES:
+        source = app.config['SEARCH_DEFAULT_SOURCE']
+
+    params = {'q': search, 'maxResults': 40, 'printType': 'books'}
+
+    local = []
+    if source in ('local', 'all'):
+        local = [search_index.as_search_item(book) for book in search_index.search(search, app.config['LOCAL_SEARCH_LIMIT'])]
+
+    if source == 'local':
+        return render_template('search_result.html', result={'items': local}, search=search, user=user, source=source)
 
     try:
-        res = requests.get(f'{url}/volumes', params={'key': GOOGLE_BOOKS_API_KEY, 'q': search, 'maxResults':40, 'printType': 'books'} )
-        result = res.json()
-        return render_template('search_result.html', result=result, search=search, user=user)
+        result = search_cache.get_or_fetch(SearchCache.make_key(search, params), lambda: fetch_search_results(params))
+
+        for item in result.get('items', []):
+            search_items.set(item['id'], CacheEntry(item))
 
     except Exception:
-        flash(f"Please enter a valid keyword", 'danger')
-        return redirect('/')
+        if not local:
+            flash(f"Please enter a valid keyword", 'danger')
+            return redirect('/')
+
+        # the API is unavailable, but we can still show what we have
+        result = {}
+
+    if local:
+        ours = {item['id'] for item in local}
+        result = {**result, 'items': local + [item for item in result.get('items', []) if item['id'] not in ours]}
+
+    return render_template('search_result.html', result=result, search=search, user=user, source=source)
+
+
+@app.route('/search/suggest')
+def search_suggest():
+    """Suggestions for what has been typed into the search box, as JSON: {"suggestions": [...]}.
+
+    Answered from suggest_index alone, never from the database or the Google Books API. The
+    index is loaded in the background, so a worker answers with no suggestions until it is.
+    """
+
+    if not g.user:
+        return jsonify(error='Access unauthorized.'), 401
+
+    limit = min(request.args.get('limit', app.config['SUGGEST_LIMIT'], type=int), app.config['SUGGEST_LIMIT'])
+
+    # gunicorn has already started it; this covers `flask run`
+    suggest_index.start(app)
+
+    response = jsonify(suggestions=suggest_index.suggest(request.args.get('q', ''), max(limit, 1)))
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response
 
 ###################################################################
 # User signup/login/logout
@@ -70,25 +336,79 @@ def search():
 
 
 
+# The logged in user's id, username and image_url travel in the (signed) session cookie,
+# so most requests never load the user row. The principal is re-read from the database
+# once it is older than PRINCIPAL_MAX_AGE seconds; the per-process cache below answers
+# that re-read for the next PRINCIPAL_CACHE_TTL seconds and is cleared by users_edit.
+app.config['PRINCIPAL_MAX_AGE'] = int(os.environ.get('PRINCIPAL_MAX_AGE', 5 * 60))
+app.config['PRINCIPAL_CACHE_TTL'] = int(os.environ.get('PRINCIPAL_CACHE_TTL', 60))
+
+principal_cache = LRUBackend(int(os.environ.get('PRINCIPAL_CACHE_MAX_ENTRIES', 1024)))
+
+
+def load_principal(user_id):
+    """Principal for user_id from the per-process cache, else from the database (None if the user is gone)."""
+
+    entry = principal_cache.get(user_id)
+    if entry is not None and entry.age() < app.config['PRINCIPAL_CACHE_TTL']:
+        return entry.value
+
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+
+    principal = user.principal()
+    principal_cache.set(user_id, CacheEntry(principal))
+    return principal
+
+
+def principal_is_current(principal):
+    return (
+        principal is not None
+        and principal.get('id') == session[CURR_USER_KEY]
+        and principal.get('version') == PRINCIPAL_VERSION
+        and time.time() - principal.get('loaded_at', 0) < app.config['PRINCIPAL_MAX_AGE']
+    )
+
+
 @app.before_request
 def add_user_to_g():
-    """If logged in, add curr user to Flask global."""
+    """If logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-    else:
+    g.user is a SessionUser: it only loads the User row if a view uses more than
+    its id, username or image_url.
+    """
+
+    if CURR_USER_KEY not in session:
         g.user = None
+        return
+
+    principal = session.get(CURR_PRINCIPAL_KEY)
+
+    if not principal_is_current(principal):
+        principal = load_principal(session[CURR_USER_KEY])
+
+        if principal is None:
+            do_logout()
+            g.user = None
+            return
+
+        session[CURR_PRINCIPAL_KEY] = principal
+
+    g.user = SessionUser(principal['id'], principal['username'], principal['image_url'])
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_PRINCIPAL_KEY] = user.principal()
 
 def do_logout():
     """Logout user"""
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_PRINCIPAL_KEY, None)
 
 
 @app.route('/')
@@ -152,9 +472,12 @@ def login():
 def logout():
     """Handle logout of user."""
 
-    user = User.query.get(session[CURR_USER_KEY])
+    if not g.user:
+        return redirect('/login')
+
+    username = g.user.username
     do_logout()
-    flash(f"Goodbye, {user.username}!", 'success')
+    flash(f"Goodbye, {username}!", 'success')
     return redirect('/login')
 
 
@@ -163,278 +486,122 @@ def logout():
 # User - add to/remove from lists
 ##########################################################
 
-@app.route('/users/<int:user_id>/add_want_to_read', methods=['POST'])
-def add_want_to_read(user_id):
-    """Add book to want_to_read list."""
+def volume_record(volumeId):
+    """The canonical record of a volume: its stored details, else the search result it was
+    picked from (if this worker served it), else a fresh copy from the API."""
 
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
+    detail = VolumeDetail.query.get(volumeId)
+    if detail is not None:
+        return detail.to_result()
 
-    data = {}
-    for key, value in request.form.items():
-        data[key] = value
-    
-    # Create author data in db
-    if len(data['author']) == 0 or 'author' not in data:
-        authors = ['N/A']
-    else:
-        authors = ast.literal_eval(data['author'])
+    entry = search_items.get(volumeId)
+    if entry is not None and entry.age() < app.config['SEARCH_CACHE_TTL']:
+        return entry.value
 
-    Author.create_author_data(authors)
+    return fetch_volume_detail(volumeId).to_result()
 
-    # Create category data in db
-    if len(data['category']) == 0 or 'category' not in data:
-        categories = ['N/A']
-    else:
-        categories = ast.literal_eval(data['category'])
 
-    Category.create_category_data(categories)
+def add_to_shelf(shelf):
+    """Shared body of the add_* views: add the posted volumeId to one of g.user's lists.
 
-    publisher = data['publisher']
+    Only the volumeId is taken from the form; the book's data comes from volume_record().
+    """
 
-    if Publisher.query.filter(Publisher.publisher == publisher).first() == None:
-        new_publisher = Publisher(publisher=publisher)
-        db.session.add(new_publisher)
-        db.session.commit()
+    if not g.user:
+        flash("Access unauthorized.", 'danger')
+        return redirect('/')
 
-    # Create book data in db
-    volumeId = data['volumeId']
-    title = data['title']
-    subtitle = data['subtitle']
-    thumbnail = data['thumbnail']
+    user = g.user
+    volumeId = request.form.get('volumeId', '')
 
-    publisher = Publisher.query.filter_by(publisher=publisher).first_or_404()
+    if not VOLUME_ID.match(volumeId):
+        flash("Book not found.", 'danger')
+        return redirect('/')
 
-    Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-    new_book = Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
+    book = Book.query.filter_by(volumeId=volumeId).first()
 
-    user = g.user
+    if book is not None:
+        user.add_book_to_shelf(shelf, book)
+    else:
+        try:
+            data = book_data_from_volume(volume_record(volumeId))
+        except Exception:
+            app.logger.warning('Could not load volume %s', volumeId, exc_info=True)
+            flash("Could not add the book, please try again later.", 'danger')
+            return redirect('/')
+
+        user.add_to_shelf(shelf, **data)
 
-    # Add the relationship between book id and and user id to db
-    user.want_to_read.append(new_book)
-    db.session.commit()
-    
     flash('Added to the list!', 'success')
 
-    return redirect(f'/users/{user.id}/want_to_read')
+    return redirect(f'/users/{user.id}/{shelf}')
 
 
-@app.route('/users/<int:user_id>/want_to_read/<int:book_id>/delete', methods=['POST'])
-def remove_want_to_read(user_id, book_id):
-    """Remove the book from want_to_read list."""
+def remove_from_shelf(user_id, book_id, shelf):
+    """Take a book off one of the user's lists; 404 if it isn't on it."""
 
     user = User.query.get_or_404(user_id)
-    book = Book.query.get_or_404(book_id)
-    user.want_to_read.remove(book)
-    db.session.commit()
 
-    return redirect(f'/users/{user.id}/want_to_read')
+    if not user.remove_from_shelf(shelf, book_id):
+        abort(404)
 
+    # user_id rather than user.id, which the commit expired
+    return redirect(f'/users/{user_id}/{shelf}')
 
-@app.route('/users/<int:user_id>/add_currently_reading', methods=['POST'])
-def add_currently_reading(user_id):
-    """Add book to currently_reading list."""
-
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
 
-    data = {}
-    for key, value in request.form.items():
-        data[key] = value
-    
-    # Create author data in db
-    if len(data['author']) == 0 or 'author' not in data:
-        authors = ['N/A']
-    else:
-        authors = ast.literal_eval(data['author'])
-
-    Author.create_author_data(authors)
+@app.route('/users/<int:user_id>/add_want_to_read', methods=['POST'])
+def add_want_to_read(user_id):
+    """Add book to want_to_read list."""
 
-    # Create category data in db
-    if len(data['category']) == 0:
-        categories = ['N/A']
-    else:
-        categories = ast.literal_eval(data['category'])
-    
-    Category.create_category_data(categories)
-
-    publisher = data['publisher']
-    if not Publisher.query.filter(Publisher.publisher == publisher).first():
-        new_publisher = Publisher(publisher=publisher)
-        db.session.add(new_publisher)
-        db.session.commit()
+    return add_to_shelf('want_to_read')
 
-    # Create book data in db
-    volumeId = data['volumeId']
-    title = data['title']
-    subtitle = data['subtitle']
-    thumbnail = data['thumbnail']
 
-    publisher = Publisher.query.filter_by(publisher=publisher).first()
+@app.route('/users/<int:user_id>/want_to_read/<int:book_id>/delete', methods=['POST'])
+def remove_want_to_read(user_id, book_id):
+    """Remove the book from want_to_read list."""
 
-    Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-    new_book = Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
+    return remove_from_shelf(user_id, book_id, 'want_to_read')
 
-    user = g.user
 
-    # Add the relationship between book id and and user id to db
-    user.currently_reading.append(new_book)
-    db.session.commit()
-    
-    flash('Added to the list!', 'success')
+@app.route('/users/<int:user_id>/add_currently_reading', methods=['POST'])
+def add_currently_reading(user_id):
+    """Add book to currently_reading list."""
 
-    return redirect(f'/users/{user.id}/currently_reading')
+    return add_to_shelf('currently_reading')
 
 
 @app.route('/users/<int:user_id>/currently_reading/<int:book_id>/delete', methods=['POST'])
 def remove_currently_reading(user_id, book_id):
     """Remove the book from currently_reading list."""
 
-    user = User.query.get_or_404(user_id)
-    book = Book.query.get_or_404(book_id)
-    user.currently_reading.remove(book)
-    db.session.commit()
-
-    return redirect(f'/users/{user.id}/currently_reading')
+    return remove_from_shelf(user_id, book_id, 'currently_reading')
 
 
 @app.route('/users/<int:user_id>/add_read', methods=['POST'])
 def add_read(user_id):
     """Add book to read list."""
 
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
-
-    data = {}
-    for key, value in request.form.items():
-        data[key] = value
-    
-    # Create author data in db
-    if len(data['author']) == 0 or 'author' not in data:
-        authors = ['N/A']
-    else:
-        authors = ast.literal_eval(data['author'])
-
-
-    Author.create_author_data(authors)
-
-    # Create category data in db
-    if len(data['category']) == 0:
-        categories = ['N/A']
-    else:
-        categories = ast.literal_eval(data['category'])
-
-    Category.create_category_data(categories)
-
-    publisher = data['publisher']
-    if not Publisher.query.filter(Publisher.publisher == publisher).first():
-        new_publisher = Publisher(publisher=publisher)
-        db.session.add(new_publisher)
-        db.session.commit()
-
-    # Create book data in db
-    volumeId = data['volumeId']
-    title = data['title']
-    subtitle = data['subtitle']
-    thumbnail = data['thumbnail']
-
-
-    publisher = Publisher.query.filter_by(publisher=publisher).first()
-
-    Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-    new_book = Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-
-    user = g.user
-
-    # Add the relationship between book id and and user id to db
-    user.read.append(new_book)
-    db.session.commit()
-    
-    flash('Added to the list!', 'success')
-
-    return redirect(f'/users/{user.id}/read')
+    return add_to_shelf('read')
 
 
 @app.route('/users/<int:user_id>/read/<int:book_id>/delete', methods=['POST'])
 def remove_read(user_id, book_id):
     """Remove the book from read list."""
 
-    user = User.query.get_or_404(user_id)
-    book = Book.query.get_or_404(book_id)
-    user.read.remove(book)
-    db.session.commit()
-
-    return redirect(f'/users/{user.id}/read')
+    return remove_from_shelf(user_id, book_id, 'read')
 
 @app.route('/users/<int:user_id>/add_favorite', methods=['POST'])
 def add_favorite(user_id):
     """Add book to favorite list."""
 
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
-
-    data = {}
-    for key, value in request.form.items():
-        data[key] = value
-    
-    # Create author data in db
-    if len(data['author']) == 0 or 'author' not in data:
-        authors = ['N/A']
-    else:
-        authors = ast.literal_eval(data['author'])
-
-    Author.create_author_data(authors)
-
-    # Create category data in db
-    if len(data['category']) == 0:
-        categories = ['N/A']
-    else:
-        categories = ast.literal_eval(data['category'])
-
-    Category.create_category_data(categories)
-
-    publisher = data['publisher']
-    if not Publisher.query.filter(Publisher.publisher == publisher).first():
-        new_publisher = Publisher(publisher=publisher)
-        db.session.add(new_publisher)
-        db.session.commit()
-
-    # Create book data in db
-    volumeId = data['volumeId']
-    title = data['title']
-    subtitle = data['subtitle']
-    thumbnail = data['thumbnail']
-
-    publisher = Publisher.query.filter_by(publisher=publisher).first()
-
-    Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-    new_book = Book.create_book_data(volumeId, title, subtitle, thumbnail, authors, categories, publisher)
-
-    user = g.user
-
-    # Add the relationship between book id and and user id to db
-    user.favorite.append(new_book)
-    db.session.commit()
-    
-    flash('Added to the list!', 'success')
-
-    return redirect(f'/users/{user.id}/favorite')
+    return add_to_shelf('favorite')
 
 
 @app.route('/users/<int:user_id>/favorite/<int:book_id>/delete', methods=['POST'])
 def remove_favorite(user_id, book_id):
     """Remove the book from favorite list."""
 
-    user = User.query.get_or_404(user_id)
-    book = Book.query.get_or_404(book_id)
-    user.favorite.remove(book)
-    db.session.commit()
-
-    return redirect(f'/users/{user.id}/favorite')
+    return remove_from_shelf(user_id, book_id, 'favorite')
 
 
 
@@ -443,11 +610,13 @@ def remove_favorite(user_id, book_id):
 ##########################################################
 
 @app.route('/users/<int:user_id>')
+@conditional(public_max_age=60)
 def users_show(user_id):
     """Show user page."""
     user = User.query.get_or_404(user_id)
+    previews = user.shelf_previews()
 
-    return render_template('users/show.html', user=user)
+    return render_template('users/show.html', user=user, previews=previews)
 
 
 @app.route('/users/<int:user_id>/edit', methods=['GET', 'POST'])
@@ -471,6 +640,11 @@ def users_edit(user_id):
             user.bio = form.bio.data
             db.session.commit()
 
+            # the navbar shows the new username and image straight away
+            principal_cache.delete(user.id)
+            if session.get(CURR_USER_KEY) == user.id:
+                session[CURR_PRINCIPAL_KEY] = user.principal()
+
             flash('User profile has been edited!', 'success')
             return redirect(f'/users/{user.id}')
 
@@ -483,59 +657,150 @@ def users_edit(user_id):
 
 
 
-@app.route('/users/<int:user_id>/want_to_read')
-def show_want_to_read(user_id):
-    """Show user's want_to_read list."""
+@app.route('/users/<int:user_id>/import', methods=['GET', 'POST'])
+def import_library(user_id):
+    """Upload a Goodreads-style CSV export to add its books to the user's lists."""
 
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
         return redirect('/')
-    
+
     user = User.query.get_or_404(user_id)
+    form = LibraryImportForm()
 
-    return render_template('users/lists/list_want_to_read.html', user=user)
+    if form.validate_on_submit():
+        upload = form.file.data
+        lines = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
 
+        try:
+            record = library_import.queue_import(user.id, lines, upload.filename, app.config['IMPORT_BATCH_SIZE'])
+        # UnicodeDecodeError is a ValueError; queue_import has already deleted what it stored
+        except (ValueError, csv.Error) as e:
+            flash(f"Could not read the file: {e}", 'danger')
+            return redirect(f'/users/{user.id}/import')
 
+        flash(f'Importing {record.rows_total} books, this may take a few minutes.', 'success')
+        return redirect(f'/users/{user.id}/import')
 
-@app.route('/users/<int:user_id>/currently_reading')
-def show_currently_reading(user_id):
-    """Show user's currently_reading list."""
+    imports = LibraryImport.query.filter_by(user_id=user.id).order_by(LibraryImport.id.desc()).limit(5).all()
+
+    return render_template('users/import.html', form=form, user=user, imports=imports)
+
+
+@app.route('/api/users/<int:user_id>/imports/<int:import_id>')
+def import_progress(user_id, import_id):
+    """Progress of one of the user's imports as JSON."""
+
+    if not g.user or g.user.id != user_id:
+        return jsonify(error='Access unauthorized.'), 401
+
+    record = LibraryImport.query.filter_by(id=import_id, user_id=user_id).first_or_404()
+
+    return jsonify(record.serialize())
+
+
+@app.cli.command('import-library')
+@click.argument('user_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=None, type=int, help='Rows per transaction (default IMPORT_BATCH_SIZE).')
+def import_library_command(user_id, path, batch_size):
+    """Add the books in a Goodreads-style CSV export to a user's lists."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        raise click.ClickException(f'No user #{user_id}')
+
+    def progress(record):
+        click.echo(f'{record.rows_done} rows: {record.added} added, {record.not_found} not found')
+
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        try:
+            record = library_import.run_import(user.id, f, os.path.basename(path), books_api,
+                                               batch_size or app.config['IMPORT_BATCH_SIZE'], progress)
+        # run_import has already marked the import finished with the rows it got to
+        except (ValueError, csv.Error, RuntimeError) as e:
+            raise click.ClickException(f'Import stopped: {e}')
+
+    for title in record.unmatched:
+        click.echo(f'Not found: {title}')
+    click.echo(f'Done: {record.added} of {record.rows_total} books added.')
+
+
+def show_shelf(user_id, shelf):
+    """Render one page of a user's list."""
 
     if not g.user:
         flash("Access unauthorized.", 'danger')
         return redirect('/')
-    
+
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/lists/list_currently_reading.html', user=user)
+    try:
+        entries, next_cursor = user.shelf_page(shelf, app.config['SHELF_PAGE_SIZE'], request.args.get('after'))
+    except ValueError:
+        # a mangled ?after= cursor: start from the top of the list
+        return redirect(f'/users/{user.id}/{shelf}')
+
+    books = [entry.book for entry in entries]
+
+    context = {'user': user, 'books': books, 'next_cursor': next_cursor}
+
+    if shelf == 'favorite':
+        context['reviews'] = user.reviews_for_books([book.id for book in books])
+
+    return render_template(f'users/lists/list_{shelf}.html', **context)
+
+
+@app.route('/users/<int:user_id>/want_to_read')
+def show_want_to_read(user_id):
+    """Show user's want_to_read list."""
 
+    return show_shelf(user_id, 'want_to_read')
+
+
+@app.route('/users/<int:user_id>/currently_reading')
+def show_currently_reading(user_id):
+    """Show user's currently_reading list."""
+
+    return show_shelf(user_id, 'currently_reading')
 
 
 @app.route('/users/<int:user_id>/read')
 def show_read(user_id):
     """Show user's read list."""
 
-    if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
-    
-    user = User.query.get_or_404(user_id)
-
-    return render_template('users/lists/list_read.html', user=user)
-
+    return show_shelf(user_id, 'read')
 
 
 @app.route('/users/<int:user_id>/favorite')
 def show_favorite(user_id):
     """Show user's favorite list."""
 
+    return show_shelf(user_id, 'favorite')
+
+
+@app.route('/api/users/<int:user_id>/shelves/<shelf>')
+def shelf_json(user_id, shelf):
+    """One page of a user's list as JSON: {"books": [...], "next": cursor or null}."""
+
     if not g.user:
-        flash("Access unauthorized.", 'danger')
-        return redirect('/')
-    
+        return jsonify(error='Access unauthorized.'), 401
+
+    if shelf not in SHELVES:
+        abort(404)
+
     user = User.query.get_or_404(user_id)
+    limit = min(request.args.get('limit', app.config['SHELF_PAGE_SIZE'], type=int), app.config['SHELF_MAX_PAGE_SIZE'])
 
-    return render_template('users/lists/list_favorite.html', user=user)
+    if limit < 1:
+        return jsonify(error='limit must be at least 1.'), 400
+
+    try:
+        entries, next_cursor = user.shelf_page(shelf, limit, request.args.get('after'))
+    except ValueError:
+        return jsonify(error='Invalid cursor.'), 400
+
+    return jsonify(books=[entry.serialize() for entry in entries], next=next_cursor)
 
 
 
@@ -552,8 +817,9 @@ def show_reviews(user_id):
         return redirect('/')
 
     user = User.query.get_or_404(user_id)
-    
-    return render_template('users/lists/list_review.html', user=user)
+    reviews = user.reviews_with_books()
+
+    return render_template('users/lists/list_review.html', user=user, reviews=reviews)
 
 
 @app.route('/users/<int:user_id>/reviews/<int:review_id>/delete', methods=['POST'])
@@ -568,6 +834,8 @@ def delete_review(user_id, review_id):
     review = Review.query.get_or_404(review_id)
 
     db.session.delete(review)
+    Book.count_rating(review.book_id, removed=review.rating)
+    search_index.reindex_later(review.book_id)
     db.session.commit()
 
     return redirect(f'/users/{user_id}/reviews')
@@ -587,11 +855,14 @@ def update_review(user_id, review_id):
 
     if form.validate_on_submit():
 
+        Book.count_rating(review.book_id, added=form.rating.data, removed=review.rating)
+
         review.rating = form.rating.data
         review.review = form.review.data
         review.user_id = user.id
         review.book_id = review.book.id
 
+        search_index.reindex_later(review.book_id)
         db.session.commit()
 
         review.update_time()
@@ -608,15 +879,30 @@ def update_review(user_id, review_id):
 ##########################################################
 
 @app.route('/books/<volumeId>', methods=['GET', 'POST'])
+@conditional(public_max_age=5 * 60)
 def show_book(volumeId, rating=None, half=None):
     """Show book detail page with review form if the user already has the book in their list."""
 
     user = g.user
     form = BookReviewForm()
 
+    # we're just checking if the book exist or not, so we don't want 404 error here.
+    book = Book.query.filter_by(volumeId=volumeId).first()
+
+    if request.method == 'POST' and form.validate_on_submit():
+
+        rating = form.rating.data
+        review = form.review.data
+
+        new_review = Review(rating=rating, review=review, user_id=user.id, book_id=book.id)
+        db.session.add(new_review)
+        Book.count_rating(book.id, added=rating)
+        search_index.reindex_later(book.id)
+        db.session.commit()
+
+        return redirect (f'/books/{volumeId}')
 
-    res = requests.get(f'{url}/volumes/{volumeId}', params={'key': GOOGLE_BOOKS_API_KEY} )
-    result = res.json()
+    result = get_volume_detail(volumeId).to_result()
 
     # Checking if the description data is included in the API response
     if 'description' in result['volumeInfo']:
@@ -635,33 +921,113 @@ def show_book(volumeId, rating=None, half=None):
             rating = int(i) 
             half = f
 
+    # if the book is not in the db, do not show the review form
+    if book == None:
+            return render_template('book.html', result=result, user=user, desc=desc, rating=rating, half=half)
+
+    try:
+        reviews, next_cursor = book.review_page(app.config['REVIEW_PAGE_SIZE'], request.args.get('after'))
+    except ValueError:
+        abort(404)
+
+    # if the book is in any of the lists for the user, show review form
+    if user.is_book_in_list(book.id):
+        return render_template('book.html', result=result, user=user, desc=desc, form=form, book=book, rating=rating, half=half, reviews=reviews, next_cursor=next_cursor)
+
+    #If the book is in the db but not in user's list
+    else:
+        return render_template('book.html', result=result, user=user, desc=desc, book=book, rating=rating, half=half, reviews=reviews, next_cursor=next_cursor)
+
+
+@app.route('/api/books/<volumeId>/reviews')
+@conditional(public_max_age=5 * 60)
+def book_reviews_json(volumeId):
+    """One page of a book's reviews as JSON: {"reviews": [...], "next": cursor or null}.
+
+    Public, like the book page the reviews are shown on.
+    """
+
+    book = Book.query.filter_by(volumeId=volumeId).first_or_404()
+    limit = min(request.args.get('limit', app.config['REVIEW_PAGE_SIZE'], type=int), app.config['REVIEW_MAX_PAGE_SIZE'])
+
+    if limit < 1:
+        return jsonify(error='limit must be at least 1.'), 400
+
+    try:
+        reviews, next_cursor = book.review_page(limit, request.args.get('after'))
+    except ValueError:
+        return jsonify(error='Invalid cursor.'), 400
+
+    return jsonify(reviews=[review.serialize() for review in reviews], next=next_cursor)
+
+
+@app.cli.command('reconcile-ratings')
+@click.option('--batch-size', default=1000, help='Books to fix per transaction.')
+def reconcile_ratings(batch_size):
+    """Rebuild every book's review count and rating columns from the reviews table."""
+
+    fixed = Book.reconcile_ratings(batch_size)
+    click.echo(f'{fixed} books had out of date ratings.')
+
+
+def cover_source(volumeId):
+    """URL to fetch a volume's cover from: the stored thumbnail, else Google's own cover URL.
+
+    Returns None for books saved without a cover.
+    """
 
-        
-    # we're just checking if the book exist or not, so we don't want 404 error here.
     book = Book.query.filter_by(volumeId=volumeId).first()
+    if book is not None and book.thumbnail:
+        if is_allowed_url(book.thumbnail):
+            return book.thumbnail
+        if not book.thumbnail.startswith('http'):
+            # the static cover-not-available image
+            return None
 
-    if request.method == 'POST' and form.validate_on_submit():
+    detail = VolumeDetail.query.get(volumeId)
+    if detail is not None and detail.image_links and is_allowed_url(detail.image_links.get('thumbnail')):
+        return detail.image_links['thumbnail']
 
-        rating = form.rating.data
-        review = form.review.data
+    return google_cover_url(volumeId)
 
-        new_review = Review(rating=rating, review=review, user_id=user.id, book_id=book.id)
-        db.session.add(new_review)
-        db.session.commit()
 
-        return redirect (f'/books/{volumeId}')
+@app.route('/covers/<volumeId>')
+def show_cover(volumeId):
+    """Serve a book's cover at 150x200 from the local cover cache."""
 
-    # if the book is not in the db, do not show the review form
-    if book == None:
-            return render_template('book.html', result=result, user=user, desc=desc, rating=rating, half=half)
+    if not VOLUME_ID.match(volumeId):
+        abort(404)
 
-    # if the book is in any of the lists for the user, show review form
-    elif user.is_book_in_list(book.id):
-        return render_template('book.html', result=result, user=user, desc=desc, form=form, book=book, rating=rating, half=half)
+    try:
+        cover = cover_cache.get_or_fetch(volumeId, lambda: cover_source(volumeId))
+    except Exception:
+        app.logger.warning('Could not fetch the cover of %s', volumeId, exc_info=True)
+        cover = None
+
+    if cover is None:
+        return redirect(asset_url('images/cover-not-available.png'))
+
+    # the file sent for a volume only changes if Google changes its cover
+    path, digest = cover
+    response = send_file(path, mimetype='image/jpeg', etag=digest, max_age=app.config['COVER_MAX_AGE'])
+    response.cache_control.public = True
+    return response
+
+
+@app.route('/metrics/google_books')
+@token_required
+def google_books_metrics():
+    """Show request, latency and connection pool stats for the Google Books client."""
+
+    return jsonify(books_api.metrics())
 
-    #If the book is in the db but not in user's list
-    else:
-        return render_template('book.html', result=result, user=user, desc=desc, book=book, rating=rating, half=half)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Handle uploads over MAX_CONTENT_LENGTH."""
+
+    flash(f"The file is too large, the limit is {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'danger')
+    return redirect(request.path)
 
 
 @app.errorhandler(404)
@@ -675,27 +1041,3 @@ def page_not_found(e):
     """Handle exceptions."""
 
     return render_template('404.html', e=e), 500
-
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
-    
-
-    
-
-
-    
-
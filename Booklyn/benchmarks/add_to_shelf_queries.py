@@ -0,0 +1,75 @@
+"""Count SQL statements per add-to-list, before and after the single-call pipeline.
+
+"before" replays what the add_* views used to do (create_book_data twice, then
+append to the list relationship and commit); "after" is User.add_to_shelf.
+
+    DATABASE_URL=postgresql:///booklyn-bench python benchmarks/add_to_shelf_queries.py
+
+Uses an in-memory sqlite database when DATABASE_URL is not set. All tables in
+the target database are dropped and recreated.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app
+from instrumentation import QueryCounter
+from models import db, User, Publisher, Book
+
+
+BOOKS = [
+    ('VKGbb1hg8JAC', 'Blink', 'The Power of Thinking Without Thinking', ['Malcolm Gladwell'], ['Psychology'], 'Back Bay Books'),
+    ('ialrgIT41OAC', 'Outliers', 'The Story of Success', ['Malcolm Gladwell'], ['Psychology'], 'Penguin UK'),
+    ('2ObWDgAAQBAJ', 'Educated', 'A Memoir', ['Tara Westover'], ['Biography & Autobiography'], 'Random House'),
+    ('f_D3DwAAQBAJ', 'The Code Breaker', None, ['Walter Isaacson'], ['Biography & Autobiography', 'Science'], 'Simon and Schuster'),
+]
+
+
+def add_before(user, shelf, volumeId, title, subtitle, authors, categories, publisher):
+    publisher = Publisher.create_publisher_data(publisher)
+    Book.create_book_data(volumeId, title, subtitle, None, authors, categories, publisher)
+    book = Book.create_book_data(volumeId, title, subtitle, None, authors, categories, publisher)
+    getattr(user, shelf).append(book)
+    db.session.commit()
+
+
+def add_after(user, shelf, volumeId, title, subtitle, authors, categories, publisher):
+    user.add_to_shelf(shelf, volumeId, title, subtitle, None, authors, categories, publisher)
+
+
+def run(add, counter):
+    """Add every book to two lists for a fresh user; return statements per add."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    user = User.signup(username='bench', email='bench@example.com', password='password', image_url=None)
+    db.session.commit()
+
+    counter.reset()
+    adds = 0
+    for shelf in ('want_to_read', 'favorite'):
+        for volumeId, title, subtitle, authors, categories, publisher in BOOKS:
+            add(user, shelf, volumeId, title, subtitle, authors, categories, publisher)
+            adds += 1
+
+    return counter.count / adds
+
+
+def main():
+    with app.app_context(), QueryCounter(db.engine) as counter:
+        before = run(add_before, counter)
+        after = run(add_after, counter)
+
+        db.drop_all()
+
+    print(f'statements per add, before: {before:.1f}')
+    print(f'statements per add, after : {after:.1f}')
+
+
+if __name__ == '__main__':
+    main()
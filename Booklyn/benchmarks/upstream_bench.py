@@ -0,0 +1,85 @@
+"""Benchmark Google Books client throughput against a local stub upstream.
+
+Compares one blocking client making calls back to back (what a sync gunicorn
+worker does) with the asyncio client keeping many calls in flight at once.
+
+    python benchmarks/upstream_bench.py --calls 200 --latency 0.1
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google_books import GoogleBooksClient
+
+
+class SlowVolumeHandler(BaseHTTPRequestHandler):
+    """Answers every request with a small volume document after `latency` seconds."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = json.dumps({'id': self.path.rsplit('/', 1)[-1].split('?')[0], 'volumeInfo': {'title': 'Blink'}}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def start_stub(latency):
+    server = StubServer(('127.0.0.1', 0), SlowVolumeHandler)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.1, help='stub upstream latency in seconds')
+    parser.add_argument('--in-flight', type=int, default=100, help='max concurrent calls for the async client')
+    args = parser.parse_args()
+
+    server, base_url = start_stub(args.latency)
+    client = GoogleBooksClient(base_url, 'bench-key')
+    volume_ids = [f'vol{i}' for i in range(args.calls)]
+
+    start = time.perf_counter()
+    for volumeId in volume_ids:
+        client.volume(volumeId).json()
+    sync_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = client.volumes(volume_ids, max_in_flight=args.in_flight)
+    async_elapsed = time.perf_counter() - start
+
+    server.shutdown()
+
+    assert all(results), 'some async calls failed'
+
+    print(f'{args.calls} calls, {args.latency * 1000:.0f} ms upstream latency')
+    print(f'sync, one at a time : {sync_elapsed:6.2f} s  {args.calls / sync_elapsed:8.1f} calls/s')
+    print(f'async, {args.in_flight:3d} in flight: {async_elapsed:6.2f} s  {args.calls / async_elapsed:8.1f} calls/s')
+    print(f'speedup             : {sync_elapsed / async_elapsed:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
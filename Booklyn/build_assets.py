@@ -0,0 +1,166 @@
+"""Build production copies of the files in static/.
+
+    python build_assets.py
+
+Every file is copied to static/dist/ under a name that includes a hash of its
+content (style.css -> style.1a2b3c4d5e6f.css), so it can be cached forever and
+a changed file gets a new URL. Alongside each copy it writes:
+
+- .gz and .br (brotli) variants of text files and fonts,
+- a .webp variant of JPEG and PNG images (at most MAX_IMAGE_WIDTH wide),
+
+whenever the variant is smaller than the original. url() references in CSS are
+rewritten to the fingerprinted files. static/dist/manifest.json maps each
+original path to its build, and asset_url() in templates reads it; without a
+build, asset_url() falls back to the plain files.
+
+Brotli and WebP need the brotli and Pillow packages; without them those
+variants are skipped.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = os.path.join(STATIC, 'dist')
+MANIFEST = os.path.join(DIST, 'manifest.json')
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ttf', '.otf', '.json', '.txt'}
+WEBP_SOURCES = {'.jpg', '.jpeg', '.png'}
+# WebP copies of wider images are scaled down to this; no screen needs more for a background
+MAX_IMAGE_WIDTH = 2560
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def fingerprinted(name, data):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def write(name, data):
+    path = os.path.join(DIST, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def write_if_smaller(name, data, original_size):
+    if len(data) < original_size:
+        write(name, data)
+        return True
+    return False
+
+
+def compressed_variants(name, data):
+    # mtime=0 keeps the .gz output identical between builds of the same file
+    write_if_smaller(f'{name}.gz', gzip.compress(data, compresslevel=9, mtime=0), len(data))
+
+    if brotli is not None:
+        write_if_smaller(f'{name}.br', brotli.compress(data, quality=11), len(data))
+
+
+def webp_variant(name, data):
+    """Write name.webp if it comes out smaller; returns its name or None."""
+
+    if Image is None:
+        return None
+
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width > MAX_IMAGE_WIDTH:
+            image = image.resize((MAX_IMAGE_WIDTH, round(image.height * MAX_IMAGE_WIDTH / image.width)), Image.Resampling.LANCZOS)
+        image.save(out, format='WEBP', quality=80, method=6)
+
+    if write_if_smaller(f'{name}.webp', out.getvalue(), len(data)):
+        return f'{name}.webp'
+    return None
+
+
+def rewrite_css(css_name, css, manifest):
+    """Point url() references to other static files at their fingerprinted copies."""
+
+    def replace(match):
+        quote, url = match.groups()
+
+        if url.startswith('/static/'):
+            source = url[len('/static/'):]
+        elif '://' in url or url.startswith(('data:', '/', '#')):
+            return match.group(0)
+        else:
+            source = os.path.normpath(os.path.join(os.path.dirname(css_name), url)).replace(os.sep, '/')
+
+        entry = manifest.get(source)
+        if entry is None:
+            return match.group(0)
+        return f"url({quote}/static/{entry['file']}{quote})"
+
+    return CSS_URL.sub(replace, css.decode('utf-8')).encode('utf-8')
+
+
+def source_files():
+    for root, dirs, files in os.walk(STATIC):
+        if os.path.abspath(root) == DIST:
+            dirs[:] = []
+            continue
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST]
+
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, STATIC).replace(os.sep, '/'), path
+
+
+def build():
+    shutil.rmtree(DIST, ignore_errors=True)
+    os.makedirs(DIST)
+
+    manifest = {}
+
+    # CSS last, so its url()s can point at the other files' fingerprinted names
+    files = sorted(source_files(), key=lambda item: item[0].endswith('.css'))
+
+    for name, path in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        ext = os.path.splitext(name)[1].lower()
+        if ext == '.css':
+            data = rewrite_css(name, data, manifest)
+
+        built = fingerprinted(name, data)
+        write(built, data)
+
+        if ext in COMPRESSIBLE:
+            compressed_variants(built, data)
+
+        webp = webp_variant(built, data) if ext in WEBP_SOURCES else None
+
+        manifest[name] = {'file': f'dist/{built}', 'webp': f'dist/{webp}' if webp else None}
+        print(f'{name} -> dist/{built}' + (' (+webp)' if webp else ''))
+
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    build()
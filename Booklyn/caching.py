@@ -0,0 +1,185 @@
+"""HTTP caching policy for Booklyn's responses.
+
+- Files under static/ linked with asset_url() carry a content hash, either in
+  the file name (static/dist/, written by build_assets.py) or as ?v=..., and are
+  cached for a year as immutable; a changed file gets a new URL. Built files
+  are served as brotli/gzip or WebP when the browser accepts them.
+- Views decorated with @conditional (book pages, profile pages) get an ETag and
+  answer If-None-Match with 304 Not Modified. They vary on Cookie, so a shared
+  cache never hands an anonymous page to a logged in user. There is no
+  Last-Modified: deleted reviews and list entries leave no timestamp behind,
+  so a page's modification time can't be known.
+- Everything else is private, no-store: list pages, forms and redirects change
+  with every action the user takes.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+from functools import wraps
+
+from flask import current_app, g, request, session, make_response, send_from_directory, url_for
+
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_asset_versions = {}
+
+
+def asset_version(static_folder, filename):
+    """Short content hash of a static file, or None if it doesn't exist.
+
+    Hashes are cached per process and recomputed when the file's mtime changes.
+    """
+
+    path = os.path.join(static_folder, filename)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _asset_versions.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]
+
+    _asset_versions[path] = (mtime, version)
+    return version
+
+
+_manifest = {'mtime': None, 'entries': {}}
+
+
+def asset_manifest(static_folder):
+    """static/dist/manifest.json from build_assets.py ({} before a build), reloaded when it changes."""
+
+    path = os.path.join(static_folder, 'dist', 'manifest.json')
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+
+    if _manifest['mtime'] != mtime:
+        with open(path) as f:
+            _manifest['entries'] = json.load(f)
+        _manifest['mtime'] = mtime
+
+    return _manifest['entries']
+
+
+def is_versioned(filename):
+    """Is this static URL one that changes whenever the file does?"""
+
+    return filename.startswith('dist/') or bool(request.args.get('v'))
+
+
+def send_static_variant(static_folder, filename):
+    """Send the smallest variant of a built file this request accepts, or None to send the file itself."""
+
+    path = os.path.join(static_folder, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    # check the header rather than accept_mimetypes, which would match webp against */*
+    if mimetype.startswith('image/') and 'image/webp' in request.headers.get('Accept', ''):
+        if os.path.exists(f'{path}.webp'):
+            response = send_from_directory(static_folder, f'{filename}.webp', mimetype='image/webp')
+            response.vary.add('Accept')
+            return response
+
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.exists(f'{path}{suffix}'):
+            response = send_from_directory(static_folder, f'{filename}{suffix}', mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+
+    return None
+
+
+def asset_url(filename):
+    """URL of a static file with its content hash, so it can be cached forever."""
+
+    entry = asset_manifest(current_app.static_folder).get(filename)
+    if entry is not None:
+        return url_for('static', filename=entry['file'])
+
+    version = asset_version(current_app.static_folder, filename)
+    if version is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=version)
+
+
+def conditional(public_max_age=0):
+    """Give a GET view's 200 responses an ETag and answer If-None-Match with 304.
+
+    Pages for a logged in user are private and revalidated on every use; anonymous
+    pages may be cached by browsers and shared caches for public_max_age seconds.
+    Both vary on Cookie, since the same URL renders differently once logged in.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = make_response(view(*args, **kwargs))
+
+            if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+                return response
+
+            # a response that sets the session cookie mustn't land in a shared cache
+            if g.get('user') or session.modified:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            else:
+                response.cache_control.public = True
+                response.cache_control.max_age = public_max_age
+
+            response.vary.add('Cookie')
+            response.add_etag()
+            return response.make_conditional(request)
+
+        return wrapper
+
+    return decorator
+
+
+def init_caching(app):
+    """Register asset_url() for templates and apply the caching policy to every response."""
+
+    # Flask's own default is None (no-cache), so setdefault() wouldn't take
+    if app.config.get('SEND_FILE_MAX_AGE_DEFAULT') is None:
+        app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 60 * 60
+
+    app.add_template_global(asset_url)
+
+    serve_static = app.view_functions['static']
+
+    def static(filename):
+        if filename.startswith('dist/'):
+            response = send_static_variant(app.static_folder, filename)
+            if response is not None:
+                return response
+        return serve_static(filename=filename)
+
+    app.view_functions['static'] = static
+
+    @app.after_request
+    def apply_cache_policy(response):
+        if request.endpoint == 'static':
+            # send_file already set ETag/Last-Modified and a max-age for unversioned URLs
+            if is_versioned(request.view_args.get('filename', '')) and response.status_code in (200, 304):
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                response.cache_control.immutable = True
+            return response
+
+        if 'Cache-Control' not in response.headers:
+            response.cache_control.private = True
+            response.cache_control.no_store = True
+
+        return response
@@ -0,0 +1,272 @@
+"""Book covers, fetched once from Google Books and served from local disk.
+
+/covers/<volumeId> resizes each cover to the 150x200 the templates show and
+keeps it in a content-addressed cache directory:
+
+    <directory>/blobs/ab/abcdef....jpg    one file per distinct image
+    <directory>/keys/<volumeId>          the hash of that volume's image
+
+Identical images (e.g. Google's "image not available" placeholder) are stored
+once. A blob's and a key's mtime are bumped whenever they are served. Once the
+blobs add up to more than max_bytes, or there are more than max_keys keys, the
+least recently served ones are deleted. Every worker shares the directory;
+writes go through a temporary file and a rename, so a reader never sees a
+half-written cover.
+
+Downloads only ever go to COVER_HOSTS: redirects are followed by hand, and
+each hop is checked like the original URL.
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+from metrics import UPSTREAM_SECONDS, COVER_LOOKUPS
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+COVER_SIZE = (150, 200)
+
+# cover URLs come from the API or from posted forms; only these hosts are ever fetched
+COVER_HOSTS = ('books.google.com', 'books.googleusercontent.com')
+
+# Google sends some cover URLs on to another of its hosts
+MAX_REDIRECTS = 3
+
+
+def google_cover_url(volumeId):
+    """Google's own front cover URL for a volume, for volumes with no stored thumbnail."""
+
+    return f'https://books.google.com/books/content?id={volumeId}&printsec=frontcover&img=1&zoom=1&source=gbs_api'
+
+
+def is_allowed_url(url, hosts=COVER_HOSTS):
+    parts = urlsplit(url or '')
+    return parts.scheme in ('http', 'https') and parts.hostname in hosts
+
+
+def resize_cover(data, size=COVER_SIZE):
+    """Scale and crop an image to exactly size, as a JPEG. Without Pillow the image is kept as it is."""
+
+    if Image is None:
+        return data
+
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.fit(image.convert('RGB'), size, Image.Resampling.LANCZOS)
+        image.save(out, format='JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+class CoverCache:
+    """Disk cache of cover images keyed by volumeId, bounded to max_bytes."""
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, max_keys=100000, timeout=(3.05, 10), hosts=COVER_HOSTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_keys = max_keys
+        self.timeout = timeout
+        self.hosts = hosts
+
+        self.session = requests.Session()
+
+        # size of the blobs (and number of keys) when last measured, plus what this process has written since
+        self._size = None
+        self._key_count = None
+        self._lock = threading.Lock()
+
+    def _key_path(self, volumeId):
+        return os.path.join(self.directory, 'keys', volumeId)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], f'{digest}.jpg')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def lookup(self, volumeId):
+        """(path, digest) of the cached cover for volumeId, or None."""
+
+        try:
+            with open(self._key_path(volumeId)) as f:
+                digest = f.read().strip()
+        except OSError:
+            return None
+
+        path = self._blob_path(digest)
+        try:
+            # mark both recently used, for eviction
+            os.utime(path)
+            os.utime(self._key_path(volumeId))
+        except OSError:
+            # evicted since the key was written
+            return None
+
+        return path, digest
+
+    def store(self, volumeId, data):
+        """Save a cover for volumeId; returns (path, digest)."""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+
+        if not os.path.exists(path):
+            self._write(path, data)
+            self._grow(len(data))
+
+        key_path = self._key_path(volumeId)
+        new_key = not os.path.exists(key_path)
+        self._write(key_path, digest.encode())
+        if new_key:
+            self._add_key()
+
+        return path, digest
+
+    def download(self, url):
+        """The image at url, resized to COVER_SIZE."""
+
+        for _ in range(MAX_REDIRECTS + 1):
+            if not is_allowed_url(url, self.hosts):
+                raise ValueError(f'Not a Google Books cover URL: {url}')
+
+            start = time.perf_counter()
+            res = None
+            try:
+                res = self.session.get(url, timeout=self.timeout, allow_redirects=False)
+            finally:
+                UPSTREAM_SECONDS.observe(
+                    time.perf_counter() - start, call='cover', outcome='error' if res is None else str(res.status_code))
+
+            if not res.is_redirect:
+                break
+            url = urljoin(url, res.headers['Location'])
+        else:
+            raise ValueError(f'Too many redirects for a cover: {url}')
+
+        res.raise_for_status()
+        if not res.headers.get('Content-Type', '').startswith('image/'):
+            raise ValueError(f'{url} is not an image')
+
+        return resize_cover(res.content)
+
+    def get_or_fetch(self, volumeId, source):
+        """(path, digest) of volumeId's cover, or None if it has none.
+
+        On a miss the cover is downloaded from source(), which returns its URL (or None).
+        """
+
+        cached = self.lookup(volumeId)
+        if cached is not None:
+            COVER_LOOKUPS.inc(result='hit')
+            return cached
+
+        COVER_LOOKUPS.inc(result='miss')
+
+        url = source()
+        if url is None:
+            return None
+
+        try:
+            return self.store(volumeId, self.download(url))
+        except Exception:
+            COVER_LOOKUPS.inc(result='error')
+            raise
+
+    def _files(self, subdirectory):
+        found = []
+        for root, dirs, files in os.walk(os.path.join(self.directory, subdirectory)):
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def blobs(self):
+        """[(mtime, size, path)] of every cached image."""
+
+        return self._files('blobs')
+
+    def keys(self):
+        """[(mtime, size, path)] of every volumeId's key."""
+
+        return self._files('keys')
+
+    def size(self):
+        return sum(size for mtime, size, path in self.blobs())
+
+    def _grow(self, added):
+        with self._lock:
+            if self._size is None:
+                # other workers write here too, so measure rather than trust a running total
+                self._size = self.size()
+            else:
+                self._size += added
+
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+
+    def _add_key(self):
+        with self._lock:
+            if self._key_count is None:
+                self._key_count = len(self.keys())
+            else:
+                self._key_count += 1
+
+            if self._key_count > self.max_keys:
+                self._key_count = self.evict_keys()
+
+    def evict(self):
+        """Delete the least recently served images until the cache is under 90% of max_bytes."""
+
+        blobs = sorted(self.blobs())
+        total = sum(size for mtime, size, path in blobs)
+        target = self.max_bytes * 0.9
+
+        for mtime, size, path in blobs:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        # keys that point at a removed image read as a miss and are rewritten by the next store()
+        return total
+
+    def evict_keys(self):
+        """Delete the least recently served keys until there are no more than 90% of max_keys.
+
+        A deleted key is a miss; its image is kept if other keys still use it.
+        """
+
+        keys = sorted(self.keys())
+        excess = len(keys) - int(self.max_keys * 0.9)
+        removed = 0
+
+        for mtime, size, path in keys[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+
+        return len(keys) - removed
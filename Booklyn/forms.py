@@ -1,5 +1,6 @@
 from ast import Pass
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField, SelectField, RadioField
 from wtforms.validators import InputRequired, Email, Length, AnyOf
 
@@ -34,3 +35,7 @@ class BookReviewForm(FlaskForm):
     rating = SelectField('rating', choices=[('1', '1'), ('2', '2'), ('3','3'), ('4','4'), ('5', '5')], validators=[AnyOf(values=['1', '2', '3', '4', '5'])])
     review = TextAreaField('(optional) review', validators=[Length(max=500)])
 
+class LibraryImportForm(FlaskForm):
+    """Form for uploading a Goodreads-style library export."""
+
+    file = FileField('CSV export', validators=[FileRequired(), FileAllowed(['csv'], 'Upload a .csv file.')])
@@ -0,0 +1,351 @@
+"""Client for the Google Books API shared by every view that talks to it."""
+
+import asyncio
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import UPSTREAM_SECONDS, UPSTREAM_REJECTED
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def call_name(path):
+    """Metric label for an API path: 'search' for /volumes, 'volume' for /volumes/<id>."""
+
+    return 'search' if path == '/volumes' else 'volume'
+
+
+def outcome(res):
+    return f'{res.status_code // 100}xx' if res is not None else 'error'
+
+
+def book_data_from_volume(result):
+    """User.add_to_shelf() arguments for a volume, shaped like the API's volume response."""
+
+    info = result.get('volumeInfo', {})
+
+    return {
+        'volumeId': result['id'],
+        'title': info.get('title', 'N/A'),
+        'subtitle': info.get('subtitle'),
+        'thumbnail': (info.get('imageLinks') or {}).get('thumbnail'),
+        'authors': info.get('authors') or ['N/A'],
+        'categories': info.get('categories') or ['N/A'],
+        'publisher': info.get('publisher') or 'N/A',
+    }
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stop calling the API for a while after too many consecutive failures.
+
+    closed -> open after `failure_threshold` failures in a row,
+    open -> half-open after `reset_timeout` seconds (one trial call is let through),
+    half-open -> closed on success, or back to open on failure.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class GoogleBooksClient:
+    """Pooled, keep-alive HTTP client with timeouts, jittered retries and a circuit breaker."""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, api_key, pool_size=20, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.2, breaker=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        # one session per process: connections (and their TLS sessions) are reused between requests
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'rejected': 0,
+            'in_flight': 0,
+            'latency_sum': 0.0,
+            'latency_max': 0.0,
+        }
+        self._stats_lock = threading.Lock()
+
+    def _record(self, **changes):
+        with self._stats_lock:
+            for stat, value in changes.items():
+                self.stats[stat] += value
+
+    def _sleep_before_retry(self, attempt):
+        """Exponential backoff with full jitter, so workers don't retry in lockstep."""
+
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def get(self, path, params=None, headers=None):
+        """GET base_url + path, retrying connection errors and 429/5xx responses."""
+
+        if not self.breaker.allow():
+            self._record(rejected=1)
+            UPSTREAM_REJECTED.inc()
+            raise UpstreamUnavailable(f'Google Books API circuit is {self.breaker.state}')
+
+        params = {'key': self.api_key, **(params or {})}
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._record(retries=1)
+                self._sleep_before_retry(attempt)
+
+            self._record(requests=1, in_flight=1)
+            start = time.perf_counter()
+            res = None
+
+            try:
+                res = self.session.get(f'{self.base_url}{path}', params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                self._record(errors=1)
+                if attempt == self.max_retries:
+                    self.breaker.record_failure()
+                    raise
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._stats_lock:
+                    self.stats['in_flight'] -= 1
+                    self.stats['latency_sum'] += elapsed
+                    self.stats['latency_max'] = max(self.stats['latency_max'], elapsed)
+                UPSTREAM_SECONDS.observe(elapsed, call=call_name(path), outcome=outcome(res))
+
+            if res.status_code in self.RETRY_STATUSES:
+                self._record(errors=1)
+                if attempt < self.max_retries:
+                    continue
+                self.breaker.record_failure()
+                return res
+
+            self.breaker.record_success()
+            return res
+
+    def search(self, params):
+        """Search volumes and return the decoded response."""
+
+        res = self.get('/volumes', params=params)
+        res.raise_for_status()
+        return res.json()
+
+    def volume(self, volumeId, etag=None):
+        """Fetch one volume; returns the response so callers can handle 304 Not Modified."""
+
+        headers = {'If-None-Match': etag} if etag else None
+        return self.get(f'/volumes/{volumeId}', headers=headers)
+
+    def volumes(self, volume_ids, max_in_flight=50):
+        """Fetch many volumes at once on an asyncio event loop instead of one after another."""
+
+        async def run():
+            async with AsyncGoogleBooksClient(self.base_url, self.api_key, max_in_flight=max_in_flight,
+                                              max_retries=self.max_retries, backoff=self.backoff,
+                                              breaker=self.breaker) as client:
+                return await client.volumes(volume_ids)
+
+        return asyncio.run(run())
+
+    def search_many(self, params_list, max_in_flight=50):
+        """Run many searches at once on an asyncio event loop; failed searches come back as None."""
+
+        async def run():
+            async with AsyncGoogleBooksClient(self.base_url, self.api_key, max_in_flight=max_in_flight,
+                                              max_retries=self.max_retries, backoff=self.backoff,
+                                              breaker=self.breaker) as client:
+                return await client.search_many(params_list)
+
+        return asyncio.run(run())
+
+    def pool_stats(self):
+        """Connection pool usage for the API host."""
+
+        pools = [self.adapter.poolmanager.pools[key] for key in self.adapter.poolmanager.pools.keys()]
+
+        return {
+            'pool_size': self.pool_size,
+            'pools': len(pools),
+            'idle_connections': sum(pool.pool.qsize() for pool in pools),
+            'connections_opened': sum(pool.num_connections for pool in pools),
+            'in_flight': self.stats['in_flight'],
+            'utilisation': self.stats['in_flight'] / self.pool_size,
+        }
+
+    def metrics(self):
+        """Request counters, latency and pool usage in one dict."""
+
+        with self._stats_lock:
+            stats = dict(self.stats)
+
+        stats['latency_avg'] = stats['latency_sum'] / stats['requests'] if stats['requests'] else 0.0
+        stats['circuit'] = self.breaker.state
+        stats.update(self.pool_stats())
+        return stats
+
+
+class AsyncGoogleBooksClient:
+    """asyncio client for fanning many API calls out at once (needs httpx).
+
+    One instance must only be used from the event loop it was first used on;
+    create it inside the coroutine that drives the batch, e.g.
+
+        async with AsyncGoogleBooksClient(url, key) as client:
+            volumes = await client.volumes(volume_ids)
+    """
+
+    RETRY_STATUSES = GoogleBooksClient.RETRY_STATUSES
+
+    def __init__(self, base_url, api_key, max_in_flight=100, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.2, breaker=None):
+        if httpx is None:
+            raise RuntimeError('AsyncGoogleBooksClient needs httpx: pip install httpx')
+
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def get(self, path, params=None, headers=None):
+        """GET base_url + path with the same retry and circuit breaker rules as GoogleBooksClient."""
+
+        if not self.breaker.allow():
+            UPSTREAM_REJECTED.inc()
+            raise UpstreamUnavailable(f'Google Books API circuit is {self.breaker.state}')
+
+        params = {'key': self.api_key, **(params or {})}
+
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+                start = time.perf_counter()
+                res = None
+
+                try:
+                    res = await self.client.get(path, params=params, headers=headers)
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        self.breaker.record_failure()
+                        raise
+                    continue
+                finally:
+                    UPSTREAM_SECONDS.observe(time.perf_counter() - start, call=call_name(path), outcome=outcome(res))
+
+                if res.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                    continue
+
+                if res.status_code in self.RETRY_STATUSES:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return res
+
+    async def search(self, params):
+        res = await self.get('/volumes', params=params)
+        res.raise_for_status()
+        return res.json()
+
+    async def volume(self, volumeId, etag=None):
+        headers = {'If-None-Match': etag} if etag else None
+        return await self.get(f'/volumes/{volumeId}', headers=headers)
+
+    async def volumes(self, volume_ids):
+        """Fetch many volumes concurrently; failed lookups come back as None."""
+
+        async def fetch(volumeId):
+            try:
+                res = await self.volume(volumeId)
+                res.raise_for_status()
+                return res.json()
+            except (httpx.HTTPError, UpstreamUnavailable):
+                return None
+
+        return await asyncio.gather(*(fetch(volumeId) for volumeId in volume_ids))
+
+    async def search_many(self, params_list):
+        """Run many searches concurrently; failed searches come back as None."""
+
+        async def fetch(params):
+            try:
+                return await self.search(params)
+            except (httpx.HTTPError, UpstreamUnavailable):
+                return None
+
+        return await asyncio.gather(*(fetch(params) for params in params_list))
@@ -0,0 +1,47 @@
+"""gunicorn settings.
+
+Views spend most of their time waiting on the Google Books API, so workers are
+gevent workers by default: each one multiplexes up to `worker_connections`
+requests on cooperative sockets instead of blocking on one upstream call at a
+time. Set GUNICORN_WORKER_CLASS=sync to go back to plain sync workers.
+"""
+
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while it waits on Postgres."""
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    """Start loading the worker's search suggestion index, so the first typeahead request doesn't."""
+
+    from app import app, suggest_index
+    suggest_index.start(app)
+
+
+def on_starting(server):
+    """Clear metrics snapshots left behind by a previous run."""
+
+    if os.environ.get('METRICS_DIR'):
+        import glob
+        for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """Drop the metrics snapshot of a worker that has exited."""
+
+    if os.environ.get('METRICS_DIR'):
+        from metrics import registry
+        registry.snapshot_dir = os.environ['METRICS_DIR']
+        registry.remove_snapshot(worker.pid)
@@ -0,0 +1,86 @@
+"""Helpers for measuring what a request does to the database."""
+
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter:
+    """Count the SQL statements run on an engine while the block is active.
+
+        with QueryCounter(db.engine) as counter:
+            client.get('/users/1')
+        assert counter.count <= 6
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+    def reset(self):
+        self.count = 0
+        self.statements = []
+
+
+def init_query_stats(app):
+    """Count SQL statements and database time for every request.
+
+    Each response gets an X-DB-Queries header and a Server-Timing "db" entry
+    (visible in the browser's network panel). Statements slower than
+    app.config['SLOW_QUERY_MS'] are logged with the route that ran them.
+    """
+
+    app.config.setdefault('SLOW_QUERY_MS', 200)
+    app.config.setdefault('DB_TIMING_HEADERS', True)
+
+    @app.before_request
+    def reset_query_stats():
+        g.db_queries = 0
+        g.db_time_ms = 0.0
+
+    # listen on the Engine class so the hooks cover whichever engine Flask-SQLAlchemy creates
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+
+        if not has_request_context():
+            return
+
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_time_ms = g.get('db_time_ms', 0.0) + elapsed_ms
+
+        if elapsed_ms >= app.config['SLOW_QUERY_MS']:
+            app.logger.warning('Slow query (%.1f ms) on %s %s: %s', elapsed_ms, request.method, request.path, statement)
+
+    @event.listens_for(Engine, 'handle_error')
+    def drop_timer(context):
+        # the statement failed, so after_cursor_execute won't run for it
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    @app.after_request
+    def add_query_headers(response):
+        if app.config['DB_TIMING_HEADERS']:
+            queries = g.get('db_queries', 0)
+            response.headers['X-DB-Queries'] = str(queries)
+            response.headers.add('Server-Timing', f'db;dur={g.get("db_time_ms", 0.0):.1f};desc="{queries} queries"')
+        return response
@@ -0,0 +1,138 @@
+"""Background jobs, queued in the jobs table of the app's own database.
+
+Views queue work with Job.enqueue() in the same transaction as the rows it is
+about, and it runs outside the request in one of two places:
+
+- a worker process (the `worker` entry in the Procfile):
+
+      python jobs.py
+
+  polls the table and runs due jobs, up to `batch_size` of a kind at once so
+  upstream calls can be batched. Failed jobs are retried with exponential
+  backoff and marked failed after JOB_MAX_ATTEMPTS.
+
+- the web worker that queued them, right after the response has been sent
+  (JOBS_RUN_AFTER_RESPONSE, on by default), so a deployment without a worker
+  process still gets its jobs done. Kinds registered with after_response=False
+  (long ones, like importing a CSV file) are left to the worker process, so
+  they don't tie up a web worker.
+
+A job is claimed by one process at a time, but it can run twice if a process
+dies half way through, so handlers must be idempotent.
+"""
+
+import os
+import time
+
+from models import db, Job
+
+
+HANDLERS = {}
+
+# kinds only the worker process runs
+WORKER_ONLY = set()
+
+
+def handler(kind, batch_size=1, after_response=True):
+    """Register func(jobs) as the handler of a kind of job.
+
+    It gets a list of up to batch_size claimed jobs and may return
+    {job.id: error} for the ones that failed; raising fails them all.
+    """
+
+    def decorator(func):
+        HANDLERS[kind] = (func, batch_size)
+        if not after_response:
+            WORKER_ONLY.add(kind)
+        return func
+
+    return decorator
+
+
+def run(app, jobs):
+    """Run claimed jobs with their handlers, then delete the finished ones and reschedule the rest."""
+
+    by_kind = {}
+    for job in jobs:
+        by_kind.setdefault(job.kind, []).append(job)
+
+    for kind, batch in by_kind.items():
+        func = HANDLERS.get(kind, (None, 1))[0]
+
+        try:
+            if func is None:
+                raise LookupError(f'No handler for {kind} jobs')
+            errors = func(batch) or {}
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning('%s jobs failed', kind, exc_info=True)
+            errors = {job.id: repr(e) for job in batch}
+
+        for job in batch:
+            if job.id in errors:
+                job.retry_or_fail(errors[job.id], app.config['JOB_MAX_ATTEMPTS'], app.config['JOB_RETRY_SECONDS'])
+            else:
+                db.session.delete(job)
+
+        db.session.commit()
+
+
+def run_enqueued(app, ids):
+    """Run the jobs with these ids, unless a worker process got to them first or they are WORKER_ONLY."""
+
+    kinds = [kind for kind in HANDLERS if kind not in WORKER_ONLY]
+
+    try:
+        with app.app_context():
+            run(app, Job.claim(kinds=kinds, ids=ids, limit=len(ids), timeout=app.config['JOB_TIMEOUT']))
+    except Exception:
+        app.logger.exception('Could not run jobs %s', ids)
+
+
+def work(app, once=False):
+    """Run due jobs until stopped (or, with once=True, until none are due)."""
+
+    with app.app_context():
+        while True:
+            claimed = 0
+
+            for kind, (func, batch_size) in HANDLERS.items():
+                jobs = Job.claim(kinds=[kind], limit=batch_size, timeout=app.config['JOB_TIMEOUT'])
+                claimed += len(jobs)
+                run(app, jobs)
+
+            # end the transaction, so the next poll sees jobs committed since
+            db.session.remove()
+
+            if not claimed:
+                if once:
+                    return
+                time.sleep(app.config['JOB_POLL_SECONDS'])
+
+
+def init_jobs(app):
+    """Settings for the job runners, and running a request's jobs after its response."""
+
+    app.config.setdefault('JOBS_RUN_AFTER_RESPONSE', os.environ.get('JOBS_RUN_AFTER_RESPONSE', 'true').lower() == 'true')
+    app.config.setdefault('JOB_MAX_ATTEMPTS', int(os.environ.get('JOB_MAX_ATTEMPTS', 5)))
+    app.config.setdefault('JOB_RETRY_SECONDS', int(os.environ.get('JOB_RETRY_SECONDS', 30)))
+    app.config.setdefault('JOB_TIMEOUT', int(os.environ.get('JOB_TIMEOUT', 10 * 60)))
+    app.config.setdefault('JOB_POLL_SECONDS', float(os.environ.get('JOB_POLL_SECONDS', 1)))
+
+    @app.after_request
+    def run_jobs_after_response(response):
+        ids = db.session.info.pop('enqueued_jobs', None)
+
+        if ids and app.config['JOBS_RUN_AFTER_RESPONSE']:
+            response.call_on_close(lambda: run_enqueued(app, ids))
+
+        return response
+
+
+if __name__ == '__main__':
+    from app import app
+
+    # app.py registers its handlers on the imported jobs module, not on this __main__ one
+    import jobs
+
+    jobs.work(app)
@@ -0,0 +1,342 @@
+"""Import a user's library from a Goodreads-style CSV export.
+
+    flask import-library <user_id> goodreads_library_export.csv
+
+or upload the file at /users/<id>/import. The file is read one row at a time
+and handled IMPORT_BATCH_SIZE rows at a time, each chunk in one transaction:
+
+1. rows whose title and first author match a stored book (Book.identity_key)
+   use that book;
+2. the rest are searched for on the API all at once, by ISBN when the row has
+   one and by title and author otherwise (GoogleBooksClient.search_many);
+3. the books found, their publishers, authors and categories, and the user's
+   list entries and ratings are written with a few multi-row INSERTs.
+
+The command imports one chunk after another and prints its progress. The
+upload (at most MAX_CONTENT_LENGTH bytes) is read once and its parsed rows are
+stored in library_import_rows a chunk per transaction; once the whole file has
+been read, an import_rows job is queued per chunk. The jobs carry only the
+positions of their rows and are run by the `python jobs.py` worker (never by the
+web worker after the response; see jobs.py), so the request only reads the file. Either way the progress is kept in a
+LibraryImport row, served at /api/users/<id>/imports/<import_id>.
+
+Only rows the API finds are imported; re-importing a file only adds what is
+missing, so a chunk that failed half way can simply run again.
+"""
+
+import csv
+import re
+from datetime import datetime
+
+from google_books import book_data_from_volume
+from models import (db, Author, Book, BookAuthor, BookCategory, Category, Job, LibraryImport, LibraryImportRow, Publisher,
+                    Review, ShelfEntry, insert_or_ignore)
+import search_index
+
+
+# Goodreads' "Exclusive Shelf" column
+SHELF_NAMES = {
+    'read': 'read',
+    'currently-reading': 'currently_reading',
+    'to-read': 'want_to_read',
+}
+
+# shelves in the "Bookshelves" column that mean favorite
+FAVORITE_SHELVES = {'favorite', 'favorites', 'favourite', 'favourites'}
+
+DATE_FORMATS = ('%Y/%m/%d', '%Y-%m-%d')
+
+# "The Fellowship of the Ring (The Lord of the Rings, #1)": the series isn't part of the title
+SERIES = re.compile(r'\s*\([^()]*#\s*[\d.]+\)\s*$')
+
+
+def clean_isbn(value):
+    """An ISBN without Goodreads' ="..." quoting and dashes, or None."""
+
+    isbn = re.sub(r'[^0-9Xx]', '', value or '').upper()
+    return isbn if len(isbn) in (10, 13) else None
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime((value or '').strip(), date_format).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_row(row):
+    """The parts of a CSV row the import uses, or None for a row without a title."""
+
+    title = SERIES.sub('', (row.get('Title') or '').strip())
+    if not title:
+        return None
+
+    try:
+        rating = int(row.get('My Rating') or 0)
+    except ValueError:
+        rating = 0
+
+    shelves = [SHELF_NAMES.get((row.get('Exclusive Shelf') or '').strip(), 'read' if rating else 'want_to_read')]
+
+    bookshelves = {shelf.strip().lower() for shelf in (row.get('Bookshelves') or '').split(',')}
+    if bookshelves & FAVORITE_SHELVES:
+        shelves.append('favorite')
+
+    return {
+        'title': title,
+        'author': (row.get('Author') or '').strip(),
+        'isbn': clean_isbn(row.get('ISBN13')) or clean_isbn(row.get('ISBN')),
+        'shelves': shelves,
+        'rating': rating if 1 <= rating <= 5 else None,
+        'review': (row.get('My Review') or '').strip() or None,
+        'date_added': parse_date(row.get('Date Added')),
+    }
+
+
+def read_rows(lines):
+    """Parsed rows of a CSV file (any iterable of lines), one at a time.
+
+    Raises ValueError if the file has no Title column.
+    """
+
+    reader = csv.DictReader(lines)
+
+    # checked here rather than in the generator, so a wrong file fails before anything is written
+    if not reader.fieldnames or 'Title' not in reader.fieldnames:
+        raise ValueError('The file has no Title column')
+
+    return (parsed for parsed in map(parse_row, reader) if parsed is not None)
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def search_params(row):
+    if row['isbn']:
+        q = f"isbn:{row['isbn']}"
+    else:
+        q = f"intitle:{row['title']}" + (f" inauthor:{row['author']}" if row['author'] else '')
+
+    return {'q': q, 'maxResults': 1, 'printType': 'books'}
+
+
+def stored_books(volume_ids, identity_keys):
+    """({volumeId: book id}, {identity_key: book id}) of the stored books matching either."""
+
+    rows = db.session.query(Book.id, Book.volumeId, Book.identity_key) \
+        .filter(db.or_(Book.volumeId.in_(volume_ids), Book.identity_key.in_(identity_keys))).all()
+
+    return {row.volumeId: row.id for row in rows}, {row.identity_key: row.id for row in rows if row.identity_key}
+
+
+def add_books(volumes):
+    """Store the books of these volumes that aren't stored yet, with their authors and categories.
+
+    volumes are book_data_from_volume() dicts. Returns ({volumeId: book id},
+    ids of the books added). Does not commit.
+    """
+
+    # two rows can find the same volume
+    volumes = list({volume['volumeId']: volume for volume in volumes}.values())
+    for volume in volumes:
+        volume['identity_key'] = Book.identity_key_for(volume['title'], volume['authors'])
+
+    by_volume, by_key = stored_books([v['volumeId'] for v in volumes], [v['identity_key'] for v in volumes])
+    new = [v for v in volumes if v['volumeId'] not in by_volume and v['identity_key'] not in by_key]
+
+    added = []
+    if new:
+        publishers = Publisher.get_or_create_many([v['publisher'] for v in new])
+
+        # rows another transaction (or an earlier row with the same identity) inserted first are skipped
+        insert_or_ignore(Book.__table__, [{
+            'volumeId': v['volumeId'],
+            'title': v['title'],
+            'subtitle': v['subtitle'],
+            'thumbnail': v['thumbnail'] or Book.thumbnail.default.arg,
+            'publisher_id': publishers[v['publisher']],
+            'identity_key': v['identity_key'],
+        } for v in new])
+
+        by_volume, by_key = stored_books([v['volumeId'] for v in volumes], [v['identity_key'] for v in volumes])
+        new = [v for v in new if v['volumeId'] in by_volume]
+        added = [by_volume[v['volumeId']] for v in new]
+
+        authors = Author.get_or_create_many([name for v in new for name in v['authors']])
+        categories = Category.get_or_create_many([name for v in new for name in v['categories']])
+
+        insert_or_ignore(BookAuthor.__table__, [
+            {'book_id': by_volume[v['volumeId']], 'author_id': authors[name]} for v in new for name in v['authors']])
+        insert_or_ignore(BookCategory.__table__, [
+            {'book_id': by_volume[v['volumeId']], 'category_id': categories[name]} for v in new for name in v['categories']])
+
+        for v in new:
+            Job.enqueue('fetch_volume', {'volumeId': v['volumeId']}, key=f"fetch_volume:{v['volumeId']}")
+
+    return {v['volumeId']: by_volume.get(v['volumeId']) or by_key.get(v['identity_key']) for v in volumes}, added
+
+
+def import_rows(user_id, rows, books_api):
+    """Add a chunk of parsed rows to a user's lists; returns (rows added, titles not found). Does not commit.
+
+    Raises RuntimeError if the API could not be searched, so the whole chunk can be retried.
+    """
+
+    keys = [Book.identity_key_for(row['title'], [row['author']] if row['author'] else []) for row in rows]
+    by_key = stored_books([], keys)[1]
+    book_ids = [by_key.get(key) for key in keys]
+
+    missing = [i for i, book_id in enumerate(book_ids) if book_id is None]
+    new_ids = []
+
+    if missing:
+        results = books_api.search_many([search_params(rows[i]) for i in missing])
+
+        failed = sum(result is None for result in results)
+        if failed:
+            raise RuntimeError(f'{failed} of {len(missing)} searches failed')
+
+        found = {i: book_data_from_volume(result['items'][0]) for i, result in zip(missing, results) if result.get('items')}
+        by_volume, new_ids = add_books(list(found.values()))
+
+        for i, volume in found.items():
+            book_ids[i] = by_volume.get(volume['volumeId'])
+
+    now = datetime.utcnow()
+    entries = {}
+    reviews = {}
+    unmatched = []
+
+    for row, book_id in zip(rows, book_ids):
+        if book_id is None:
+            unmatched.append(row['title'])
+            continue
+
+        date_added = datetime.fromisoformat(row['date_added']) if row['date_added'] else now
+        for shelf in row['shelves']:
+            entries[book_id, shelf] = {'user_id': user_id, 'book_id': book_id, 'shelf': shelf, 'date_added': date_added}
+
+        if row['rating']:
+            reviews[book_id] = (row, date_added)
+
+    if entries:
+        insert_or_ignore(ShelfEntry.__table__, list(entries.values()))
+
+    # ratings become reviews, unless the user has already reviewed the book
+    if reviews:
+        reviewed = {row[0] for row in db.session.query(Review.book_id)
+                    .filter(Review.user_id == user_id, Review.book_id.in_(reviews))}
+
+        for book_id, (row, date_added) in reviews.items():
+            if book_id in reviewed:
+                continue
+            db.session.add(Review(rating=row['rating'], review=row['review'], user_id=user_id, book_id=book_id, date_added=date_added))
+            Book.count_rating(book_id, added=row['rating'])
+
+    search_index.reindex(new_ids + list(reviews))
+
+    return len(rows) - len(unmatched), unmatched
+
+
+def import_chunk(import_id, user_id, rows, books_api):
+    """Import a chunk of rows and count it in the import's progress. Does not commit."""
+
+    added, unmatched = import_rows(user_id, rows, books_api)
+    return LibraryImport.record_progress(import_id, len(rows), added, unmatched)
+
+
+def import_stored_chunk(import_id, user_id, start, stop, books_api):
+    """Import an upload's stored rows at positions start to stop - 1, then delete them. Does not commit."""
+
+    rows = LibraryImportRow.chunk(import_id, start, stop)
+    record = import_chunk(import_id, user_id, rows, books_api)
+    LibraryImportRow.remove(import_id, start, stop)
+    return record
+
+
+def queue_import(user_id, lines, filename, batch_size):
+    """Store the rows of a CSV file and queue an import_rows job per batch_size rows; returns the LibraryImport.
+
+    The file is read once, and its rows are committed batch_size at a time. No job
+    is queued until all of it has been read: if it can't be decoded or parsed part
+    way through (ValueError or csv.Error), the import and its rows are deleted and
+    the error raised again.
+    """
+
+    rows = read_rows(lines)
+
+    record = LibraryImport(user_id=user_id, filename=filename)
+    db.session.add(record)
+    db.session.commit()
+    import_id = record.id
+
+    total = 0
+    try:
+        for chunk in chunks(rows, batch_size):
+            LibraryImportRow.store(import_id, total, chunk)
+            db.session.commit()
+            total += len(chunk)
+    except (ValueError, csv.Error):
+        db.session.rollback()
+        LibraryImportRow.remove(import_id)
+        LibraryImport.query.filter_by(id=import_id).delete()
+        db.session.commit()
+        raise
+
+    for start in range(0, total, batch_size):
+        Job.enqueue('import_rows', {'import_id': import_id, 'user_id': user_id, 'start': start, 'stop': start + batch_size})
+
+    record = LibraryImport.finish_reading(import_id, total)
+    db.session.commit()
+    return record
+
+
+def run_import(user_id, lines, filename, books_api, batch_size, progress=None):
+    """Import a CSV file chunk by chunk in this process; returns the LibraryImport.
+
+    Each chunk is committed on its own, and progress(record) is called after it.
+    If a row can't be read (ValueError or csv.Error) or a chunk's searches fail
+    (RuntimeError), the chunk is counted as failed and the import finished with
+    the rows read so far before the error is raised again.
+    """
+
+    rows = read_rows(lines)
+
+    record = LibraryImport(user_id=user_id, filename=filename)
+    db.session.add(record)
+    db.session.commit()
+    import_id = record.id
+
+    total = 0
+    chunk = []
+    try:
+        for chunk in chunks(rows, batch_size):
+            record = import_chunk(import_id, user_id, chunk, books_api)
+            db.session.commit()
+            total += len(chunk)
+            chunk = []
+
+            if progress is not None:
+                progress(record)
+    except (ValueError, csv.Error, RuntimeError):
+        db.session.rollback()
+        if chunk:
+            LibraryImport.record_failure(import_id, len(chunk))
+            total += len(chunk)
+        LibraryImport.finish_reading(import_id, total)
+        db.session.commit()
+        raise
+
+    record = LibraryImport.finish_reading(import_id, total)
+    db.session.commit()
+    return record
@@ -0,0 +1,364 @@
+"""In-process metrics registry with Prometheus text output.
+
+Every gunicorn worker keeps its own counters and histograms in memory; updating
+one is a dict lookup under a lock. When METRICS_DIR is set, each worker also
+writes a snapshot of its metrics to METRICS_DIR/<pid>.json every few seconds,
+and /metrics adds up the snapshots of every live worker, so a scrape sees the
+whole server whichever worker answers it.
+
+/metrics (and the Google Books client's /metrics/google_books) are only served
+when METRICS_TOKEN is set, to requests sending it as a bearer token; Prometheus'
+scrape config takes it as `authorization: {credentials: ...}`.
+
+Ratios are left to the query side, e.g. the search cache hit ratio is
+
+    sum(rate(booklyn_search_cache_lookups_total{result=~"hit|stale"}[5m]))
+      / sum(rate(booklyn_search_cache_lookups_total[5m]))
+"""
+
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import Response, abort, current_app, g, request
+from sqlalchemy.pool import QueuePool
+
+
+# seconds; spans a cached page render up to a slow upstream call with retries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    """Base for a named metric with a fixed set of label names."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def samples(self):
+        """[(suffix, {label: value}, number)] as they appear in the exposition format."""
+
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('', dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value that is set, or read when metrics are collected from a callback returning {label tuple: value}.
+
+    kind='counter' exposes a callback that reads a counter kept elsewhere (e.g. SearchCache.stats).
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None, kind='gauge'):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        collected = self.collect() if self.collect is not None else {}
+
+        with self._lock:
+            for key, value in collected.items():
+                self.values[tuple(str(part) for part in key)] = value
+            return [('', dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        samples = []
+
+        with self._lock:
+            for key, series in self.values.items():
+                labels = dict(zip(self.labels, key))
+
+                # buckets are stored per bound and reported cumulatively
+                running = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    running += count
+                    samples.append(('_bucket', {**labels, 'le': repr(float(bound))}, running))
+                samples.append(('_bucket', {**labels, 'le': '+Inf'}, series['count']))
+                samples.append(('_sum', labels, series['sum']))
+                samples.append(('_count', labels, series['count']))
+
+        return samples
+
+
+class Registry:
+    """The metrics of one process, and the snapshot files shared between workers."""
+
+    def __init__(self):
+        self.metrics = []
+        self.snapshot_dir = None
+        self.flush_interval = 5
+        self.last_flush = 0
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), collect=None, kind='gauge'):
+        return self.register(Gauge(name, help, labels, collect, kind))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """{name: {'kind', 'help', 'samples'}} for this process."""
+
+        snapshot = {}
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                # a broken gauge callback shouldn't take the whole endpoint down
+                samples = []
+            snapshot[metric.name] = {'kind': metric.kind, 'help': metric.help, 'samples': samples}
+        return snapshot
+
+    def snapshot_path(self, pid=None):
+        return os.path.join(self.snapshot_dir, f'{pid or os.getpid()}.json')
+
+    def flush(self, force=False):
+        """Write this worker's snapshot, at most once every flush_interval seconds."""
+
+        if self.snapshot_dir is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+
+        path = self.snapshot_path()
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        # rename is atomic, so readers never see a half-written file
+        os.replace(f'{path}.tmp', path)
+
+    def remove_snapshot(self, pid):
+        """Forget a worker that has exited."""
+
+        if self.snapshot_dir is not None:
+            try:
+                os.remove(self.snapshot_path(pid))
+            except FileNotFoundError:
+                pass
+
+    def collect(self):
+        """Snapshots of every worker (or just this process) added together."""
+
+        if self.snapshot_dir is None:
+            return self.snapshot()
+
+        self.flush(force=True)
+
+        merged = {}
+        for path in glob.glob(os.path.join(self.snapshot_dir, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, {'kind': metric['kind'], 'help': metric['help'], 'totals': {}})
+                for suffix, labels, value in metric['samples']:
+                    key = (suffix, tuple(sorted(labels.items())))
+                    target['totals'][key] = target['totals'].get(key, 0) + value
+
+        return {
+            name: {
+                'kind': metric['kind'],
+                'help': metric['help'],
+                'samples': [(suffix, dict(labels), value) for (suffix, labels), value in metric['totals'].items()],
+            }
+            for name, metric in merged.items()
+        }
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+
+        lines = []
+
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["kind"]}')
+
+            for suffix, labels, value in metric['samples']:
+                if labels:
+                    label_text = ','.join(f'{label}="{escape(value)}"' for label, value in labels.items())
+                    lines.append(f'{name}{suffix}{{{label_text}}} {value}')
+                else:
+                    lines.append(f'{name}{suffix} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'booklyn_request_duration_seconds', 'Time spent handling a request, by Flask endpoint.', ('endpoint', 'method'))
+RESPONSES = registry.counter(
+    'booklyn_responses_total', 'Responses sent, by Flask endpoint and status code.', ('endpoint', 'status'))
+
+UPSTREAM_SECONDS = registry.histogram(
+    'booklyn_upstream_request_duration_seconds', 'Google Books API call latency, one observation per attempt.',
+    ('call', 'outcome'))
+UPSTREAM_REJECTED = registry.counter(
+    'booklyn_upstream_rejected_total', 'Google Books API calls refused because the circuit breaker was open.')
+
+COVER_LOOKUPS = registry.counter(
+    'booklyn_cover_cache_lookups_total', 'Cover image lookups by result (hit, miss, error).', ('result',))
+
+DB_POOL_WAIT_SECONDS = registry.histogram(
+    'booklyn_db_pool_wait_seconds', 'Time spent waiting to check a connection out of the pool.',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+
+def token_required(view):
+    """Serve a metrics view only to requests with the METRICS_TOKEN bearer token, and not at all without one."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get('METRICS_TOKEN')
+        if not token:
+            abort(404)
+
+        sent = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+            return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def init_metrics(app, db, search_cache=None, books_api=None):
+    """Time every request and serve everything at /metrics."""
+
+    registry.snapshot_dir = app.config.get('METRICS_DIR')
+    registry.flush_interval = app.config.get('METRICS_FLUSH_SECONDS', 5)
+    if registry.snapshot_dir:
+        os.makedirs(registry.snapshot_dir, exist_ok=True)
+
+    def pool_stats():
+        pool = db.engine.pool
+        stats = {}
+        for stat in ('size', 'checkedout', 'overflow', 'checkedin'):
+            if hasattr(pool, stat):
+                stats[(stat,)] = getattr(pool, stat)()
+        return stats
+
+    registry.gauge('booklyn_db_pool_connections', 'Database connection pool usage.', ('state',), pool_stats)
+
+    if search_cache is not None:
+        registry.gauge(
+            'booklyn_search_cache_lookups_total', 'Search cache lookups by result (hit, stale, miss) and background refreshes.',
+            ('result',), lambda: {
+                ('hit',): search_cache.stats['hits'],
+                ('stale',): search_cache.stats['stale_hits'],
+                ('miss',): search_cache.stats['misses'],
+                ('refresh',): search_cache.stats['refreshes'],
+                ('error',): search_cache.stats['errors'],
+            }, kind='counter')
+
+    if books_api is not None:
+        registry.gauge(
+            'booklyn_upstream_in_flight', 'Google Books API calls in progress.',
+            collect=lambda: {(): books_api.stats['in_flight']})
+        registry.gauge(
+            'booklyn_upstream_circuit_open', 'Workers whose Google Books circuit breaker is open or half-open.',
+            collect=lambda: {(): 0 if books_api.breaker.state == 'closed' else 1})
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+            RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+
+        try:
+            registry.flush()
+        except OSError:
+            app.logger.exception('Could not write metrics snapshot')
+
+        return response
+
+    @app.route('/metrics')
+    @token_required
+    def metrics():
+        """All metrics in the Prometheus text format."""
+
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,245 @@
+"""Migrations that bring an existing database up to date with models.py without losing data.
+
+seed.py drops and recreates every table; use this on a database that already has
+users and books in it:
+
+    python migrations.py
+
+Each migration runs once, in its own transaction, and is recorded in the
+schema_migrations table.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, Book, ShelfEntry, Job, LibraryImport, LibraryImportRow, SearchCacheEntry, VolumeDetail, SHELVES
+import search_index
+
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register a migration; they run in the order they are defined."""
+
+    MIGRATIONS.append(func)
+    return func
+
+
+def dedupe_names(table, column, link_table=None, link_column=None):
+    """Merge rows of table whose column only differs in case into the row with the lowest id.
+
+    Rows in link_table (a middle table keyed by (book_id, link_column)) are moved
+    over to the surviving row first.
+    """
+
+    keepers = f"""
+        SELECT t.id, (SELECT MIN(k.id) FROM {table} k WHERE lower(k.{column}) = lower(t.{column})) AS keep_id
+        FROM {table} t
+    """
+
+    db.session.execute(text(f"CREATE TEMPORARY TABLE dupes AS SELECT id, keep_id FROM ({keepers}) m WHERE id <> keep_id"))
+
+    if link_table == 'books':
+        db.session.execute(text(f"""
+            UPDATE books SET {link_column} = (SELECT keep_id FROM dupes WHERE dupes.id = books.{link_column})
+            WHERE {link_column} IN (SELECT id FROM dupes)
+        """))
+
+    elif link_table:
+        db.session.execute(text(f"""
+            INSERT INTO {link_table} (book_id, {link_column})
+            SELECT DISTINCT l.book_id, d.keep_id
+            FROM {link_table} l JOIN dupes d ON l.{link_column} = d.id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {link_table} e WHERE e.book_id = l.book_id AND e.{link_column} = d.keep_id
+            )
+        """))
+        db.session.execute(text(f"DELETE FROM {link_table} WHERE {link_column} IN (SELECT id FROM dupes)"))
+
+    db.session.execute(text(f"DELETE FROM {table} WHERE id IN (SELECT id FROM dupes)"))
+    db.session.execute(text("DROP TABLE dupes"))
+
+
+@migration
+def search_cache_table():
+    """Add the search_cache table that shares Google Books search results between workers."""
+
+    SearchCacheEntry.__table__.create(db.session.connection(), checkfirst=True)
+
+
+@migration
+def volume_details_table():
+    """Add the volume_details table that book pages render from."""
+
+    VolumeDetail.__table__.create(db.session.connection(), checkfirst=True)
+
+
+@migration
+def unique_author_category_publisher_names():
+    """Merge case-insensitive duplicates and add unique indexes on lower(name)."""
+
+    dedupe_names('authors', 'author', 'books_authors', 'author_id')
+    dedupe_names('categories', 'category', 'books_categories', 'category_id')
+    dedupe_names('publishers', 'publisher', 'books', 'publisher_id')
+
+    db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_authors_author ON authors (lower(author))"))
+    db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_categories_category ON categories (lower(category))"))
+    db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_publishers_publisher ON publishers (lower(publisher))"))
+
+
+@migration
+def book_identity_key():
+    """Add books.identity_key (normalized title + first author) with a unique index."""
+
+    db.session.execute(text("ALTER TABLE books ADD COLUMN identity_key TEXT"))
+
+    # the first author is the one with the lowest id; if older rows already share
+    # a key, the lowest book id keeps it and the rest are left without one
+    rows = db.session.execute(text("""
+        SELECT b.id, b.title, (
+            SELECT a.author FROM books_authors ba JOIN authors a ON a.id = ba.author_id
+            WHERE ba.book_id = b.id ORDER BY a.id LIMIT 1
+        )
+        FROM books b ORDER BY b.id
+    """)).all()
+
+    seen = set()
+    for book_id, title, author in rows:
+        key = Book.identity_key_for(title, [author] if author else [])
+        if key in seen:
+            continue
+        seen.add(key)
+        db.session.execute(text("UPDATE books SET identity_key = :key WHERE id = :id"), {'key': key, 'id': book_id})
+
+    db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_books_identity_key ON books (identity_key)"))
+
+
+@migration
+def unified_shelf_entries():
+    """Move want_to_read, currently_reading, read and favorite into shelf_entries."""
+
+    ShelfEntry.__table__.create(db.session.connection(), checkfirst=True)
+
+    for shelf in SHELVES:
+        db.session.execute(text(f"""
+            INSERT INTO shelf_entries (user_id, book_id, shelf, date_added)
+            SELECT user_id, book_id, '{shelf}', date_added FROM {shelf}
+        """))
+        db.session.execute(text(f"DROP TABLE {shelf}"))
+
+
+@migration
+def reviews_user_book_index():
+    """Index reviews on (user_id, book_id) for the "has this user reviewed it" check."""
+
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_reviews_user_id_book_id ON reviews (user_id, book_id)"))
+
+
+@migration
+def jobs_table():
+    """Add the jobs table used by the background job queue."""
+
+    Job.__table__.create(db.session.connection(), checkfirst=True)
+
+
+@migration
+def book_search_index():
+    """Add the book_search full-text index and index every book."""
+
+    search_index.create_search_index(None, db.session.connection())
+    search_index.reindex_all()
+
+
+@migration
+def book_rating_counts():
+    """Add books.review_count, rating_sum and rating_1 to rating_5, counted from the reviews."""
+
+    for column in ['review_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']:
+        db.session.execute(text(f"ALTER TABLE books ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+
+    Book.reconcile_ratings(commit=False)
+
+
+@migration
+def reviews_book_date_index():
+    """Index reviews on (book_id, date_added, id) for the book page's review pages."""
+
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_reviews_book_id_date_added ON reviews (book_id, date_added, id)"))
+
+
+@migration
+def library_imports_table():
+    """Add the library_imports table that tracks CSV imports."""
+
+    LibraryImport.__table__.create(db.session.connection(), checkfirst=True)
+
+
+@migration
+def library_imports_rows_failed():
+    """Add library_imports.rows_failed, the rows of chunks that failed for good."""
+
+    # library_imports_table already creates it on a database that didn't have the table yet
+    columns = {column['name'] for column in db.inspect(db.session.connection()).get_columns('library_imports')}
+    if 'rows_failed' not in columns:
+        db.session.execute(text("ALTER TABLE library_imports ADD COLUMN rows_failed INTEGER NOT NULL DEFAULT 0"))
+
+
+@migration
+def library_import_rows_table():
+    """Create library_import_rows, where an upload's rows wait for their import_rows jobs."""
+
+    LibraryImportRow.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def create_migrations_table():
+    db.session.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL
+        )
+    """))
+    db.session.commit()
+
+
+def mark_all_applied():
+    """Record every migration as applied, for a database just built by db.create_all()."""
+
+    create_migrations_table()
+    db.session.execute(text("DELETE FROM schema_migrations"))
+
+    for func in MIGRATIONS:
+        db.session.execute(text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :now)"),
+                           {'name': func.__name__, 'now': datetime.utcnow()})
+    db.session.commit()
+
+
+def run():
+    """Apply every migration that hasn't been applied yet."""
+
+    create_migrations_table()
+
+    applied = {row[0] for row in db.session.execute(text("SELECT name FROM schema_migrations"))}
+
+    for func in MIGRATIONS:
+        if func.__name__ in applied:
+            continue
+
+        print(f"Applying {func.__name__}: {func.__doc__}")
+
+        try:
+            func()
+            db.session.execute(text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :now)"),
+                               {'name': func.__name__, 'now': datetime.utcnow()})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        run()
@@ -3,9 +3,13 @@
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-
-import ast
+from sqlalchemy import insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from datetime import datetime, timedelta
+import time
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -16,7 +20,96 @@ def connect_db(app):
     db.init_app(app)
     
 
-class Category(db.Model):
+def normalize_name(name):
+    """Collapse runs of whitespace in an author/category/publisher name."""
+
+    return ' '.join(name.split())
+
+
+def get_or_create_ids(model, column, values):
+    """Return {value: id} for values in model.column, inserting the missing ones.
+
+    Names are matched case-insensitively (the unique index is on lower(column)),
+    so 'J.K. Rowling' and 'j.k. rowling' share a row. It takes one SELECT for the
+    existing rows and one multi-row INSERT ... ON CONFLICT DO NOTHING for the
+    rest; if a concurrent transaction inserted some of the same names first, one
+    more SELECT picks up their ids. Nothing is committed, so callers can keep
+    everything for a book in one transaction.
+    """
+
+    # drop duplicates but keep the first spelling of each name
+    names = {}
+    for value in values:
+        name = normalize_name(value)
+        names.setdefault(name.lower(), name)
+
+    if not names:
+        return {}
+
+    col = getattr(model, column)
+    table = model.__table__
+
+    def lookup(keys):
+        rows = db.session.query(db.func.lower(col), model.id).filter(db.func.lower(col).in_(keys)).all()
+        return dict(rows)
+
+    ids = lookup(list(names))
+    missing = [{column: name} for key, name in names.items() if key not in ids]
+
+    if missing:
+        if db.session.get_bind().dialect.name == 'postgresql':
+            stmt = postgresql.insert(table).values(missing).on_conflict_do_nothing()
+            inserted = db.session.execute(stmt.returning(db.func.lower(table.c[column]), table.c.id))
+            ids.update(dict(inserted.all()))
+        else:
+            db.session.execute(sqlite.insert(table).on_conflict_do_nothing(), missing)
+
+        # sqlite has no RETURNING in SQLAlchemy 1.4, and on Postgres rows another transaction won are not returned
+        left = [key for key in names if key not in ids]
+        if left:
+            ids.update(lookup(left))
+
+    return {value: ids[normalize_name(value).lower()] for value in values}
+
+
+class NameLookupMixin:
+    """get-or-create helpers for lookup tables that are unique on a case-folded name column."""
+
+    name_column = None
+
+    @classmethod
+    def get_or_create_many(cls, names):
+        """Return {name: id}, creating missing rows race-safely. Does not commit."""
+
+        return get_or_create_ids(cls, cls.name_column, names)
+
+    @classmethod
+    def get_by_name(cls, name):
+        col = getattr(cls, cls.name_column)
+        return cls.query.filter(db.func.lower(col) == normalize_name(name).lower()).first()
+
+
+def insert_or_ignore(table, rows):
+    """INSERT rows, skipping any that would violate a unique constraint (ON CONFLICT DO NOTHING)."""
+
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    db.session.execute(dialect.insert(table).on_conflict_do_nothing(), rows)
+
+
+def add_book_links(model, column, book_id, ids, new_book=False):
+    """Insert the missing rows of a book's middle table (books_authors or books_categories) in one statement."""
+
+    existing = set()
+    if not new_book:
+        existing = {row[0] for row in db.session.query(getattr(model, column)).filter(model.book_id == book_id)}
+
+    rows = [{'book_id': book_id, column: i} for i in dict.fromkeys(ids) if i not in existing]
+
+    if rows:
+        db.session.execute(insert(model.__table__), rows)
+
+
+class Category(NameLookupMixin, db.Model):
     """Categories for books."""
 
     __tablename__ = 'categories'
@@ -24,26 +117,24 @@ class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.Text, nullable=False)
 
+    name_column = 'category'
+    __table_args__ = (db.Index('uq_categories_category', db.func.lower(category), unique=True),)
+
     @classmethod
-    def create_category_data(cls, categories):
-        """Check if the category data already exists in db, and if it doesn't, add the category data to db."""
-
-        # if there are multiple categories
-        if len(categories) != 1:
-            for category in categories:
-                if cls.query.filter(cls.category == category).first() == None:
-                    new_category = cls(category=category)
-                    db.session.add(new_category)
-                    db.session.commit()
-
-        #if there's only one category
-        else:
-            if cls.query.filter(cls.category == categories[0]).first() == None:
-                new_category = cls(category=categories[0])
-                db.session.add(new_category)
-                db.session.commit()
+    def create_category_data(cls, categories, commit=True):
+        """Check if the category data already exists in db, and if it doesn't, add the category data to db.
+
+        Returns {category: id}.
+        """
+
+        ids = cls.get_or_create_many(categories)
+
+        if commit:
+            db.session.commit()
+
+        return ids
 
-class Author(db.Model):
+class Author(NameLookupMixin, db.Model):
     """Authors for books."""
 
     __tablename__ = 'authors'
@@ -51,30 +142,28 @@ class Author(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.Text, nullable=False)
 
+    name_column = 'author'
+    __table_args__ = (db.Index('uq_authors_author', db.func.lower(author), unique=True),)
+
     def __repr__(self):
         return f"<Author #{self.id}: {self.author}>"
 
     @classmethod
-    def create_author_data(cls, authors):
-        """Check if the author data already exists in db, and if it doesn't, add the author data to db."""
-
-        # if there are multiple authors
-        if len(authors) != 1:
-            for author in authors:
-                if cls.query.filter(cls.author == author).first() == None:
-                    new_author = cls(author=author)
-                    db.session.add(new_author)
-                    db.session.commit()
-
-        # if there's only one author
-        else:
-            if cls.query.filter(cls.author == authors[0]).first() == None:
-                new_author = cls(author=authors[0])
-                db.session.add(new_author)
-                db.session.commit()
+    def create_author_data(cls, authors, commit=True):
+        """Check if the author data already exists in db, and if it doesn't, add the author data to db.
+
+        Returns {author: id}.
+        """
+
+        ids = cls.get_or_create_many(authors)
+
+        if commit:
+            db.session.commit()
+
+        return ids
 
 
-class Publisher(db.Model):
+class Publisher(NameLookupMixin, db.Model):
     """Publishers for books."""
 
     __tablename__ = 'publishers'
@@ -82,8 +171,20 @@ class Publisher(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     publisher = db.Column(db.Text, nullable=False)
 
+    name_column = 'publisher'
+    __table_args__ = (db.Index('uq_publishers_publisher', db.func.lower(publisher), unique=True),)
+
+    @classmethod
+    def create_publisher_data(cls, publisher, commit=True):
+        """Return the publisher, adding it to db first if it doesn't exist."""
+
+        publisher_id = cls.get_or_create_many([publisher])[publisher]
+
+        if commit:
+            db.session.commit()
+
+        return cls.query.get(publisher_id)
 
-  
 
 class Book(db.Model):
     """Books."""
@@ -99,6 +200,22 @@ class Book(db.Model):
 
     publisher_id = db.Column(db.Integer, db.ForeignKey('publishers.id'), nullable=False)
 
+    # normalized "title|first author": books with the same key are the same book
+    identity_key = db.Column(db.Text, nullable=True)
+
+    # our users' ratings, kept current by count_rating() whenever a review is added,
+    # changed or deleted, so the book page never reads every review to show them;
+    # reconcile_ratings() rebuilds them from the reviews table
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (db.Index('uq_books_identity_key', identity_key, unique=True),)
+
     authors = db.relationship('Author', secondary='books_authors', backref='books')
     categories = db.relationship('Category', secondary='books_categories', backref='books')
     
@@ -108,57 +225,173 @@ class Book(db.Model):
         return f"<Book #{self.id}: {self.title}, {self.authors}, {self.categories}>"
 
 
-    @classmethod
-    def create_book_data(cls, volumeId, title, subtitle, thumbnail, authors, categories, publisher):
-        """Create book data and relationships in db."""
+    @property
+    def average_rating(self):
+        """Our users' average rating, or None if nobody has reviewed the book."""
 
-        # Create book data in db
-        publisher_id=publisher.id
-        
+        return self.rating_sum / self.review_count if self.review_count else None
 
-        books = cls.query.filter_by(title=title).all()
+    @property
+    def rating_histogram(self):
+        """[(stars, number of reviews)], from 5 stars down to 1."""
 
-        if len(books) == 0:
-            new_book = Book(volumeId=volumeId, title=title, subtitle=subtitle, thumbnail=thumbnail or User.thumbnail.default.arg, publisher_id=publisher_id)
-            db.session.add(new_book)
-            db.session.commit()
-        
-        elif len(books) >= 2:
-            for book in books:
-                if book.authors[0].author == authors[0]:
-                    new_book = book
-                    return new_book
-
-            new_book = Book(volumeId=volumeId, title=title, subtitle=subtitle, thumbnail=thumbnail or User.thumbnail.default.arg, publisher_id=publisher_id)
-            db.session.add(new_book)
-            db.session.commit()
+        return [(stars, getattr(self, f'rating_{stars}')) for stars in reversed(RATINGS)]
 
-        #if there's one book with the same title
-        else:
-            book = cls.query.filter_by(title=title).first()
-            if book.authors[0].author == authors[0]:
-                new_book = book
-
-        # Create books_authors relationship
-        if len(authors) != 1:
-            for author in authors:
-                author = Author.query.filter(Author.author == author).first_or_404()
-                new_book.authors.append(author)
-                db.session.commit()
-        else:
-            author = Author.query.filter(Author.author == authors[0]).first_or_404()
-            new_book.authors.append(author)
-            db.session.commit()
+    @classmethod
+    def count_rating(cls, book_id, added=None, removed=None):
+        """Add a review's rating to (and/or take one away from) a book's rating columns. Does not commit.
+
+        It is a single UPDATE of relative increments, so concurrent reviews of the
+        same book can't overwrite each other's counts.
+        """
+
+        # form data arrives as strings
+        added = None if added is None else int(added)
+        removed = None if removed is None else int(removed)
+
+        counts = {}
+        if added is not None:
+            counts[added] = counts.get(added, 0) + 1
+        if removed is not None:
+            counts[removed] = counts.get(removed, 0) - 1
+
+        # plain ints: Postgres has no integer + boolean operator
+        review_delta = int(added is not None) - int(removed is not None)
+        rating_delta = (added or 0) - (removed or 0)
+
+        values = {
+            cls.review_count: cls.review_count + review_delta,
+            cls.rating_sum: cls.rating_sum + rating_delta,
+        }
+        for stars, change in counts.items():
+            if change:
+                column = getattr(cls, f'rating_{stars}')
+                values[column] = column + change
+
+        db.session.execute(update(cls).where(cls.id == book_id).values(values)
+                           .execution_options(synchronize_session='evaluate'))
 
-        # Create books_categories relationship
-        if len(categories) != 1:
-            for category in categories:
-                cat = Category.query.filter(Category.category == category).first_or_404()
-                new_book.categories.append(cat)
+    @classmethod
+    def reconcile_ratings(cls, batch_size=1000, commit=True):
+        """Recompute every book's rating columns from its reviews; returns how many books were off.
+
+        Books are locked and fixed batch_size at a time, committing after each
+        batch unless commit=False.
+        """
+
+        columns = ['review_count', 'rating_sum'] + [f'rating_{stars}' for stars in RATINGS]
+        aggregates = [db.func.count(), db.func.sum(Review.rating)] + \
+            [db.func.sum(db.case((Review.rating == stars, 1), else_=0)) for stars in RATINGS]
+
+        fixed = 0
+        last_id = 0
+        while True:
+            # lock the rows first, so a review counted while we read the reviews waits for us
+            stored = db.session.query(cls.id, *[getattr(cls, column) for column in columns]) \
+                .filter(cls.id > last_id).order_by(cls.id).limit(batch_size).with_for_update().all()
+            if not stored:
+                return fixed
+
+            first_id, last_id = stored[0][0], stored[-1][0]
+
+            actual = db.session.query(Review.book_id, *aggregates) \
+                .filter(Review.book_id.between(first_id, last_id)).group_by(Review.book_id).all()
+            actual = {row[0]: tuple(int(value or 0) for value in row[1:]) for row in actual}
+
+            changes = []
+            for row in stored:
+                book_id, counts = row[0], tuple(row[1:])
+                expected = actual.get(book_id, (0,) * len(columns))
+                if counts != expected:
+                    changes.append({'id': book_id, **dict(zip(columns, expected))})
+
+            if changes:
+                db.session.bulk_update_mappings(cls, changes)
+                fixed += len(changes)
+
+            if commit:
                 db.session.commit()
-        else:
-            cat = Category.query.filter(Category.category == categories[0]).first_or_404()
-            new_book.categories.append(cat)
+
+    def review_page(self, limit, after=None):
+        """One page of the book's reviews, newest first, with each reviewer loaded in the same query.
+
+        Returns (reviews, next cursor); the cursor is None on the last page. Like
+        User.shelf_page, pages are keyed by (date_added, id) rather than offset.
+        """
+
+        query = Review.query.filter_by(book_id=self.id).options(joinedload(Review.user))
+
+        if after:
+            date_added, review_id = Review.parse_cursor(after)
+            query = query.filter(db.or_(
+                Review.date_added < date_added,
+                db.and_(Review.date_added == date_added, Review.id < review_id),
+            ))
+
+        # one extra row tells us whether there is a next page
+        reviews = query.order_by(Review.date_added.desc(), Review.id.desc()).limit(limit + 1).all()
+
+        if len(reviews) > limit:
+            reviews = reviews[:limit]
+            return reviews, reviews[-1].cursor
+
+        return reviews, None
+
+    @staticmethod
+    def identity_key_for(title, authors):
+        """Key shared by every edition of a book: normalized title plus its first author."""
+
+        first_author = authors[0] if authors else ''
+        return f"{normalize_name(title).lower()}|{normalize_name(first_author).lower()}"
+
+    @classmethod
+    def find_existing(cls, volumeId, identity_key):
+        """The stored book with this identity key (or, for older rows without a key, this volumeId)."""
+
+        return cls.query.filter(db.or_(cls.identity_key == identity_key, cls.volumeId == volumeId)) \
+            .order_by((cls.identity_key == identity_key).desc()).first()
+
+    @classmethod
+    def get_or_create(cls, volumeId, title, subtitle, thumbnail, authors, publisher):
+        """Return (book, is_new): the stored book with the same identity, or a new row without authors or categories."""
+
+        # a book with the same title and the same (first) author counts as the same book
+        identity_key = cls.identity_key_for(title, authors)
+        book = cls.find_existing(volumeId, identity_key)
+
+        if book is not None:
+            return book, False
+
+        book = Book(volumeId=volumeId, title=title, subtitle=subtitle, thumbnail=thumbnail or cls.thumbnail.default.arg, publisher_id=publisher.id, identity_key=identity_key)
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(book)
+        except IntegrityError:
+            # a concurrent request added the same book first
+            return cls.find_existing(volumeId, identity_key), False
+
+        return book, True
+
+    def add_links(self, authors, categories, new_book=False):
+        """Link the book to its authors and categories, creating them if needed. Does not commit."""
+
+        author_ids = Author.create_author_data(authors, commit=False)
+        category_ids = Category.create_category_data(categories, commit=False)
+
+        # Create books_authors and books_categories relationships
+        add_book_links(BookAuthor, 'author_id', self.id, [author_ids[author] for author in authors], new_book)
+        add_book_links(BookCategory, 'category_id', self.id, [category_ids[category] for category in categories], new_book)
+        db.session.expire(self, ['authors', 'categories'])
+
+    @classmethod
+    def create_book_data(cls, volumeId, title, subtitle, thumbnail, authors, categories, publisher, commit=True):
+        """Create book data and relationships in db, all in one transaction."""
+
+        new_book, is_new = cls.get_or_create(volumeId, title, subtitle, thumbnail, authors, publisher)
+        new_book.add_links(authors, categories, is_new)
+
+        if commit:
             db.session.commit()
 
         return new_book
@@ -182,44 +415,74 @@ class BookCategory(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), primary_key=True)
 
 
-class WantToRead(db.Model):
-    """Middle table for the relationship between a user and the user's want_to_read books."""
+SHELVES = ('want_to_read', 'currently_reading', 'read', 'favorite')
+
 
-    __tablename__ = 'want_to_read'
+class ShelfEntry(db.Model):
+    """A book on one of a user's lists (want_to_read, currently_reading, read or favorite)."""
+
+    __tablename__ = 'shelf_entries'
 
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
-    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
-    
+    shelf = db.Column(db.Enum(*SHELVES, name='shelf'), primary_key=True)
+    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-class CurrentlyReading(db.Model):
-    """Middle table for the relationship between a user and the books that the user's currently reading."""
+    # the primary key (user_id, book_id, shelf) answers "which lists is this book on";
+    # this one serves a user's list in date order
+    __table_args__ = (
+        db.Index('ix_shelf_entries_user_shelf_date', user_id, shelf, date_added, book_id),
+        db.Index('ix_shelf_entries_book_id', book_id),
+    )
 
-    __tablename__ = 'currently_reading'
+    book = db.relationship('Book')
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
-    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    def __repr__(self):
+        return f"<ShelfEntry user: {self.user_id}, book: {self.book_id}, shelf: {self.shelf}, date added: {self.date_added}>"
 
+    @property
+    def cursor(self):
+        """Opaque position of this entry in its list, for keyset pagination."""
 
-class Read(db.Model):
-    """Middle table for the relationship between a user and the books that the user has read."""
+        return f"{self.date_added.isoformat()}_{self.book_id}"
 
-    __tablename__ = 'read'
+    @staticmethod
+    def parse_cursor(cursor):
+        """(date_added, book_id) from a cursor; raises ValueError if it is malformed."""
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
-    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+        date_added, _, book_id = cursor.rpartition('_')
+        return datetime.fromisoformat(date_added), int(book_id)
 
+    def serialize(self):
+        book = self.book
 
-class Favorite(db.Model):
-    """Middle table for the relationship between a user and their favorite books."""
+        return {
+            'id': book.id,
+            'volumeId': book.volumeId,
+            'title': book.title,
+            'subtitle': book.subtitle,
+            'thumbnail': book.thumbnail,
+            'authors': [author.author for author in book.authors],
+            'categories': [category.category for category in book.categories],
+            'date_added': self.date_added.isoformat(),
+        }
 
-    __tablename__ = 'favorite'
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
-    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+def shelf_relationship(shelf):
+    """Relationship to the user's entries on one shelf, plus a proxy that reads and writes them as books."""
+
+    others = ','.join(f'{other}_entries' for other in SHELVES if other != shelf)
+
+    entries = db.relationship(
+        'ShelfEntry',
+        primaryjoin=f"and_(User.id == ShelfEntry.user_id, ShelfEntry.shelf == '{shelf}')",
+        order_by='ShelfEntry.date_added',
+        cascade='all, delete-orphan',
+        overlaps=others,
+    )
+    books = association_proxy(f'{shelf}_entries', 'book', creator=lambda book: ShelfEntry(book=book, shelf=shelf))
+
+    return entries, books
 
 
 class User(db.Model):
@@ -234,10 +497,11 @@ class User(db.Model):
     image_url = db.Column(db.Text, default='/static/images/user.png')
     bio = db.Column(db.Text, nullable=True)
 
-    want_to_read = db.relationship('Book', secondary='want_to_read', backref='want_to_read_books')
-    currently_reading = db.relationship('Book', secondary='currently_reading', backref='currently_reading_books')
-    read = db.relationship('Book', secondary='read', backref='read_books')
-    favorite = db.relationship('Book', secondary='favorite', backref='favorite_books')
+    # user.read etc. behave like the old many-to-many lists of books (append, remove, slicing)
+    want_to_read_entries, want_to_read = shelf_relationship('want_to_read')
+    currently_reading_entries, currently_reading = shelf_relationship('currently_reading')
+    read_entries, read = shelf_relationship('read')
+    favorite_entries, favorite = shelf_relationship('favorite')
 
     reviews = db.relationship('Review', backref='user')
 
@@ -245,37 +509,148 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
 
-    def is_book_in_list(self, book_to_check):
-        """list of books that are in the user's lists."""
+    def add_to_shelf(self, shelf, volumeId, title, subtitle, thumbnail, authors, categories, publisher):
+        """Add a book to one of the user's lists, creating the book row first if needed.
 
-        books = []
+        A new book is written with its authors and categories (a few bulk statements),
+        so no page ever shows it without them. Its volume details and search index
+        row are left to background jobs (see jobs.py), enqueued in the same
+        transaction. Adding a book that is already on the list is a no-op.
+        """
 
-        for book in self.want_to_read:
-            books.append(book.id)
-        for book in self.currently_reading:
-            books.append(book.id)
-        for book in self.favorite:
-            books.append(book.id)
-        for book in self.read:
-            books.append(book.id)
+        publisher = Publisher.create_publisher_data(publisher, commit=False)
+        book, is_new = Book.get_or_create(volumeId, title, subtitle, thumbnail, authors, publisher)
 
-        books_in_list = set(books)
+        if is_new:
+            book.add_links(authors, categories, new_book=True)
+            Job.enqueue('index_book', {'book_id': book.id}, key=f'index_book:{book.id}')
+            Job.enqueue('fetch_volume', {'volumeId': volumeId}, key=f'fetch_volume:{volumeId}')
 
-        if book_to_check in books_in_list:
-            return True
+        return self.add_book_to_shelf(shelf, book)
+
+    def add_book_to_shelf(self, shelf, book):
+        """Add a stored book to one of the user's lists and commit; a no-op if it is already there."""
+
+        insert_or_ignore(ShelfEntry.__table__, [{'user_id': self.id, 'book_id': book.id, 'shelf': shelf, 'date_added': datetime.utcnow()}])
+        db.session.expire(self, [f'{shelf}_entries'])
+        db.session.commit()
+
+        return book
+
+    def remove_from_shelf(self, shelf, book_id):
+        """Take a book off one of the user's lists with one primary key DELETE and commit.
+
+        Returns whether the book was on the list.
+        """
+
+        removed = ShelfEntry.query.filter_by(user_id=self.id, book_id=book_id, shelf=shelf) \
+            .delete(synchronize_session=False)
+        db.session.expire(self, [f'{shelf}_entries'])
+        db.session.commit()
+
+        return removed > 0
+
+    def shelves_for_book(self, book_id):
+        """Names of the user's lists the book is on, from one primary key lookup."""
+
+        rows = db.session.query(ShelfEntry.shelf).filter_by(user_id=self.id, book_id=book_id)
+        return {row.shelf for row in rows}
+
+    def shelf_page(self, shelf, limit, after=None):
+        """One page of a user's list, most recently added first.
+
+        Returns (entries, next cursor); the cursor is None on the last page. Pages are
+        keyed by (date_added, book_id) rather than offset, so every page costs the same
+        index range scan however long the list is.
+        """
+
+        query = ShelfEntry.query.filter_by(user_id=self.id, shelf=shelf) \
+            .options(joinedload(ShelfEntry.book).selectinload(Book.authors),
+                     joinedload(ShelfEntry.book).selectinload(Book.categories))
+
+        if after:
+            date_added, book_id = ShelfEntry.parse_cursor(after)
+            query = query.filter(db.or_(
+                ShelfEntry.date_added < date_added,
+                db.and_(ShelfEntry.date_added == date_added, ShelfEntry.book_id < book_id),
+            ))
+
+        # one extra row tells us whether there is a next page
+        entries = query.order_by(ShelfEntry.date_added.desc(), ShelfEntry.book_id.desc()).limit(limit + 1).all()
+
+        if len(entries) > limit:
+            entries = entries[:limit]
+            return entries, entries[-1].cursor
+
+        return entries, None
+
+    def shelf_previews(self, per_shelf=3):
+        """The newest few books on each of the user's lists, for the profile page.
+
+        One query numbers each list's entries newest first and keeps the first
+        per_shelf of them; the books' authors are loaded in one more query.
+        Returns {shelf: [book, ...]} with an entry for every shelf.
+        """
+
+        position = db.func.row_number().over(
+            partition_by=ShelfEntry.shelf,
+            order_by=(ShelfEntry.date_added.desc(), ShelfEntry.book_id.desc()),
+        ).label('position')
+
+        ranked = db.session.query(ShelfEntry.shelf, ShelfEntry.book_id, position) \
+            .filter(ShelfEntry.user_id == self.id).subquery()
+
+        rows = db.session.query(ranked.c.shelf, Book) \
+            .join(Book, Book.id == ranked.c.book_id) \
+            .filter(ranked.c.position <= per_shelf) \
+            .order_by(ranked.c.shelf, ranked.c.position) \
+            .options(selectinload(Book.authors))
+
+        previews = {shelf: [] for shelf in SHELVES}
+        for shelf, book in rows:
+            previews[shelf].append(book)
+
+        return previews
+
+    def reviews_with_books(self):
+        """The user's reviews, newest first, with each review's book loaded in the same query."""
+
+        return Review.query.filter_by(user_id=self.id) \
+            .options(joinedload(Review.book)) \
+            .order_by(Review.date_added.desc(), Review.id.desc()).all()
+
+    def is_book_in_list(self, book_to_check):
+        """Is the book in any of the user's lists?"""
+
+        query = ShelfEntry.query.filter_by(user_id=self.id, book_id=book_to_check)
+        return db.session.query(query.exists()).scalar()
 
-    
     def user_reviewed(self, book_id):
         """Check if the user wrote review for the book."""
 
-        books_reviewed = []
+        query = Review.query.filter_by(user_id=self.id, book_id=book_id)
+        return db.session.query(query.exists()).scalar()
+
+    def reviews_for_books(self, book_ids):
+        """The user's reviews of the given books, keyed by book id, in one query."""
+
+        if not book_ids:
+            return {}
+
+        reviews = Review.query.filter(Review.user_id == self.id, Review.book_id.in_(book_ids))
+        return {review.book_id: review for review in reviews}
 
-        for book in self.reviews:
-            books_reviewed.append(book.book_id)
 
-        if book_id in books_reviewed:
-            return True
+    def principal(self):
+        """What the session cookie keeps about the logged in user (see SessionUser)."""
 
+        return {
+            'id': self.id,
+            'username': self.username,
+            'image_url': self.image_url,
+            'version': PRINCIPAL_VERSION,
+            'loaded_at': time.time(),
+        }
 
     @classmethod
     def signup(cls, username, password, email, image_url):
@@ -307,6 +682,49 @@ class User(db.Model):
         return False
         
 
+# bump when the fields kept in User.principal() change, so older cookies are rebuilt
+PRINCIPAL_VERSION = 1
+
+
+class SessionUser:
+    """Stand-in for the logged in User, built from the principal in the session cookie.
+
+    id, username and image_url (all the navbar needs) come from the cookie. Anything
+    else loads the User row the first time it is used, once per request.
+    """
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self._user = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't set in __init__
+        return getattr(self.user, name)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, SessionUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<SessionUser #{self.id}: {self.username}>"
+
+
+# the star ratings a review can give
+RATINGS = range(1, 6)
+
+
 class Review(db.Model):
     """Reviews."""
 
@@ -317,10 +735,17 @@ class Review(db.Model):
     review = db.Column(db.Text, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
-    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    date_added = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     book = db.relationship('Book', backref='reviews')
 
+    # the first answers "has this user reviewed this book" without reading the user's other
+    # reviews; the second serves a book's reviews in date order, a page at a time
+    __table_args__ = (
+        db.Index('ix_reviews_user_id_book_id', user_id, book_id),
+        db.Index('ix_reviews_book_id_date_added', book_id, date_added, id),
+    )
+
     def update_time(self):
         self.date_added = datetime.utcnow()
         db.session.add(self)
@@ -329,6 +754,136 @@ class Review(db.Model):
     def __repr__(self):
         return f"<Review #{self.id}: rating: {self.rating}, review: {self.review}, user: {self.user_id}, book: {self.book_id}, date added: {self.date_added}>"
 
+    @property
+    def cursor(self):
+        """Opaque position of this review among the book's reviews, for keyset pagination."""
+
+        return f"{self.date_added.isoformat()}_{self.id}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """(date_added, review id) from a cursor; raises ValueError if it is malformed."""
+
+        date_added, _, review_id = cursor.rpartition('_')
+        return datetime.fromisoformat(date_added), int(review_id)
+
+    def serialize(self):
+        user = self.user
+
+        return {
+            'id': self.id,
+            'rating': self.rating,
+            'review': self.review,
+            'date_added': self.date_added.isoformat(),
+            'user': {'id': user.id, 'username': user.username, 'image_url': user.image_url},
+        }
+
+
+class SearchCacheEntry(db.Model):
+    """Google Books search results shared between app workers."""
+
+    __tablename__ = 'search_cache'
+
+    key = db.Column(db.Text, primary_key=True)
+    payload = db.Column(db.JSON, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def store(cls, key, payload, fetched_at, max_entries):
+        """Insert or replace a cache entry and trim the table down to max_entries."""
+
+        db.session.merge(cls(key=key, payload=payload, fetched_at=fetched_at))
+        db.session.commit()
+
+        # trim the oldest entries once the table has grown past the limit
+        if cls.query.count() > max_entries:
+            oldest = db.session.query(cls.key).order_by(cls.fetched_at.desc()).offset(max_entries)
+            cls.query.filter(cls.key.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+            db.session.commit()
+
+    @classmethod
+    def remove(cls, key):
+        cls.query.filter_by(key=key).delete()
+        db.session.commit()
+
+
+class VolumeDetail(db.Model):
+    """Google Books volume details kept locally so book pages render without calling the API."""
+
+    __tablename__ = 'volume_details'
+
+    volumeId = db.Column(db.Text, primary_key=True)
+    title = db.Column(db.Text, nullable=False)
+    subtitle = db.Column(db.Text, nullable=True)
+    authors = db.Column(db.JSON, nullable=True)
+    categories = db.Column(db.JSON, nullable=True)
+    publisher = db.Column(db.Text, nullable=True)
+    description = db.Column(db.Text, nullable=True)
+    average_rating = db.Column(db.Float, nullable=True)
+    image_links = db.Column(db.JSON, nullable=True)
+    etag = db.Column(db.Text, nullable=True)
+    last_fetched = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<VolumeDetail {self.volumeId}: {self.title}, last fetched: {self.last_fetched}>"
+
+    def is_expired(self, ttl):
+        """Has it been more than ttl seconds since the details were fetched?"""
+
+        return (datetime.utcnow() - self.last_fetched).total_seconds() > ttl
+
+    def to_result(self):
+        """Return the details shaped like the API's volume response, which is what book.html renders."""
+
+        volume_info = {
+            'title': self.title,
+            'subtitle': self.subtitle,
+            'authors': self.authors,
+            'categories': self.categories,
+            'publisher': self.publisher,
+            'description': self.description,
+            'averageRating': self.average_rating,
+            'imageLinks': self.image_links,
+        }
+
+        return {'id': self.volumeId, 'volumeInfo': {k: v for k, v in volume_info.items() if v is not None}}
+
+    @classmethod
+    def store(cls, volumeId, result, etag=None):
+        """Insert or update the details for a volume from an API volume response."""
+
+        info = result.get('volumeInfo', {})
+
+        detail = cls.query.get(volumeId) or cls(volumeId=volumeId)
+        detail.title = info.get('title', 'N/A')
+        detail.subtitle = info.get('subtitle')
+        detail.authors = info.get('authors')
+        detail.categories = info.get('categories')
+        detail.publisher = info.get('publisher')
+        detail.description = info.get('description')
+        detail.average_rating = info.get('averageRating')
+        detail.image_links = info.get('imageLinks')
+        detail.etag = etag or result.get('etag')
+        detail.last_fetched = datetime.utcnow()
+
+        db.session.add(detail)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another worker stored the same volume first
+            db.session.rollback()
+            return cls.query.get(volumeId)
+
+        return detail
+
+    @classmethod
+    def touch(cls, volumeId):
+        """Mark the details as fresh without changing them (the API answered 304 Not Modified)."""
+
+        cls.query.filter_by(volumeId=volumeId).update({'last_fetched': datetime.utcnow()})
+        db.session.commit()
+
 
 
 
@@ -336,4 +891,206 @@ class Review(db.Model):
     
 
 
+JOB_STATUSES = ('queued', 'running', 'failed')
+
+
+class Job(db.Model):
+    """A unit of background work, run by jobs.py. Finished jobs are deleted."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.Text, nullable=False)
+    # at most one queued or running job per key, so the same work isn't enqueued twice
+    key = db.Column(db.Text, nullable=True)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.Enum(*JOB_STATUSES, name='job_status'), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_kind_run_at', status, kind, run_at),
+        db.Index('uq_jobs_active_key', key, unique=True,
+                 postgresql_where=status.in_(('queued', 'running')), sqlite_where=status.in_(('queued', 'running'))),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind}, {self.status}, attempts: {self.attempts}>"
+
+    @classmethod
+    def enqueue(cls, kind, payload, key=None, run_at=None):
+        """Queue a job in the current transaction; returns None if one with the same key is already waiting.
+
+        Does not commit. The ids of the jobs queued are kept in db.session.info['enqueued_jobs'].
+        """
+
+        job = cls(kind=kind, payload=payload, key=key, run_at=run_at or datetime.utcnow())
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(job)
+        except IntegrityError:
+            return None
+
+        db.session.info.setdefault('enqueued_jobs', []).append(job.id)
+        return job
+
+    @classmethod
+    def claim(cls, kinds=None, ids=None, limit=20, timeout=600):
+        """Mark up to limit due jobs as running and return them.
+
+        Jobs left running for more than timeout seconds (their worker died) are
+        claimed again. On Postgres, rows another worker is claiming are skipped.
+        """
+
+        now = datetime.utcnow()
+
+        query = cls.query.filter(db.or_(
+            db.and_(cls.status == 'queued', cls.run_at <= now),
+            db.and_(cls.status == 'running', cls.locked_at < now - timedelta(seconds=timeout)),
+        ))
+
+        if kinds is not None:
+            query = query.filter(cls.kind.in_(kinds))
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+
+        jobs = query.order_by(cls.id).limit(limit).with_for_update(skip_locked=True).all()
+
+        for job in jobs:
+            job.status = 'running'
+            job.locked_at = now
+            job.attempts += 1
+
+        db.session.commit()
+        return jobs
+
+    def retry_or_fail(self, error, max_attempts, retry_seconds):
+        """Queue the job again with exponential backoff, or mark it failed after max_attempts."""
+
+        self.last_error = error
+        self.locked_at = None
+
+        if self.attempts >= max_attempts:
+            self.status = 'failed'
+        else:
+            self.status = 'queued'
+            self.run_at = datetime.utcnow() + timedelta(seconds=retry_seconds * 2 ** (self.attempts - 1))
+
+
+class LibraryImport(db.Model):
+    """A CSV import of a user's library (see library_import.py) and how far it has got."""
+
+    __tablename__ = 'library_imports'
+
+    # titles of rows that matched no book are kept for the user to see, up to this many
+    MAX_UNMATCHED = 100
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), nullable=False, index=True)
+    filename = db.Column(db.Text, nullable=True)
+    # None until the whole file has been read
+    rows_total = db.Column(db.Integer, nullable=True)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    added = db.Column(db.Integer, nullable=False, default=0)
+    not_found = db.Column(db.Integer, nullable=False, default=0)
+    # rows of chunks that failed for good (see the import_rows job)
+    rows_failed = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unmatched = db.Column(db.JSON, nullable=False, default=list)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<LibraryImport #{self.id}: user: {self.user_id}, {self.rows_done}/{self.rows_total} rows>"
+
+    @classmethod
+    def locked(cls, import_id):
+        """The import row, locked until the end of the transaction, since chunks may finish at the same time."""
+
+        return cls.query.filter_by(id=import_id).with_for_update().populate_existing().one()
+
+    def _check_finished(self):
+        if self.finished_at is None and self.rows_total is not None and self.rows_done >= self.rows_total:
+            self.finished_at = datetime.utcnow()
+
+    @classmethod
+    def record_progress(cls, import_id, rows, added, unmatched):
+        """Count a chunk of rows as done. Does not commit."""
+
+        record = cls.locked(import_id)
+        record.rows_done += rows
+        record.added += added
+        record.not_found += len(unmatched)
+        record.unmatched = (record.unmatched + unmatched)[:cls.MAX_UNMATCHED]
+        record._check_finished()
+        return record
+
+    @classmethod
+    def record_failure(cls, import_id, rows):
+        """Count a chunk of rows that won't be imported as done, so the import still finishes. Does not commit."""
+
+        record = cls.locked(import_id)
+        record.rows_done += rows
+        record.rows_failed += rows
+        record._check_finished()
+        return record
+
+    @classmethod
+    def finish_reading(cls, import_id, rows_total):
+        """Record how many rows the file had, once it has all been read. Does not commit."""
+
+        record = cls.locked(import_id)
+        record.rows_total = rows_total
+        record._check_finished()
+        return record
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'rows_total': self.rows_total,
+            'rows_done': self.rows_done,
+            'added': self.added,
+            'not_found': self.not_found,
+            'rows_failed': self.rows_failed,
+            'unmatched': self.unmatched,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class LibraryImportRow(db.Model):
+    """A parsed row of an uploaded CSV file, kept until its import_rows job has handled it."""
+
+    __tablename__ = 'library_import_rows'
+
+    import_id = db.Column(db.Integer, db.ForeignKey('library_imports.id', ondelete="cascade"), primary_key=True)
+    # the row's place in the file, from 0
+    position = db.Column(db.Integer, primary_key=True)
+    row = db.Column(db.JSON, nullable=False)
+
+    @classmethod
+    def store(cls, import_id, start, rows):
+        """Write rows as positions start, start + 1, ... with one multi-row INSERT. Does not commit."""
+
+        db.session.execute(insert(cls.__table__), [
+            {'import_id': import_id, 'position': start + i, 'row': row} for i, row in enumerate(rows)])
+
+    @classmethod
+    def chunk(cls, import_id, start, stop):
+        """The rows at positions start to stop - 1, in file order."""
+
+        query = db.session.query(cls.row).filter(cls.import_id == import_id, cls.position >= start, cls.position < stop)
+        return [row for row, in query.order_by(cls.position)]
+
+    @classmethod
+    def remove(cls, import_id, start=None, stop=None):
+        """Delete the rows at positions start to stop - 1 (all of the import's rows by default). Does not commit."""
 
+        query = cls.query.filter(cls.import_id == import_id)
+        if start is not None:
+            query = query.filter(cls.position >= start, cls.position < stop)
+        query.delete(synchronize_session=False)
@@ -0,0 +1,185 @@
+"""Read-through cache for Google Books search results."""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class CacheEntry:
+    """A cached search result and the time (epoch seconds) it was fetched."""
+
+    def __init__(self, value, fetched_at=None):
+        self.value = value
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+class LRUBackend:
+    """In-process, size-bounded LRU store."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            # evict the least recently used entries once we are over the limit
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DatabaseBackend:
+    """Shared store backed by the search_cache table, so every worker sees the same entries."""
+
+    def __init__(self, app, model, max_entries=10000):
+        self.app = app
+        self.model = model
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.app.app_context():
+            row = self.model.query.get(key)
+            if row is None:
+                return None
+            return CacheEntry(row.payload, row.fetched_at.timestamp())
+
+    def set(self, key, entry):
+        with self.app.app_context():
+            self.model.store(key, entry.value, datetime.fromtimestamp(entry.fetched_at), self.max_entries)
+
+    def delete(self, key):
+        with self.app.app_context():
+            self.model.remove(key)
+
+
+class SearchCache:
+    """Two-tier (local LRU + optional shared backend) read-through cache.
+
+    Entries younger than `ttl` are served as hits. Entries older than `ttl` but
+    within `stale_ttl` are served as they are while a background thread refreshes
+    them (stale-while-revalidate). Anything older is fetched synchronously, and
+    if that fetch fails the stale entry is served rather than an error.
+    """
+
+    def __init__(self, ttl=3600, stale_ttl=86400, max_entries=512, shared=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.local = LRUBackend(max_entries)
+        self.shared = shared
+
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, params=None):
+        """Build a cache key from the normalized query and the remaining request params."""
+
+        normalized = ' '.join((query or '').lower().split())
+        params = {k: v for k, v in (params or {}).items() if k not in ('q', 'key')}
+
+        return f"{normalized}|{json.dumps(params, sort_keys=True)}"
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        return entry
+
+    def _store(self, key, value):
+        entry = CacheEntry(value)
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry)
+        return entry
+
+    def _refresh(self, key, fetch):
+        try:
+            self._store(key, fetch())
+            self._count('refreshes')
+        except Exception:
+            self._count('errors')
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+    def _refresh_in_background(self, key, fetch):
+        """Start a refresh for key unless one is already running."""
+
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value for key, calling fetch() to fill or refresh it."""
+
+        entry = self._lookup(key)
+
+        if entry is not None:
+            age = entry.age()
+
+            if age < self.ttl:
+                self._count('hits')
+                return entry.value
+
+            if age < self.ttl + self.stale_ttl:
+                self._count('stale_hits')
+                self._refresh_in_background(key, fetch)
+                return entry.value
+
+        self._count('misses')
+
+        try:
+            return self._store(key, fetch()).value
+        except Exception:
+            self._count('errors')
+            # upstream is down: an old answer is better than none
+            if entry is not None:
+                return entry.value
+            raise
+
+    def invalidate(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def hit_ratio(self):
+        served = self.stats['hits'] + self.stats['stale_hits']
+        total = served + self.stats['misses']
+        return served / total if total else 0.0
@@ -0,0 +1,194 @@
+"""Full-text index over our own books: title, subtitle, authors and review text.
+
+One row per book in the book_search table, weighted title > authors > reviews:
+
+- on Postgres, a plain table whose tsvector column is generated from the three
+  text columns, with a GIN index on it, queried with websearch_to_tsquery;
+- on SQLite (tests, local development), an FTS5 virtual table ranked by bm25.
+
+The table is created by db.create_all() (and the book_search_index migration)
+and kept current by the index_book job, which is queued whenever a book is
+added or its reviews change; see reindex_later().
+"""
+
+import re
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Author, BookAuthor, Book, Review, Job
+
+
+POSTGRES_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS book_search (
+        book_id INTEGER PRIMARY KEY REFERENCES books (id) ON DELETE CASCADE,
+        title TEXT NOT NULL DEFAULT '',
+        authors TEXT NOT NULL DEFAULT '',
+        reviews TEXT NOT NULL DEFAULT '',
+        document tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', title), 'A') ||
+            setweight(to_tsvector('english', authors), 'B') ||
+            setweight(to_tsvector('english', reviews), 'C')
+        ) STORED
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_book_search_document ON book_search USING GIN (document)",
+)
+
+SQLITE_DDL = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS book_search
+    USING fts5(title, authors, reviews, book_id UNINDEXED, tokenize = 'porter unicode61')
+    """,
+)
+
+
+def is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def create_search_index(target, connection, **kw):
+    """Create book_search if it doesn't exist (runs after db.create_all())."""
+
+    for statement in POSTGRES_DDL if is_postgres(connection) else SQLITE_DDL:
+        connection.execute(text(statement))
+
+
+def drop_search_index(target, connection, **kw):
+    """Drop book_search before db.drop_all() drops the books it points at."""
+
+    connection.execute(text("DROP TABLE IF EXISTS book_search"))
+
+
+db.event.listen(db.metadata, 'after_create', create_search_index)
+db.event.listen(db.metadata, 'before_drop', drop_search_index)
+
+
+def documents(book_ids):
+    """{book_id: {'title', 'authors', 'reviews'}} built from the books, authors and reviews tables."""
+
+    docs = {}
+
+    for book_id, title, subtitle in db.session.query(Book.id, Book.title, Book.subtitle).filter(Book.id.in_(book_ids)):
+        docs[book_id] = {'book_id': book_id, 'title': ' '.join(filter(None, (title, subtitle))), 'authors': [], 'reviews': []}
+
+    authors = db.session.query(BookAuthor.book_id, Author.author) \
+        .join(Author, Author.id == BookAuthor.author_id).filter(BookAuthor.book_id.in_(book_ids))
+    for book_id, author in authors:
+        docs[book_id]['authors'].append(author)
+
+    reviews = db.session.query(Review.book_id, Review.review) \
+        .filter(Review.book_id.in_(book_ids), Review.review.isnot(None))
+    for book_id, review in reviews:
+        docs[book_id]['reviews'].append(review)
+
+    for doc in docs.values():
+        doc['authors'] = ' '.join(doc['authors'])
+        doc['reviews'] = '\n'.join(doc['reviews'])
+
+    return docs
+
+
+def reindex(book_ids):
+    """Rewrite the index rows of these books. Does not commit."""
+
+    book_ids = list(set(book_ids))
+    if not book_ids:
+        return
+
+    docs = list(documents(book_ids).values())
+    connection = db.session.connection()
+
+    if is_postgres(connection):
+        if docs:
+            db.session.execute(text("""
+                INSERT INTO book_search (book_id, title, authors, reviews)
+                VALUES (:book_id, :title, :authors, :reviews)
+                ON CONFLICT (book_id) DO UPDATE
+                SET title = excluded.title, authors = excluded.authors, reviews = excluded.reviews
+            """), docs)
+    else:
+        # FTS5 tables have no unique keys to upsert on
+        delete = text("DELETE FROM book_search WHERE book_id IN :ids").bindparams(bindparam('ids', expanding=True))
+        db.session.execute(delete, {'ids': book_ids})
+        if docs:
+            db.session.execute(text("""
+                INSERT INTO book_search (book_id, title, authors, reviews)
+                VALUES (:book_id, :title, :authors, :reviews)
+            """), docs)
+
+
+def reindex_all(batch_size=500):
+    """Index every book, batch_size books per statement. Does not commit."""
+
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Book.id).filter(Book.id > last_id).order_by(Book.id).limit(batch_size)]
+        if not ids:
+            return
+        reindex(ids)
+        last_id = ids[-1]
+
+
+def reindex_later(book_id):
+    """Queue an index_book job for a book whose reviews or authors changed, in the current transaction."""
+
+    Job.enqueue('index_book', {'book_id': book_id}, key=f'index_book:{book_id}')
+
+
+def fts5_query(query):
+    """Quote every word, so user input can't use (or break on) FTS5 query syntax."""
+
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"' for word in words)
+
+
+def search(query, limit=20):
+    """Books matching query, best match first, with authors, categories and publisher loaded."""
+
+    if not query or not query.strip():
+        return []
+
+    if is_postgres(db.session.connection()):
+        rows = db.session.execute(text("""
+            SELECT book_id FROM book_search, websearch_to_tsquery('english', :query) q
+            WHERE document @@ q
+            ORDER BY ts_rank(document, q) DESC, book_id
+            LIMIT :limit
+        """), {'query': query, 'limit': limit})
+    else:
+        match = fts5_query(query)
+        if not match:
+            return []
+        rows = db.session.execute(text("""
+            SELECT book_id FROM book_search
+            WHERE book_search MATCH :query
+            ORDER BY bm25(book_search, 10.0, 5.0, 1.0), book_id
+            LIMIT :limit
+        """), {'query': match, 'limit': limit})
+
+    ids = [row[0] for row in rows]
+    if not ids:
+        return []
+
+    books = Book.query.filter(Book.id.in_(ids)) \
+        .options(selectinload(Book.authors), selectinload(Book.categories), joinedload(Book.publisher)).all()
+
+    by_id = {book.id: book for book in books}
+    return [by_id[book_id] for book_id in ids if book_id in by_id]
+
+
+def as_search_item(book):
+    """A local book shaped like an item of the API's search response, which is what search_result.html renders."""
+
+    volume_info = {
+        'title': book.title,
+        'subtitle': book.subtitle,
+        'authors': [author.author for author in book.authors],
+        'categories': [category.category for category in book.categories],
+        'publisher': book.publisher.publisher,
+        'imageLinks': {'thumbnail': book.thumbnail},
+    }
+
+    return {'id': book.volumeId, 'local': True, 'volumeInfo': {k: v for k, v in volume_info.items() if v}}
@@ -2,9 +2,11 @@
 
 from models import db
 from app import app
+from migrations import mark_all_applied
 
 
 # Create all tables
 with app.app_context():
     db.drop_all()
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    mark_all_applied()
\ No newline at end of file
@@ -0,0 +1,165 @@
+// Typeahead for the navbar search box: suggestions from /search/suggest fill a
+// <datalist>, and picking one goes straight to the book (or author search).
+(function () {
+  var input = document.getElementById('search');
+  var list = document.getElementById('search-suggestions');
+  if (!input || !list || !window.fetch) {
+    return;
+  }
+
+  var DELAY_MS = 150;
+  var timer = null;
+  var controller = null;
+  var suggestions = [];
+
+  function show(items) {
+    suggestions = items;
+    list.innerHTML = '';
+    items.forEach(function (item) {
+      var option = document.createElement('option');
+      option.value = item.label;
+      list.appendChild(option);
+    });
+  }
+
+  function load(query) {
+    if (controller) {
+      controller.abort();
+    }
+    controller = window.AbortController ? new AbortController() : null;
+
+    fetch('/search/suggest?q=' + encodeURIComponent(query), {
+      credentials: 'same-origin',
+      signal: controller ? controller.signal : undefined
+    })
+      .then(function (res) { return res.ok ? res.json() : { suggestions: [] }; })
+      .then(function (data) {
+        if (input.value.trim() === query) {
+          show(data.suggestions);
+        }
+      })
+      .catch(function () {});
+  }
+
+  input.addEventListener('input', function () {
+    var query = input.value.trim();
+
+    var picked = suggestions.filter(function (item) { return item.label === input.value; })[0];
+    if (picked && picked.url) {
+      window.location.href = picked.url;
+      return;
+    }
+
+    clearTimeout(timer);
+    if (query.length < 2) {
+      show([]);
+      return;
+    }
+    timer = setTimeout(function () { load(query); }, DELAY_MS);
+  });
+})();
+
+// "more reviews" on the book page: append the next page of reviews from
+// /api/books/<volumeId>/reviews instead of following the link to a new page.
+(function () {
+  var more = document.getElementById('more_reviews');
+  var list = document.getElementById('reviews');
+  var card = document.getElementById('review_card');
+  if (!more || !list || !card || !window.fetch || !('content' in card)) {
+    return;
+  }
+
+  function stars(rating) {
+    var html = '';
+    for (var i = 1; i <= 5; i++) {
+      html += '<i class="' + (i <= rating ? 'fa-solid' : 'fa-regular') + ' fa-star"></i>';
+    }
+    return html;
+  }
+
+  function render(review) {
+    var node = card.content.cloneNode(true);
+    var text = review.review || '';
+    var date = new Date(review.date_added);
+
+    node.querySelector('.review-image').src = review.user.image_url;
+    node.querySelector('.review-stars').innerHTML = stars(review.rating);
+    node.querySelector('.review-username').textContent = 'by ' + review.user.username.toLowerCase();
+    node.querySelector('.review-text').textContent = text.length > 600 ? text.slice(0, 597) + '...' : text;
+    node.querySelector('.review-date').textContent = 'reviewed on: ' +
+      date.toLocaleDateString('en-US', { month: 'long', day: '2-digit', year: 'numeric' });
+
+    var form = node.querySelector('.review-delete');
+    if (String(review.user.id) === more.dataset.userId) {
+      form.action = '/users/' + review.user.id + '/reviews/' + review.id + '/delete';
+    } else {
+      form.parentNode.removeChild(form);
+    }
+
+    list.appendChild(node);
+  }
+
+  more.addEventListener('click', function (event) {
+    event.preventDefault();
+    if (more.classList.contains('disabled')) {
+      return;
+    }
+    more.classList.add('disabled');
+
+    fetch(more.dataset.url + '?after=' + encodeURIComponent(more.dataset.after), { credentials: 'same-origin' })
+      .then(function (res) {
+        if (!res.ok) {
+          throw new Error(res.status);
+        }
+        return res.json();
+      })
+      .then(function (data) {
+        data.reviews.forEach(render);
+
+        if (data.next) {
+          more.dataset.after = data.next;
+          more.href = more.href.split('?')[0] + '?after=' + encodeURIComponent(data.next);
+          more.classList.remove('disabled');
+        } else {
+          more.parentNode.removeChild(more);
+        }
+      })
+      .catch(function () {
+        // fall back to the plain link
+        window.location.href = more.href;
+      });
+  });
+})();
+
+// Imports still running on the import page: poll their progress until they finish.
+(function () {
+  var items = document.querySelectorAll('.import-progress[data-progress-url]');
+  if (!items.length || !window.fetch) {
+    return;
+  }
+
+  var POLL_MS = 3000;
+
+  function poll(item) {
+    fetch(item.dataset.progressUrl, { credentials: 'same-origin' })
+      .then(function (res) { return res.ok ? res.json() : null; })
+      .then(function (record) {
+        if (!record) {
+          return;
+        }
+        item.querySelector('.import-status').textContent =
+          record.rows_done + ' of ' + (record.rows_total === null ? '?' : record.rows_total) + ' rows, ' +
+          record.added + ' added, ' + record.not_found + ' not found' +
+          (record.rows_failed ? ', ' + record.rows_failed + ' failed' : '') + (record.finished_at ? '' : ' (importing)');
+
+        if (!record.finished_at) {
+          setTimeout(function () { poll(item); }, POLL_MS);
+        }
+      })
+      .catch(function () {});
+  }
+
+  Array.prototype.forEach.call(items, function (item) {
+    setTimeout(function () { poll(item); }, POLL_MS);
+  });
+})();
@@ -0,0 +1,238 @@
+"""Typeahead suggestions for the search box, from an in-memory index of local titles and authors.
+
+Every web worker keeps its own index, loaded and kept current by a background
+thread (start()), which gunicorn starts as each worker boots (gunicorn.conf.py).
+Requests only read the index: until the first load is done they get no
+suggestions rather than waiting for it. After that, the thread tops it up every
+refresh_seconds with the books and authors whose id is above the highest one it
+has seen, which costs two indexed queries. Titles and author names never change
+once written, and rows are never deleted, so new ids are all there is to pick up.
+
+A query is matched two ways:
+
+- prefix: the query is the start of a word of the title or name, found by
+  binary search over a sorted list of every word-suffix ("the story of
+  success", "story of success", ...). "story of" finds "Outliers: The Story
+  of Success".
+- trigram: when prefixes find fewer than `limit` entries, entries sharing
+  enough three-letter sequences with the query (like pg_trgm's similarity())
+  fill the rest, so "malcom gladwel" still finds Malcolm Gladwell.
+"""
+
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlencode
+
+from models import db, Author, Book, ShelfEntry
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    return ' '.join(re.findall(r'\w+', (text or '').lower()))
+
+
+def trigrams(text):
+    """Three-letter sequences of each word, padded like pg_trgm ("  c", " ca", "cat", "at ")."""
+
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SuggestIndex:
+    """Prefix and trigram index over book titles and author names."""
+
+    def __init__(self, refresh_seconds=5, min_similarity=0.3):
+        self.refresh_seconds = refresh_seconds
+        self.min_similarity = min_similarity
+
+        # entries[i] = {'type', 'label', 'key', 'volumeId', 'popularity', 'grams'}
+        self.entries = []
+        # sorted (word-suffix, entry index) pairs
+        self.prefixes = []
+        # trigram -> set of entry indexes
+        self.grams = {}
+
+        self.last_book_id = 0
+        self.last_author_id = 0
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, type, label, volumeId, popularity, new_grams):
+        """Append an entry; returns its (word-suffix, index) pairs and collects its trigrams in new_grams."""
+
+        key = normalize(label)
+        if not key:
+            return []
+
+        index = len(self.entries)
+        grams = trigrams(key)
+        self.entries.append({'type': type, 'label': label, 'key': key, 'volumeId': volumeId,
+                             'popularity': popularity, 'grams': len(grams)})
+
+        for gram in grams:
+            new_grams.setdefault(gram, set()).add(index)
+
+        words = key.split()
+        return [(' '.join(words[i:]), index) for i in range(len(words))]
+
+    def start(self, app):
+        """Load the index and keep it current in a background thread; does nothing if one is running."""
+
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, args=(app,), name='suggest-index', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and wait for it."""
+
+        thread = self._thread
+        if thread is None:
+            return
+
+        self._stopping.set()
+        thread.join()
+        self._thread = None
+
+    def _run(self, app):
+        while not self._stopping.is_set():
+            with app.app_context():
+                try:
+                    self.refresh(force=True)
+                except Exception:
+                    logger.warning('Could not refresh the suggestion index', exc_info=True)
+                finally:
+                    db.session.remove()
+
+            self._stopping.wait(self.refresh_seconds)
+
+    def refresh(self, force=False):
+        """Load books and authors added since the last refresh."""
+
+        now = time.monotonic()
+        if not force and self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+            return
+
+        # one refresh at a time; other requests keep using the index as it is
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            self.refreshed_at = now
+
+            books = db.session.query(Book.id, Book.title, Book.volumeId) \
+                .filter(Book.id > self.last_book_id).order_by(Book.id).all()
+            authors = db.session.query(Author.id, Author.author) \
+                .filter(Author.id > self.last_author_id).order_by(Author.id).all()
+
+            if not books and not authors:
+                return
+
+            # how many lists a book is on when it is indexed, to put popular books first
+            popularity = {}
+            if books:
+                counts = db.session.query(ShelfEntry.book_id, db.func.count()) \
+                    .filter(ShelfEntry.book_id > self.last_book_id).group_by(ShelfEntry.book_id)
+                popularity = dict(counts.all())
+
+            new_prefixes = []
+            new_grams = {}
+            for book_id, title, volumeId in books:
+                new_prefixes.extend(self._add('book', title, volumeId, popularity.get(book_id, 0), new_grams))
+            for author_id, name in authors:
+                new_prefixes.extend(self._add('author', name, None, 0, new_grams))
+
+            # lookups in other threads may be reading these: build new sets and lists, then swap them in
+            for gram, indexes in new_grams.items():
+                self.grams[gram] = self.grams.get(gram, frozenset()) | indexes
+            self.prefixes = sorted(self.prefixes + new_prefixes)
+
+            if books:
+                self.last_book_id = books[-1][0]
+            if authors:
+                self.last_author_id = authors[-1][0]
+        finally:
+            self._lock.release()
+
+    def prefix_matches(self, query):
+        """Indexes of entries with a word starting with query."""
+
+        prefixes = self.prefixes
+        found = []
+        seen = set()
+
+        i = bisect_left(prefixes, (query,))
+        while i < len(prefixes) and prefixes[i][0].startswith(query):
+            index = prefixes[i][1]
+            if index not in seen:
+                seen.add(index)
+                found.append(index)
+            i += 1
+
+        return found
+
+    def trigram_matches(self, query, exclude):
+        """Indexes of entries similar to query, most similar first."""
+
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        shared = {}
+        for gram in query_grams:
+            for index in self.grams.get(gram, ()):
+                if index not in exclude:
+                    shared[index] = shared.get(index, 0) + 1
+
+        scored = []
+        for index, count in shared.items():
+            similarity = count / (len(query_grams) + self.entries[index]['grams'] - count)
+            if similarity >= self.min_similarity:
+                scored.append((-similarity, index))
+
+        return [index for similarity, index in sorted(scored)]
+
+    def suggest(self, query, limit=10):
+        """Up to limit entries for what has been typed so far, best first."""
+
+        query = normalize(query)
+        if not query:
+            return []
+
+        entries = self.entries
+
+        def rank(index):
+            entry = entries[index]
+            # whole label starts with the query, then popular books, then shorter labels
+            return (not entry['key'].startswith(query), -entry['popularity'], len(entry['key']), index)
+
+        found = sorted(self.prefix_matches(query), key=rank)[:limit]
+
+        if len(found) < limit:
+            found += self.trigram_matches(query, set(found))[:limit - len(found)]
+
+        return [self.serialize(entries[index]) for index in found]
+
+    @staticmethod
+    def serialize(entry):
+        if entry['type'] == 'book':
+            return {'type': 'book', 'label': entry['label'], 'volumeId': entry['volumeId'], 'url': f"/books/{entry['volumeId']}"}
+        return {'type': 'author', 'label': entry['label'], 'url': f"/search?{urlencode({'q': entry['label'], 'source': 'local'})}"}
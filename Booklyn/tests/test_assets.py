@@ -0,0 +1,77 @@
+"""Static asset build and serving tests."""
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import Flask, render_template_string
+
+import build_assets
+from caching import init_caching
+
+
+class AssetTestCase(TestCase):
+    """Test build_assets.py and how caching.py serves its output."""
+
+    def setUp(self):
+        """Build a small static folder into a temporary directory."""
+
+        self.dir = tempfile.mkdtemp()
+        static = os.path.join(self.dir, 'static')
+        os.makedirs(os.path.join(static, 'stylesheets'))
+        os.makedirs(os.path.join(static, 'font'))
+
+        with open(os.path.join(static, 'stylesheets', 'style.css'), 'w') as f:
+            f.write("@font-face { src: url('/static/font/face.ttf'); }\n" + 'body { margin: 0; }\n' * 50)
+        with open(os.path.join(static, 'font', 'face.ttf'), 'wb') as f:
+            f.write(b'font' * 1000)
+
+        self.saved = (build_assets.STATIC, build_assets.DIST, build_assets.MANIFEST)
+        build_assets.STATIC = static
+        build_assets.DIST = os.path.join(static, 'dist')
+        build_assets.MANIFEST = os.path.join(static, 'dist', 'manifest.json')
+        self.manifest = build_assets.build()
+
+        self.app = Flask(__name__, static_folder=static)
+        init_caching(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        build_assets.STATIC, build_assets.DIST, build_assets.MANIFEST = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        """Are files fingerprinted, compressed, and CSS url()s rewritten?"""
+
+        css = self.manifest['stylesheets/style.css']['file']
+        font = self.manifest['font/face.ttf']['file']
+
+        self.assertRegex(css, r'^dist/stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(build_assets.STATIC, f'{font}.gz')))
+
+        with open(os.path.join(build_assets.STATIC, css)) as f:
+            self.assertIn(f"url('/static/{font}')", f.read())
+
+    def test_asset_url_and_variants(self):
+        """Does asset_url link the build, served gzipped and immutable?"""
+
+        with self.app.test_request_context():
+            url = render_template_string("{{ asset_url('stylesheets/style.css') }}")
+
+        self.assertEqual(url, '/static/' + self.manifest['stylesheets/style.css']['file'])
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertNotIn('no-cache', resp.headers['Cache-Control'])
+        self.assertIn('body { margin: 0; }', gzip.decompress(resp.get_data()).decode())
+        resp.close()
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
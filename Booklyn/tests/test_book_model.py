@@ -4,7 +4,7 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Author, Category, Publisher, Book, Review
+from models import db, User, Author, Category, Publisher, Book, Review, VolumeDetail
 
 os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
 
@@ -167,3 +167,54 @@ class BookModelTestCase(TestCase):
 
         
 
+
+    def test_volume_detail_model(self):
+        """Does the volume detail store round-trip an API volume response?"""
+
+        result = {
+            'id': 'ialrgIT41OAC',
+            'volumeInfo': {
+                'title': 'Outliers',
+                'subtitle': 'The Story of Success',
+                'authors': ['Malcolm Gladwell'],
+                'description': 'Why do some people succeed?',
+                'averageRating': 4.5,
+                'imageLinks': {'thumbnail': 'http://books.google.com/books/content?id=ialrgIT41OAC'},
+            }
+        }
+
+        VolumeDetail.store('ialrgIT41OAC', result, etag='"abc"')
+        detail = VolumeDetail.query.get('ialrgIT41OAC')
+
+        self.assertEqual(detail.etag, '"abc"')
+        self.assertFalse(detail.is_expired(60))
+        self.assertEqual(detail.to_result(), result)
+
+    def test_create_author_data_bulk(self):
+        """Are existing authors reused and new ones added once?"""
+
+        ids = Author.create_author_data(['Malcolm Gladwell', 'Walter Isaacson', 'Walter Isaacson'])
+
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(Author.query.filter_by(author='Malcolm Gladwell').one().id, ids['Malcolm Gladwell'])
+        self.assertEqual(Author.query.filter_by(author='Walter Isaacson').count(), 1)
+
+    def test_get_or_create_many_case_insensitive(self):
+        """Do names that only differ in case or spacing share one row?"""
+
+        ids = Publisher.get_or_create_many(['penguin  uk', 'Simon and Schuster'])
+
+        self.assertEqual(ids['penguin  uk'], Publisher.query.filter_by(publisher='Penguin UK').one().id)
+        self.assertEqual(Publisher.query.count(), 2)
+        self.assertEqual(Publisher.get_by_name('simon and schuster').id, ids['Simon and Schuster'])
+
+    def test_identity_key(self):
+        """Is another edition with the same title and first author the same book?"""
+
+        publisher = Publisher.query.filter_by(publisher='Penguin UK').first()
+
+        book = Book.create_book_data('other-edition', ' outliers', None, None, ['MALCOLM GLADWELL'], ['Psychology'], publisher)
+
+        self.assertEqual(book.volumeId, 'ialrgIT41OAC')
+        self.assertEqual(book.identity_key, 'outliers|malcolm gladwell')
+        self.assertEqual(Book.query.count(), 1)
@@ -0,0 +1,146 @@
+"""Cover cache tests."""
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+
+from PIL import Image
+
+from covers import CoverCache, resize_cover, is_allowed_url, COVER_SIZE
+
+
+def image_bytes(color, size=(128, 190), format='PNG'):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, format=format)
+    return out.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """/cover is an image; /redirect?to=<url> redirects to url."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/redirect?to='):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect?to='):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = image_bytes('blue')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class CoverCacheTestCase(TestCase):
+    """Test CoverCache against a temporary directory."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.covers = CoverCache(self.dir, max_bytes=13000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store_and_lookup(self):
+        """Is a stored cover found again by volumeId, and identical images kept once?"""
+
+        self.assertIsNone(self.covers.lookup('abc'))
+
+        path, digest = self.covers.store('abc', b'cover')
+        self.assertEqual(self.covers.lookup('abc'), (path, digest))
+
+        self.assertEqual(self.covers.store('def', b'cover'), (path, digest))
+        self.assertEqual(len(self.covers.blobs()), 1)
+
+    def test_get_or_fetch(self):
+        """Is source() only called on a miss, and None passed through?"""
+
+        self.covers.store('abc', b'cover')
+        self.assertIsNotNone(self.covers.get_or_fetch('abc', lambda: self.fail('fetched a cached cover')))
+        self.assertIsNone(self.covers.get_or_fetch('def', lambda: None))
+
+        with self.assertRaises(ValueError):
+            self.covers.get_or_fetch('ghi', lambda: 'http://169.254.169.254/latest/meta-data')
+
+    def test_eviction(self):
+        """Are the least recently served covers deleted once the cache is over max_bytes?"""
+
+        for i in range(4):
+            path, digest = self.covers.store(f'v{i}', bytes([i]) * 3000)
+            os.utime(path, (i, i))
+
+        # v0 was stored first but served last
+        self.covers.lookup('v0')
+        self.covers.store('v4', b'x' * 3000)
+
+        self.assertLessEqual(self.covers.size(), 13000 * 0.9)
+        self.assertIsNotNone(self.covers.lookup('v0'))
+        self.assertIsNone(self.covers.lookup('v1'))
+        self.assertIsNotNone(self.covers.lookup('v4'))
+
+    def test_key_eviction(self):
+        """Are the least recently served keys deleted once there are more than max_keys?"""
+
+        self.covers.max_keys = 4
+
+        for i in range(4):
+            self.covers.store(f'v{i}', b'not available')
+            os.utime(os.path.join(self.dir, 'keys', f'v{i}'), (i, i))
+
+        # v0 was stored first but served last
+        self.covers.lookup('v0')
+        self.covers.store('v4', b'not available')
+
+        self.assertLessEqual(len(self.covers.keys()), 4 * 0.9)
+        self.assertIsNotNone(self.covers.lookup('v0'))
+        self.assertIsNone(self.covers.lookup('v1'))
+        self.assertIsNotNone(self.covers.lookup('v4'))
+        self.assertEqual(len(self.covers.blobs()), 1)
+
+    def test_download_redirects(self):
+        """Are redirects followed only to allowed hosts?"""
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_port}'
+
+        try:
+            covers = CoverCache(self.dir, hosts=('127.0.0.1',))
+
+            self.assertEqual(len(covers.download(f'{base}/redirect?to=/cover')), len(resize_cover(image_bytes('blue'))))
+
+            # the redirect target is checked like the original URL
+            with self.assertRaises(ValueError):
+                covers.download(f'{base}/redirect?to=http://localhost:{server.server_port}/cover')
+
+            loop = f'{base}/redirect?to=' * 5 + '/cover'
+            with self.assertRaises(ValueError):
+                covers.download(loop)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_resize_cover(self):
+        """Are covers scaled to exactly COVER_SIZE as JPEG?"""
+
+        with Image.open(io.BytesIO(resize_cover(image_bytes('red')))) as image:
+            self.assertEqual(image.size, COVER_SIZE)
+            self.assertEqual(image.format, 'JPEG')
+
+    def test_is_allowed_url(self):
+        """Are only Google Books hosts fetched?"""
+
+        self.assertTrue(is_allowed_url('http://books.google.com/books/content?id=abc&img=1'))
+        self.assertFalse(is_allowed_url('http://books.google.com.example.org/cover.jpg'))
+        self.assertFalse(is_allowed_url('/static/images/cover-not-available.png'))
+        self.assertFalse(is_allowed_url(None))
@@ -0,0 +1,94 @@
+"""Google Books client tests."""
+
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+
+import requests
+
+from google_books import GoogleBooksClient, CircuitBreaker, UpstreamUnavailable
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers with the next status in the server's `statuses` list."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps({'path': self.path}).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GoogleBooksClientTestCase(TestCase):
+    """Test the pooled Google Books client against a local stub server."""
+
+    def setUp(self):
+        """Start a stub upstream and a client pointed at it."""
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.client = GoogleBooksClient(base_url, 'test-key', max_retries=2, backoff=0,
+                                        breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_search(self):
+        """Does search send the API key and reuse one pooled connection?"""
+
+        self.client.search({'q': 'blink'})
+        result = self.client.search({'q': 'outliers'})
+
+        self.assertIn('key=test-key', result['path'])
+        self.assertIn('q=outliers', result['path'])
+        self.assertEqual(self.client.metrics()['connections_opened'], 1)
+        self.assertEqual(self.client.metrics()['requests'], 2)
+
+    def test_retry(self):
+        """Are 5xx responses retried?"""
+
+        self.server.statuses = [503, 200]
+
+        res = self.client.volume('ialrgIT41OAC')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.client.stats['retries'], 1)
+        self.assertEqual(self.client.breaker.state, 'closed')
+
+    def test_circuit_breaker(self):
+        """Does the client stop calling the API after repeated failures?"""
+
+        self.server.statuses = [500] * 6
+
+        for i in range(2):
+            with self.assertRaises(requests.HTTPError):
+                self.client.search({'q': 'blink'})
+
+        self.assertEqual(self.client.breaker.state, 'open')
+
+        with self.assertRaises(UpstreamUnavailable):
+            self.client.search({'q': 'blink'})
+
+        self.assertEqual(self.client.stats['rejected'], 1)
+
+    def test_volumes(self):
+        """Are many volumes fetched concurrently, with failures returned as None?"""
+
+        self.server.statuses = [200, 404, 200]
+
+        results = self.client.volumes(['a', 'b', 'c'], max_in_flight=1)
+
+        self.assertEqual([result is None for result in results], [False, True, False])
+        self.assertIn('/volumes/a', results[0]['path'])
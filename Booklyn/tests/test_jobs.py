@@ -0,0 +1,99 @@
+"""Background job tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Book, Job, VolumeDetail
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app
+import jobs
+import search_index
+
+db.create_all()
+
+
+@jobs.handler('test_fail')
+def fail(queued):
+    raise RuntimeError('upstream down')
+
+
+class JobTestCase(TestCase):
+    """Test the job queue and the jobs queued by User.add_to_shelf."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup(username='test1', email='u1@gmail.com', password='password', image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['JOB_MAX_ATTEMPTS'] = 5
+
+    def add_book(self):
+        return self.user.add_to_shelf('read', 'ialrgIT41OAC', 'Outliers', 'The Story of Success', None,
+                                      ['Malcolm Gladwell'], ['Psychology'], 'Penguin UK')
+
+    def test_add_to_shelf_enqueues(self):
+        """Is a new book added with its authors, and its details and indexing queued once?"""
+
+        book = self.add_book()
+        self.user.add_to_shelf('favorite', 'ialrgIT41OAC', 'Outliers', None, None, ['Malcolm Gladwell'], ['Psychology'], 'Penguin UK')
+
+        self.assertEqual([author.author for author in book.authors], ['Malcolm Gladwell'])
+        self.assertEqual([category.category for category in book.categories], ['Psychology'])
+        self.assertEqual(sorted(job.kind for job in Job.query), ['fetch_volume', 'index_book'])
+
+        # stored details mean no API call
+        VolumeDetail.store('ialrgIT41OAC', {'volumeInfo': {'title': 'Outliers'}})
+        jobs.work(app, once=True)
+
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual([found.id for found in search_index.search('gladwell')], [book.id])
+
+    def test_enqueue_dedupes_by_key(self):
+        """Is a job with the key of a waiting job skipped?"""
+
+        self.assertIsNotNone(Job.enqueue('test_fail', {}, key='same'))
+        self.assertIsNone(Job.enqueue('test_fail', {}, key='same'))
+        db.session.commit()
+
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_claim(self):
+        """Is a claimed job not claimed again until its lock times out?"""
+
+        Job.enqueue('test_fail', {})
+        db.session.commit()
+
+        self.assertEqual(len(Job.claim(kinds=['test_fail'])), 1)
+        self.assertEqual(Job.claim(kinds=['test_fail']), [])
+        self.assertEqual(len(Job.claim(kinds=['test_fail'], timeout=-1)), 1)
+
+    def test_retry_then_fail(self):
+        """Are failed jobs retried later, then marked failed after JOB_MAX_ATTEMPTS?"""
+
+        app.config['JOB_MAX_ATTEMPTS'] = 2
+        job_id = Job.enqueue('test_fail', {}).id
+        db.session.commit()
+
+        with self.assertLogs(app.logger, level='WARNING'):
+            jobs.work(app, once=True)
+
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn('upstream down', job.last_error)
+
+        job.run_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        with self.assertLogs(app.logger, level='WARNING'):
+            jobs.work(app, once=True)
+
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
@@ -0,0 +1,253 @@
+"""Library CSV import tests."""
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from urllib.parse import urlparse, parse_qs
+
+from models import db, User, Publisher, Book, Review, ShelfEntry, Job, LibraryImport, LibraryImportRow
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app, CURR_USER_KEY
+from google_books import GoogleBooksClient
+import jobs
+import library_import
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+CSV_HEADER = 'Book Id,Title,Author,ISBN,ISBN13,My Rating,Bookshelves,Exclusive Shelf,Date Added,My Review\n'
+
+CSV_ROWS = (
+    '1,Outliers,Malcolm Gladwell,"=""""","=""""",0,,to-read,2021/05/14,\n'
+    '2,"Educated (Memoirs, #1)",Tara Westover,"=""0399590501""","=""9780399590504""",5,favorites,read,2021/06/01,Gripping\n'
+    '3,An Unfindable Book,Nobody,"=""""","=""""",0,,currently-reading,,\n'
+)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Google Books search: finds Educated by its ISBN, and nothing else."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        q = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+        self.server.queries.append(q)
+
+        body = {'totalItems': 0}
+        if q == 'isbn:9780399590504':
+            body = {'totalItems': 1, 'items': [{'id': '2ObWDgAAQBAJ', 'volumeInfo': {
+                'title': 'Educated', 'subtitle': 'A Memoir', 'authors': ['Tara Westover'],
+                'categories': ['Biography & Autobiography'], 'publisher': 'Random House'}}]}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class LibraryImportTestCase(TestCase):
+    """Test library_import.py and /users/<id>/import."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup(username='test1', email='u1@gmail.com', password='password', image_url=None)
+        publisher = Publisher.create_publisher_data('Penguin UK')
+        self.outliers = Book.create_book_data('ialrgIT41OAC', 'Outliers', 'The Story of Success', None, ['Malcolm Gladwell'], ['Psychology'], publisher)
+        db.session.commit()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.queries = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.books_api = GoogleBooksClient(f'http://127.0.0.1:{self.server.server_port}', 'test-key', backoff=0)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_read_rows(self):
+        """Are titles, ISBNs, lists and ratings read from Goodreads' columns?"""
+
+        rows = list(library_import.read_rows(io.StringIO(CSV_HEADER + CSV_ROWS)))
+
+        self.assertEqual([row['title'] for row in rows], ['Outliers', 'Educated', 'An Unfindable Book'])
+        self.assertEqual([row['isbn'] for row in rows], [None, '9780399590504', None])
+        self.assertEqual([row['shelves'] for row in rows], [['want_to_read'], ['read', 'favorite'], ['currently_reading']])
+        self.assertEqual(rows[1]['rating'], 5)
+        self.assertEqual(rows[1]['date_added'], '2021-06-01T00:00:00')
+
+        with self.assertRaises(ValueError):
+            list(library_import.read_rows(io.StringIO('Name,Author\nOutliers,Malcolm Gladwell\n')))
+
+    def test_run_import(self):
+        """Are stored books matched locally, the rest found on the API, and the lists, ratings and progress written?"""
+
+        progress = []
+        record = library_import.run_import(self.user.id, io.StringIO(CSV_HEADER + CSV_ROWS), 'export.csv', self.books_api,
+                                           batch_size=2, progress=lambda record: progress.append(record.rows_done))
+
+        # Outliers is already stored, so only the other two rows are searched for
+        self.assertEqual(sorted(self.server.queries), ['intitle:An Unfindable Book inauthor:Nobody', 'isbn:9780399590504'])
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual((record.rows_total, record.added, record.not_found), (3, 2, 1))
+        self.assertEqual(record.unmatched, ['An Unfindable Book'])
+        self.assertIsNotNone(record.finished_at)
+
+        educated = Book.query.filter_by(volumeId='2ObWDgAAQBAJ').one()
+        self.assertEqual([author.author for author in educated.authors], ['Tara Westover'])
+        self.assertEqual(educated.publisher.publisher, 'Random House')
+        self.assertEqual((educated.review_count, educated.rating_5), (1, 1))
+        self.assertEqual(Review.query.filter_by(user_id=self.user.id, book_id=educated.id).one().review, 'Gripping')
+
+        entries = {(entry.book_id, entry.shelf) for entry in ShelfEntry.query.filter_by(user_id=self.user.id)}
+        self.assertEqual(entries, {(self.outliers.id, 'want_to_read'), (educated.id, 'read'), (educated.id, 'favorite')})
+        self.assertEqual(Job.query.filter_by(kind='fetch_volume').count(), 1)
+
+        # importing the same file again adds nothing twice
+        library_import.run_import(self.user.id, io.StringIO(CSV_HEADER + CSV_ROWS), 'export.csv', self.books_api, batch_size=2)
+        self.assertEqual(ShelfEntry.query.filter_by(user_id=self.user.id).count(), 3)
+        self.assertEqual(Review.query.filter_by(user_id=self.user.id).count(), 1)
+
+    def test_run_import_failed(self):
+        """Is an import whose searches fail left finished, with the failed chunk counted?"""
+
+        books_api = GoogleBooksClient('http://127.0.0.1:1', 'test-key', backoff=0)
+
+        with self.assertRaises(RuntimeError):
+            library_import.run_import(self.user.id, io.StringIO(CSV_HEADER + CSV_ROWS), 'export.csv', books_api, batch_size=2)
+
+        record = LibraryImport.query.one()
+        self.assertEqual((record.rows_total, record.rows_done, record.rows_failed), (2, 2, 2))
+        self.assertIsNotNone(record.finished_at)
+
+    def test_import_command_bad_row(self):
+        """Does the command stop with an error on a row csv can't read, and finish the import?"""
+
+        path = os.path.join(self.tmp, 'export.csv')
+        with open(path, 'w') as f:
+            # the first row is already stored, so nothing is searched for
+            f.write(CSV_HEADER + CSV_ROWS.splitlines(True)[0] + '2,"' + 'x' * (csv.field_size_limit() + 1) + '",Nobody\n')
+
+        result = app.test_cli_runner().invoke(args=['import-library', str(self.user.id), path, '--batch-size', '1'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Import stopped', result.output)
+
+        record = LibraryImport.query.one()
+        self.assertEqual((record.rows_total, record.rows_done, record.rows_failed), (1, 1, 0))
+        self.assertIsNotNone(record.finished_at)
+
+        # the error's traceback keeps the command's objects alive, so don't leave them in the shared session
+        db.session.remove()
+
+    def test_import_view(self):
+        """Does uploading a file store its rows and queue import_rows jobs for them, left for the worker process?"""
+
+        user_id = self.user.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            data = {'file': (io.BytesIO((CSV_HEADER + CSV_ROWS).encode()), 'export.csv')}
+            resp = c.post(f'/users/{user_id}/import', data=data, content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 302)
+            # runs the request's call_on_close callbacks
+            resp.close()
+
+            record = LibraryImport.query.filter_by(user_id=user_id).one()
+            self.assertEqual((record.rows_total, record.rows_done), (3, 0))
+
+            # JOBS_RUN_AFTER_RESPONSE is on, but import_rows jobs only run in the worker
+            jobs = Job.query.filter_by(kind='import_rows').all()
+            self.assertEqual([(job.payload['start'], job.payload['stop'], job.status) for job in jobs], [(0, 100, 'queued')])
+            self.assertNotIn('rows', jobs[0].payload)
+
+            # the jobs read the rows stored for the import
+            rows = LibraryImportRow.chunk(record.id, 0, 100)
+            self.assertEqual([row['title'] for row in rows], ['Outliers', 'Educated', 'An Unfindable Book'])
+
+            resp = c.get(f'/api/users/{user_id}/imports/{record.id}')
+            self.assertEqual(resp.json['rows_total'], 3)
+
+            data = {'file': (io.BytesIO(b'Name\nOutliers\n'), 'other.csv')}
+            resp = c.post(f'/users/{user_id}/import', data=data, content_type='multipart/form-data', follow_redirects=True)
+            self.assertIn('Could not read the file', resp.get_data(as_text=True))
+
+            # a file that can't be decoded half way through writes nothing either
+            app.config['IMPORT_BATCH_SIZE'] = 1
+            try:
+                data = {'file': (io.BytesIO((CSV_HEADER + CSV_ROWS).encode() + b'4,\xff\xfe,Nobody\n'), 'bad.csv')}
+                resp = c.post(f'/users/{user_id}/import', data=data, content_type='multipart/form-data', follow_redirects=True)
+                self.assertIn('Could not read the file', resp.get_data(as_text=True))
+            finally:
+                app.config['IMPORT_BATCH_SIZE'] = 100
+
+            self.assertEqual(LibraryImport.query.filter_by(user_id=user_id).count(), 1)
+            self.assertEqual(Job.query.filter_by(kind='import_rows').count(), 1)
+            self.assertEqual(LibraryImportRow.query.count(), 3)
+
+    def test_import_too_large(self):
+        """Is an upload over MAX_CONTENT_LENGTH turned away before it's read?"""
+
+        user_id = self.user.id
+        app.config['MAX_CONTENT_LENGTH'] = 100
+
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                data = {'file': (io.BytesIO((CSV_HEADER + CSV_ROWS).encode()), 'export.csv')}
+                resp = c.post(f'/users/{user_id}/import', data=data, content_type='multipart/form-data', follow_redirects=True)
+        finally:
+            app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('The file is too large', resp.get_data(as_text=True))
+        self.assertEqual(LibraryImport.query.count(), 0)
+
+    def test_failed_chunk(self):
+        """Does an import still finish when one of its chunks fails for good?"""
+
+        app.config['JOB_MAX_ATTEMPTS'] = 1
+        record = LibraryImport(user_id=self.user.id, filename='export.csv', rows_total=2)
+        db.session.add(record)
+        db.session.flush()
+
+        # a row without a title can't be imported
+        LibraryImportRow.store(record.id, 0, [{}, {}])
+        Job.enqueue('import_rows', {'import_id': record.id, 'user_id': self.user.id, 'start': 0, 'stop': 100})
+        db.session.commit()
+        import_id = record.id
+
+        try:
+            with self.assertLogs(app.logger, level='WARNING'):
+                jobs.work(app, once=True)
+        finally:
+            app.config['JOB_MAX_ATTEMPTS'] = 5
+
+        # the worker wrote through a session of its own
+        db.session.expire_all()
+        record = LibraryImport.query.get(import_id)
+        self.assertEqual((record.rows_done, record.rows_failed), (2, 2))
+        self.assertIsNotNone(record.finished_at)
+        self.assertEqual(Job.query.filter_by(kind='import_rows').one().status, 'failed')
+        self.assertEqual(LibraryImportRow.query.count(), 0)
@@ -0,0 +1,103 @@
+"""Metrics registry tests."""
+
+import os
+import json
+import tempfile
+from unittest import TestCase
+
+from metrics import Registry
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app
+
+
+class RegistryTestCase(TestCase):
+    """Test the in-process metrics registry."""
+
+    def setUp(self):
+        self.registry = Registry()
+        self.requests = self.registry.counter('requests_total', 'Requests.', ('endpoint',))
+        self.latency = self.registry.histogram('latency_seconds', 'Latency.', ('endpoint',), buckets=(0.1, 1))
+
+    def test_counter(self):
+        """Are counters kept per label set?"""
+
+        self.requests.inc(endpoint='search')
+        self.requests.inc(endpoint='search')
+        self.requests.inc(endpoint='show_book')
+
+        output = self.registry.render()
+
+        self.assertIn('# TYPE requests_total counter', output)
+        self.assertIn('requests_total{endpoint="search"} 2', output)
+        self.assertIn('requests_total{endpoint="show_book"} 1', output)
+
+    def test_histogram(self):
+        """Are histogram buckets cumulative, with sum and count?"""
+
+        self.latency.observe(0.05, endpoint='search')
+        self.latency.observe(0.5, endpoint='search')
+        self.latency.observe(3, endpoint='search')
+
+        output = self.registry.render()
+
+        self.assertIn('latency_seconds_bucket{endpoint="search",le="0.1"} 1', output)
+        self.assertIn('latency_seconds_bucket{endpoint="search",le="1.0"} 2', output)
+        self.assertIn('latency_seconds_bucket{endpoint="search",le="+Inf"} 3', output)
+        self.assertIn('latency_seconds_sum{endpoint="search"} 3.55', output)
+        self.assertIn('latency_seconds_count{endpoint="search"} 3', output)
+
+    def test_gauge_callback(self):
+        """Are gauge callbacks read at collection time?"""
+
+        stats = {'in_flight': 1}
+        self.registry.gauge('in_flight', 'In flight.', collect=lambda: {(): stats['in_flight']})
+        stats['in_flight'] = 4
+
+        self.assertIn('in_flight 4', self.registry.render())
+
+    def test_workers_are_added_up(self):
+        """Does a scrape add this worker's snapshot to the other workers'?"""
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            self.registry.snapshot_dir = snapshot_dir
+
+            # another worker's snapshot
+            with open(os.path.join(snapshot_dir, '1.json'), 'w') as f:
+                json.dump({'requests_total': {'kind': 'counter', 'help': 'Requests.',
+                                              'samples': [['', {'endpoint': 'search'}, 5]]}}, f)
+
+            self.requests.inc(endpoint='search')
+            output = self.registry.render()
+
+            self.assertIn('requests_total{endpoint="search"} 6', output)
+
+            self.registry.remove_snapshot(1)
+            self.assertIn('requests_total{endpoint="search"} 1', self.registry.render())
+
+
+class MetricsViewTestCase(TestCase):
+    """Test who may read /metrics and /metrics/google_books."""
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+
+    def test_token_required(self):
+        """Are the metrics hidden without METRICS_TOKEN, and only served with it as a bearer token?"""
+
+        client = app.test_client()
+
+        app.config['METRICS_TOKEN'] = None
+        for url in ('/metrics', '/metrics/google_books'):
+            self.assertEqual(client.get(url).status_code, 404)
+            self.assertEqual(client.get(url, headers={'Authorization': 'Bearer '}).status_code, 404)
+
+        app.config['METRICS_TOKEN'] = 'scrape-secret'
+        for url in ('/metrics', '/metrics/google_books'):
+            self.assertEqual(client.get(url).status_code, 401)
+            self.assertEqual(client.get(url, headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+            self.assertEqual(client.get(url, headers={'Authorization': 'Bearer scrape-secret'}).status_code, 200)
+
+        resp = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertIn('# TYPE booklyn_db_pool_connections gauge', resp.get_data(as_text=True))
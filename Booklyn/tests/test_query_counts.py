@@ -0,0 +1,185 @@
+"""SQL statement budget tests for the profile, list and review pages."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Publisher, Book, Review, SHELVES
+from instrumentation import QueryCounter
+
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+
+# statements per page, whatever the number of books on the user's lists
+# (load the profile user, then the page's own queries)
+MAX_STATEMENTS = {
+    'profile': 3,
+    'list': 4,
+    'reviews': 2,
+    'remove': 2,
+}
+
+
+class QueryCountTestCase(TestCase):
+    """Pages run a fixed number of SQL statements, however many books a user has."""
+
+    def setUp(self):
+        """Create a user with books on every list and reviews for them."""
+
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup(username='test1', email='u1@gmail.com', password='password', image_url=None)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.client = app.test_client()
+        self.add_books(2)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add_books(self, count):
+        """Put `count` more books on every list, each with its own author and a review."""
+
+        user = User.query.get(self.user_id)
+        publisher = Publisher.create_publisher_data('Penguin UK')
+        start = Book.query.count()
+
+        for i in range(start, start + count):
+            book = Book.create_book_data(f'volume{i}', f'Book {i}', None, None, [f'Author {i}'], ['Fiction'], publisher)
+
+            for shelf in SHELVES:
+                getattr(user, shelf).append(book)
+
+            db.session.add(Review(rating=4, review='Good', user_id=self.user_id, book_id=book.id))
+
+        db.session.commit()
+
+    def count_statements(self, path):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            # log in properly first, so the session carries the user's principal
+            c.get('/')
+
+            # start from an empty session, as a real request would
+            db.session.remove()
+
+            with QueryCounter(db.engine) as counter:
+                resp = c.get(path)
+
+        self.assertEqual(resp.status_code, 200)
+        return counter.count
+
+    def assert_flat(self, path, budget):
+        """The page stays within budget, and adding books doesn't add statements."""
+
+        few = self.count_statements(path)
+        self.add_books(5)
+        many = self.count_statements(path)
+
+        self.assertLessEqual(few, budget)
+        self.assertEqual(few, many)
+
+    def test_profile_page(self):
+        """Does users_show load its previews in a fixed number of statements?"""
+
+        self.assert_flat(f'/users/{self.user_id}', MAX_STATEMENTS['profile'])
+
+    def test_list_pages(self):
+        """Do the list pages load books, authors and categories in a fixed number of statements?"""
+
+        for shelf in ('want_to_read', 'currently_reading', 'read'):
+            self.assert_flat(f'/users/{self.user_id}/{shelf}', MAX_STATEMENTS['list'])
+
+    def test_favorite_page(self):
+        """Does the favorite page load the user's reviews in one more statement?"""
+
+        self.assert_flat(f'/users/{self.user_id}/favorite', MAX_STATEMENTS['list'] + 1)
+
+    def test_reviews_page(self):
+        """Does show_reviews load every review's book in the same query?"""
+
+        self.assert_flat(f'/users/{self.user_id}/reviews', MAX_STATEMENTS['reviews'])
+
+    def test_remove_from_list(self):
+        """Does taking a book off a list cost the same however long the list is?"""
+
+        self.add_books(20)
+        counts = []
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get('/')
+
+            for book_id in (1, 22):
+                db.session.remove()
+
+                with QueryCounter(db.engine) as counter:
+                    resp = c.post(f'/users/{self.user_id}/read/{book_id}/delete')
+
+                self.assertEqual(resp.status_code, 302)
+                counts.append(counter.count)
+
+            # not on the list any more
+            self.assertEqual(c.post(f'/users/{self.user_id}/read/1/delete').status_code, 404)
+
+        self.assertLessEqual(counts[0], MAX_STATEMENTS['remove'])
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(User.query.get(self.user_id).shelves_for_book(1), {'want_to_read', 'currently_reading', 'favorite'})
+
+    def test_query_headers(self):
+        """Does every response report its statement count and database time?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            db.session.remove()
+
+            with QueryCounter(db.engine) as counter:
+                resp = c.get(f'/users/{self.user_id}')
+
+        self.assertEqual(resp.headers['X-DB-Queries'], str(counter.count))
+        self.assertIn('db;dur=', resp.headers['Server-Timing'])
+
+    def test_slow_query_log(self):
+        """Are statements over SLOW_QUERY_MS logged with their route?"""
+
+        app.config['SLOW_QUERY_MS'] = 0
+
+        try:
+            with self.assertLogs(app.logger, level='WARNING') as logs:
+                self.count_statements(f'/users/{self.user_id}')
+        finally:
+            app.config['SLOW_QUERY_MS'] = 200
+
+        self.assertIn(f'GET /users/{self.user_id}', logs.output[0])
+
+    def test_logged_in_user_not_reloaded(self):
+        """Is the logged in user read from the session instead of the database?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            # the first request stores the principal in the session
+            c.get('/')
+
+            with QueryCounter(db.engine) as counter:
+                resp = c.get('/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('test1', resp.get_data(as_text=True))
+        self.assertEqual(counter.count, 0)
@@ -2,6 +2,7 @@
 
 import os
 from unittest import TestCase
+from datetime import datetime
 from sqlalchemy import exc
 
 from models import db, User, Author, Category, Publisher, Book, Review
@@ -102,3 +103,65 @@ class BookModelTestCase(TestCase):
         self.assertEqual(len(book.reviews), 1)
         self.assertEqual(book.reviews[0].rating, 5)
         self.assertEqual(book.reviews[0].review, 'Loved it!')
+
+    def test_rating_counts(self):
+        """Does count_rating keep a book's rating columns in step with its reviews?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+
+        Book.count_rating(book.id, added=5)
+        Book.count_rating(book.id, added='3')
+        db.session.commit()
+
+        self.assertEqual((book.review_count, book.rating_sum), (2, 8))
+        self.assertEqual(book.average_rating, 4)
+        self.assertEqual(book.rating_histogram, [(5, 1), (4, 0), (3, 1), (2, 0), (1, 0)])
+
+        Book.count_rating(book.id, added=4, removed=5)
+        Book.count_rating(book.id, removed=3)
+        db.session.commit()
+
+        self.assertEqual((book.review_count, book.rating_sum), (1, 4))
+        self.assertEqual(book.rating_histogram, [(5, 0), (4, 1), (3, 0), (2, 0), (1, 0)])
+
+    def test_reconcile_ratings(self):
+        """Does reconcile_ratings rebuild the rating columns from the reviews table?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+
+        db.session.add(Review(rating=5, review='Loved it!', user_id=self.u1_id, book_id=book.id))
+        db.session.add(Review(rating=2, review=None, user_id=self.u2_id, book_id=book.id))
+        book.rating_1 = 7
+        db.session.commit()
+
+        self.assertEqual(Book.reconcile_ratings(batch_size=1), 1)
+        self.assertEqual(Book.reconcile_ratings(), 0)
+
+        book = Book.query.filter_by(title=self.title).first()
+        self.assertEqual((book.review_count, book.rating_sum), (2, 7))
+        self.assertEqual(book.rating_histogram, [(5, 1), (4, 0), (3, 0), (2, 1), (1, 0)])
+
+    def test_review_page(self):
+        """Does review_page return a book's reviews newest first, a page at a time?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+
+        for i in range(5):
+            db.session.add(Review(rating=4, review=f'review {i}', user_id=self.u1_id, book_id=book.id,
+                                  date_added=datetime(2022, 1, 1 + i // 2)))
+        db.session.commit()
+
+        reviews, cursor = book.review_page(2)
+        self.assertEqual([review.review for review in reviews], ['review 4', 'review 3'])
+
+        pages = [reviews]
+        while cursor:
+            reviews, cursor = book.review_page(2, cursor)
+            pages.append(reviews)
+
+        self.assertEqual([[review.review for review in page] for page in pages],
+                         [['review 4', 'review 3'], ['review 2', 'review 1'], ['review 0']])
+        self.assertEqual(pages[0][0].serialize()['user']['username'], 'test1')
+
+        with self.assertRaises(ValueError):
+            book.review_page(2, 'nonsense')
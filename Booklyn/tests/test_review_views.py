@@ -99,6 +99,9 @@ class BookViewTestCase(TestCase):
         self.rating = rating
         self.review = review
 
+    def tearDown(self):
+        db.session.rollback()
+
     
     def test_show_reviews(self):
         """Test show_reviews."""
@@ -168,6 +171,46 @@ class BookViewTestCase(TestCase):
             self.assertIn('Reviews', html)
 
 
+    def test_review_rating_counts(self):
+        """Do editing and deleting a review update the book's rating counts?"""
+
+        Book.reconcile_ratings()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            review = Review.query.filter_by(review=self.review).first()
+            c.post(f'/users/{self.u1_id}/reviews/{review.id}/update', data={'rating': '3', 'review': 'Liked it'})
+
+            book = Book.query.filter_by(title=self.title).first()
+            self.assertEqual((book.review_count, book.rating_sum, book.rating_5, book.rating_3), (1, 3, 0, 1))
+
+            c.post(f'/users/{self.u1_id}/reviews/{review.id}/delete')
+
+            db.session.expire_all()
+            self.assertEqual((book.review_count, book.rating_sum, book.rating_3), (0, 0, 0))
+
+    def test_book_reviews_json(self):
+        """Does /api/books/<volumeId>/reviews page through a book's reviews?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+        db.session.add(Review(rating=2, review='Not for me', user_id=self.u2_id, book_id=book.id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f'/api/books/{self.volumeId}/reviews?limit=1')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([review['review'] for review in resp.json['reviews']], ['Not for me'])
+            self.assertEqual(resp.json['reviews'][0]['user']['username'], 'test2')
+
+            resp = c.get(f'/api/books/{self.volumeId}/reviews?limit=1&after={resp.json["next"]}')
+            self.assertEqual([review['review'] for review in resp.json['reviews']], [self.review])
+            self.assertIsNone(resp.json['next'])
+
+            self.assertEqual(c.get(f'/api/books/{self.volumeId}/reviews?after=nonsense').status_code, 400)
+            self.assertEqual(c.get('/api/books/nonexistent/reviews').status_code, 404)
+
     def test_update_review_get(self):
         """Test update_review view with get request."""
 
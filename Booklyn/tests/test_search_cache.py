@@ -0,0 +1,71 @@
+"""Search cache tests."""
+
+from unittest import TestCase
+
+from search_cache import SearchCache, CacheEntry
+
+
+class SearchCacheTestCase(TestCase):
+    """Test the search results cache."""
+
+    def setUp(self):
+        """Create a cache and a fake upstream that counts calls."""
+
+        self.cache = SearchCache(ttl=60, stale_ttl=60, max_entries=2)
+        self.calls = 0
+
+    def fetch(self):
+        self.calls += 1
+        return {'items': [{'id': 'ialrgIT41OAC'}], 'call': self.calls}
+
+    def test_make_key(self):
+        """Do equivalent queries share a key?"""
+
+        params = {'q': 'Blink', 'maxResults': 40, 'key': 'secret'}
+
+        self.assertEqual(SearchCache.make_key('  Blink ', params), SearchCache.make_key('blink', {'maxResults': 40}))
+        self.assertNotEqual(SearchCache.make_key('blink', {'maxResults': 40}), SearchCache.make_key('blink', {'maxResults': 5}))
+
+    def test_read_through(self):
+        """Is the second lookup served from the cache?"""
+
+        first = self.cache.get_or_fetch('blink', self.fetch)
+        second = self.cache.get_or_fetch('blink', self.fetch)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.hit_ratio(), 0.5)
+
+    def test_eviction(self):
+        """Is the least recently used entry evicted?"""
+
+        self.cache.get_or_fetch('a', self.fetch)
+        self.cache.get_or_fetch('b', self.fetch)
+        self.cache.get_or_fetch('a', self.fetch)
+        self.cache.get_or_fetch('c', self.fetch)
+
+        self.assertEqual(len(self.cache.local), 2)
+        self.assertIsNone(self.cache.local.get('b'))
+        self.assertIsNotNone(self.cache.local.get('a'))
+
+    def test_stale_entry_served_when_upstream_fails(self):
+        """Is an expired entry returned if the upstream call raises?"""
+
+        self.cache.local.set('blink', CacheEntry({'items': []}, fetched_at=0))
+
+        def broken_fetch():
+            raise ConnectionError()
+
+        self.assertEqual(self.cache.get_or_fetch('blink', broken_fetch), {'items': []})
+        self.assertEqual(self.cache.stats['errors'], 1)
+
+    def test_miss_without_entry_raises(self):
+        """Is the upstream error raised when there is nothing cached?"""
+
+        def broken_fetch():
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            self.cache.get_or_fetch('blink', broken_fetch)
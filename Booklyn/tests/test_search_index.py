@@ -0,0 +1,81 @@
+"""Local full-text search tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Publisher, Book, Review
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app, CURR_USER_KEY
+import search_index
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SearchIndexTestCase(TestCase):
+    """Test search_index.py and /search?source=local."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup(username='test1', email='u1@gmail.com', password='password', image_url=None)
+        publisher = Publisher.create_publisher_data('Penguin UK')
+
+        self.outliers = Book.create_book_data('ialrgIT41OAC', 'Outliers', 'The Story of Success', None, ['Malcolm Gladwell'], ['Psychology'], publisher)
+        self.educated = Book.create_book_data('2ObWDgAAQBAJ', 'Educated', 'A Memoir', None, ['Tara Westover'], ['Biography'], publisher)
+
+        db.session.add(Review(rating=5, review='Better than Outliers, and about success too', user_id=self.user.id, book_id=self.educated.id))
+        db.session.commit()
+
+        search_index.reindex_all()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def titles(self, query):
+        return [book.title for book in search_index.search(query)]
+
+    def test_search(self):
+        """Are books found by title, subtitle, author and review text, title matches first?"""
+
+        self.assertEqual(self.titles('westover'), ['Educated'])
+        self.assertEqual(self.titles('memoir'), ['Educated'])
+        self.assertEqual(self.titles('outliers'), ['Outliers', 'Educated'])
+        self.assertEqual(self.titles('gladwell success'), ['Outliers'])
+        self.assertEqual(self.titles('dickens'), [])
+
+    def test_query_syntax_ignored(self):
+        """Does user input with search operators neither fail nor match everything?"""
+
+        self.assertEqual(self.titles('westover) "memoir'), ['Educated'])
+        self.assertEqual(self.titles('*'), [])
+        self.assertEqual(self.titles(''), [])
+
+    def test_reindex(self):
+        """Does reindexing a book pick up a new review?"""
+
+        db.session.add(Review(rating=4, review='A page-turner', user_id=self.user.id, book_id=self.outliers.id))
+        search_index.reindex([self.outliers.id])
+        db.session.commit()
+
+        self.assertEqual(self.titles('turner'), ['Outliers'])
+
+    def test_local_search_view(self):
+        """Does /search?source=local answer from our own books without calling the API?"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            resp = c.get('/search?q=westover&source=local')
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Educated', html)
+        self.assertIn('on Booklyn', html)
+        self.assertNotIn('Outliers', html)
@@ -0,0 +1,135 @@
+"""Search box suggestion tests."""
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User, Publisher, Book, ShelfEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
+
+from app import app, CURR_USER_KEY
+import app as app_module
+from suggest import SuggestIndex, trigrams
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def wait_for(check, timeout=5):
+    """Poll check() until it returns something truthy or timeout seconds pass."""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class SuggestTestCase(TestCase):
+    """Test suggest.py and /search/suggest."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup(username='test1', email='u1@gmail.com', password='password', image_url=None)
+        self.publisher = Publisher.create_publisher_data('Penguin UK')
+
+        self.outliers = Book.create_book_data('ialrgIT41OAC', 'Outliers', 'The Story of Success', None, ['Malcolm Gladwell'], ['Psychology'], self.publisher)
+        self.tipping = Book.create_book_data('yBDBEGBIUmgC', 'The Tipping Point', None, None, ['Malcolm Gladwell'], ['Psychology'], self.publisher)
+        self.stories = Book.create_book_data('2ObWDgAAQBAJ', 'Short Stories', None, None, ['Anton Chekhov'], ['Fiction'], self.publisher)
+
+        db.session.add(ShelfEntry(user_id=self.user.id, book_id=self.tipping.id, shelf='read'))
+        db.session.commit()
+
+        self.index = SuggestIndex()
+        self.index.refresh()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def labels(self, query, limit=10):
+        return [item['label'] for item in self.index.suggest(query, limit)]
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams('cat'), {'  c', ' ca', 'cat', 'at '})
+
+    def test_prefix(self):
+        """Are titles and names found by the start of any word, whole-label matches and popular books first?"""
+
+        Book.create_book_data('ZbD0AAAAMAAJ', 'Tipping the Velvet', None, None, ['Sarah Waters'], ['Fiction'], self.publisher)
+        Book.create_book_data('qgYPAQAAIAAJ', 'The Outsider', None, None, ['Albert Camus'], ['Fiction'], self.publisher)
+        db.session.commit()
+        self.index.refresh(force=True)
+
+        self.assertEqual(self.labels('out'), ['Outliers', 'The Outsider'])
+        self.assertEqual(self.labels('gladw'), ['Malcolm Gladwell'])
+        self.assertEqual(self.labels('point'), ['The Tipping Point'])
+        self.assertEqual(self.labels('tipping'), ['Tipping the Velvet', 'The Tipping Point'])
+        self.assertEqual(self.labels('the', limit=2), ['The Tipping Point', 'The Outsider'])
+
+    def test_typo(self):
+        """Do misspelled queries still find the entry by trigram similarity?"""
+
+        self.assertEqual(self.labels('malcom gladwel'), ['Malcolm Gladwell'])
+        self.assertEqual(self.labels('tiping point'), ['The Tipping Point'])
+        self.assertEqual(self.labels('xyzzy'), [])
+        self.assertEqual(self.labels(''), [])
+
+    def test_refresh(self):
+        """Does a refresh add only the books and authors created since the last one?"""
+
+        size = len(self.index)
+
+        Book.create_book_data('hVFwAAAAQBAJ', 'David and Goliath', None, None, ['Malcolm Gladwell'], ['Psychology'], self.publisher)
+        db.session.commit()
+
+        self.index.refresh()
+        self.assertEqual(self.labels('goliath'), [])
+
+        self.index.refresh(force=True)
+        self.assertEqual(self.labels('goliath'), ['David and Goliath'])
+        self.assertEqual(len(self.index), size + 1)
+
+    def test_background_refresh(self):
+        """Does start() load a new index in the background and pick up books added after?"""
+
+        index = SuggestIndex(refresh_seconds=0.05)
+        index.start(app)
+
+        try:
+            self.assertTrue(wait_for(lambda: index.suggest('outl')))
+
+            Book.create_book_data('hVFwAAAAQBAJ', 'David and Goliath', None, None, ['Malcolm Gladwell'], ['Psychology'], self.publisher)
+            db.session.commit()
+
+            self.assertTrue(wait_for(lambda: index.suggest('goliath')))
+        finally:
+            index.stop()
+
+    def test_suggest_view(self):
+        """Does /search/suggest return JSON suggestions from the loaded index, and only to logged in users?"""
+
+        app_module.suggest_index = self.index
+
+        try:
+            with app.test_client() as c:
+                resp = c.get('/search/suggest?q=outl')
+                self.assertEqual(resp.status_code, 401)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user.id
+
+                resp = c.get('/search/suggest?q=outl')
+        finally:
+            # the view starts the background refresh when gunicorn hasn't
+            self.index.stop()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['suggestions'], [
+            {'type': 'book', 'label': 'Outliers', 'volumeId': 'ialrgIT41OAC', 'url': '/books/ialrgIT41OAC'},
+        ])
+        self.assertIn('private', resp.headers['Cache-Control'])
@@ -4,7 +4,7 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Author, Category, Publisher, Book, Review
+from models import db, User, Author, Category, Publisher, Book, Review, ShelfEntry
 
 os.environ['DATABASE_URL'] = "postgresql:///booklyn-test"
 
@@ -222,3 +222,34 @@ class UserModelTestCase(TestCase):
 
 
 
+
+    def test_shelves(self):
+        """Do the shelf helpers read from shelf_entries?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+        self.u1.favorite.append(book)
+        db.session.commit()
+
+        self.assertEqual(self.u1.shelves_for_book(book.id), {'want_to_read', 'favorite'})
+        entries, next_cursor = self.u1.shelf_page('favorite', 10)
+        self.assertEqual([entry.book for entry in entries], [book])
+        self.assertIsNone(next_cursor)
+        self.assertEqual(ShelfEntry.query.filter_by(user_id=self.u1_id).count(), 2)
+
+        self.u1.favorite.remove(book)
+        db.session.commit()
+
+        self.assertEqual(self.u1.shelves_for_book(book.id), {'want_to_read'})
+
+    def test_reviews_for_books(self):
+        """Does reviews_for_books only return the user's reviews of the given books?"""
+
+        book = Book.query.filter_by(title=self.title).first()
+        self.assertEqual(self.u1.reviews_for_books([book.id]), {})
+
+        review = Review(rating=4, review='Good', user_id=self.u1_id, book_id=book.id)
+        db.session.add(review)
+        db.session.commit()
+
+        self.assertEqual(self.u1.reviews_for_books([book.id, book.id + 1]), {book.id: review})
+        self.assertEqual(self.u1.reviews_for_books([]), {})